@@ -8,9 +8,20 @@
 
 
 from math import *
-from decimal import Decimal
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-import xlsxwriter
+from mplay import instrument, scoring
+from mplay.aggregate import RunningTable, vectorize
+from mplay.cache import QCache, cache_key
+from mplay.checkpoint import train_checkpointed
+from mplay.distance import pair_values, pairwise_distances
+from mplay.parallel import replica_seed
+from mplay.policy import greedy_successors, policy_routes, route_histogram
+from mplay.qbatch import BatchQAgent
+from mplay.solver import exact_qtable
+from mplay.store import StackWriter, export_excel, save_qtables
+from mplay.topology import TopologyIndex
+from mplay.weights import weight_layers
 
 
 # ### Define Q-Learning Class
@@ -34,8 +45,11 @@ class QAgent():
         
         self.Q = Q
         
-    def training(self, start_location, end_location, iterations):
+    def training(self, start_location, end_location, iterations, tolerance=None, window=100):
         """Training the system in the given environment to move from a start state to an end state
+
+        With a tolerance, training stops once no Q-value has moved by tolerance or more over the last
+        window iterations. iterations_used records how many iterations actually ran.
         """
         rewards_new = np.copy(self.rewards)
         
@@ -43,20 +57,22 @@ class QAgent():
         ending_state = self.location_to_state[end_location]
         rewards_new[ending_state, ending_state] = 999
 
+        #index the possible actions of every state once
+        playable = TopologyIndex(rewards_new)
+
+        self.iterations_used = iterations
+        #last iteration that moved a Q-value by tolerance or more
+        last_moved = -1
+        td_updates = 0
+
         #Loop for iterations
         for i in range(iterations):
             #Randomly pick a state to observe
             current_state = np.random.randint(0,len(self.rewards)) 
-            playable_actions = []
-
-            #Construct list of possible actions
-            for j in range(len(self.rewards)):
-                if rewards_new[current_state,j] > 0:
-                    playable_actions.append(j)
 
             #Only run updates if observed state has performable actions
-            if len(playable_actions) > 0:
-                next_state = np.random.choice(playable_actions)
+            if playable.degrees[current_state] > 0:
+                next_state = playable.sample_action(current_state)
 
                 #Calculate temporal difference
                 TD = rewards_new[current_state,next_state] +                         self.gamma * self.Q[next_state, np.argmax(self.Q[next_state,])] - self.Q[current_state,next_state]
@@ -65,25 +81,26 @@ class QAgent():
 
                 #updates Q-value using Bellman equation
                 self.Q[current_state,next_state] += self.alpha * TD
+                td_updates += 1
+
+                if tolerance is not None and abs(self.alpha * TD) >= tolerance:
+                    last_moved = i
+
+            #stop once Q has been stable for a whole window
+            if tolerance is not None and i - last_moved >= window:
+                self.iterations_used = i + 1
+                break
+
+        instrument.count("iterations", self.iterations_used)
+        instrument.count("td_updates", td_updates)
+        instrument.count("dead_end_hits", self.iterations_used - td_updates)
 
-        route = [start_location]
-        next_location = start_location
-        
         # Get the route 
-        return self.get_optimal_route(start_location, end_location, next_location, route, self.Q)
-        
-    # Get the optimal route
-    def get_optimal_route(self, start_location, end_location, next_location, route, Q):
+        return self.get_optimal_route(start_location, end_location, self.Q)
         
-        while(next_location != end_location):
-            starting_state = self.location_to_state[start_location]
-            next_state = np.argmax(Q[starting_state,])
-            #episilon?
-            next_location = self.state_to_location[next_state]
-            route.append(next_location)
-            start_location = next_location
-        
-        return route
+    # Get the optimal route, or None when the greedy walk hits a dead end or goes around a cycle
+    def get_optimal_route(self, start_location, end_location, Q):
+        return policy_routes(greedy_successors(Q[np.newaxis]), self.location_to_state, start_location, end_location)[0]
 
 
 # ### Accept file names
@@ -102,6 +119,8 @@ with open(filename) as textFile:
     
 #list of averaged q-tables to take minkowski differences of
 averaged_tables = []
+#per-cell standard deviation of the replicas behind each averaged table
+averaged_spread = []
 
 # Define the states
 location_to_state = {
@@ -134,60 +153,161 @@ state_to_location = dict((state,location) for location,state in location_to_stat
 # Initialize parameters
 gamma = 0.75 # Discount factor (discounts previous rewards)
 alpha = 0.9 # Learning rate
-
-#generates excel spreadsheet containing all q-tables in a given path
-def to_excel(paths_taken, qtables, final_state):
-    """store data in excel
+batched = True # Train all replicas of an ending together instead of one QAgent at a time
+solver = "sampled" # "exact" computes the converged q-table directly instead of averaging 100 trained replicas
+workers = 1 # Number of processes to spread (ending, replica) training over; 1 trains in this process
+seed = 0 # Base seed of each replica when training over several processes or with a tolerance
+excel = False # Also write every q-table to an .xlsx workbook next to the .npy output
+tolerance = None # Stop training a replica once no Q-value moves by this much over window iterations; batched replicas then draw from their own seeded generators
+window = 100 # Number of iterations Q has to stay within tolerance
+replica_tolerance = None # Stop adding replicas once no averaged Q-value moves by this much over replica_window replicas
+replica_window = 5 # Number of replicas the average has to stay within replica_tolerance
+replica_batch = 10 # Replicas trained together between checks when replica_tolerance is set
+memory_batch = 100 # Most replicas trained and held in memory at once; lower it to bound memory on large topologies
+checkpoint = None # .npz file to save training progress to as it goes; rerunning with the same file resumes the run
+cache = None # Directory to keep trained q-tables in; rescoring the same topology and settings reads them back
+timings = None # Name of a .json file to record per-stage timings and counters in, None to skip
+profile = False # Also record a cProfile summary and peak memory in the timings file
+
+qcache = QCache(cache) if cache is not None else None
+
+if timings is not None:
+    instrument.start_recording(instrument.Recorder(profile, profile))
+
+#saves all q-tables of a given ending with a histogram of their greedy routes, and an excel spreadsheet if asked for
+def save_run(qtables, final_state):
+    """store a whole stack of tables at once
     """
-    workbook = xlsxwriter.Workbook(filename + final_state + '.xlsx')
-    worksheet = workbook.add_worksheet()
-
-    #write all paths taken into first worksheet
-    col = 0
-    for row, data in enumerate(paths_taken):
-        worksheet.write_row(row, col, data)
+    writer = StackWriter(filename + final_state, location_to_state, len(qtables))
+    writer.add_all(qtables)
+    return finish_run(writer, [greedy_successors(qtables)], final_state)
 
-    #write each q-table to another worksheet
-    for table, data in enumerate(qtables):
-        worksheet = workbook.add_worksheet()
-        for row, data2 in enumerate(qtables[table]):
-            worksheet.write_row(row, col, data2)
-
-    workbook.close()
+#close the stored stack of an ending, adding its route histogram, plus excel when enabled
+def finish_run(writer, successors, final_state):
+    """Each route row is [count, outcome, locations...], counting the replicas that take that route.
+    """
+    routes = route_histogram(np.concatenate(successors), location_to_state, 'Start', final_state)
+    qtables = writer.close(routes)
+    if excel:
+        export_excel(filename + final_state + '.xlsx', qtables, routes)
+    return qtables
+
+#write a batch of q-tables out and fold it into the ending's statistics, keeping only the greedy
+#successors of each table for the route histogram
+def collect(tables, writer, statistics, successors):
+    writer.add_all(tables)
+    statistics.add_all(tables)
+    successors.append(greedy_successors(tables))
     
-#Take set of q-tables and average them into one q-table
-def qaverage(table_set):
-    num = 0
-    output_table = table_set[0].copy()
-    for i in range(len(table_set[0][0])):
-        for j in range(len(table_set[0])):
-            for k in range(len(table_set)):
-                num += table_set[k][j][i]
-            output_table[j][i] = num / len(table_set)
-            num = 0
-            
-    return output_table
-
 #Handle all q-learning for a given topology
 def qmaster(final_state):
-    #array to store the final optimal path of each 1000 iterations
-    paths_taken = []
-    #array to store the final Q-Table of each 1000 iterations
-    qtables = []
-    for i in range(100):
-      qagent = QAgent(alpha, gamma, location_to_state, rewards,  state_to_location, np.array(np.zeros([21,21])))
-      paths_taken.append(qagent.training('Start', final_state, 1000))
-      qtables.append(qagent.Q)
-
-    #output the current run to an excel file
-    to_excel(paths_taken, qtables, final_state)
-    averaged_tables.append(qaverage(qtables))
+    #tables go to disk a batch at a time, so only one batch is ever held in memory
+    writer = StackWriter(filename + final_state, location_to_state, 100)
+    statistics = RunningTable(replica_tolerance)
+    successors = []
+    key = None
+    if qcache is not None:
+      key = cache_key(rewards, location_to_state[final_state], alpha=alpha, gamma=gamma, solver=solver, batched=batched,
+                      iterations=1000, replicas=100, tolerance=tolerance, window=window, replica_tolerance=replica_tolerance,
+                      replica_window=replica_window, replica_batch=replica_batch, seed=seed)
+      cached = qcache.get(key)
+    if key is not None and cached is not None:
+      collect(cached[0], writer, statistics, successors)
+    elif solver == "exact":
+      collect(exact_qtable(rewards, location_to_state[final_state], gamma)[np.newaxis], writer, statistics, successors)
+    elif batched:
+      #train in batches when checking the average between them or bounding memory; the shared random
+      #stream keeps the tables the same as training all replicas together
+      batch = min(memory_batch, 100 if replica_tolerance is None else replica_batch)
+      iterations_used = []
+      for first in range(0, 100, batch):
+        qagent = BatchQAgent(alpha, gamma, location_to_state, rewards, state_to_location, min(batch, 100 - first))
+        #with a tolerance every replica draws from its own generator, so a stopped replica stops drawing too
+        random_state = np.random
+        if tolerance is not None:
+          random_state = [replica_seed(seed, final_states.index(final_state), r) for r in range(first, first + qagent.replicas)]
+        qagent.training('Start', final_state, 1000, random_state, routes=False, tolerance=tolerance, window=window)
+        iterations_used += list(qagent.iterations_used)
+        collect(qagent.Q, writer, statistics, successors)
+        if statistics.converged(replica_window):
+          break
+      report(final_state, iterations_used)
+    else:
+      iterations_used = []
+      for i in range(100):
+        qagent = QAgent(alpha, gamma, location_to_state, rewards,  state_to_location, np.array(np.zeros([21,21])))
+        qagent.training('Start', final_state, 1000, tolerance, window)
+        iterations_used.append(qagent.iterations_used)
+        collect(qagent.Q[np.newaxis], writer, statistics, successors)
+        if statistics.converged(replica_window):
+          break
+      report(final_state, iterations_used)
+
+    #output the current run, read back from disk for the cache
+    with instrument.stage("save"):
+        qtables = finish_run(writer, successors, final_state)
+    if key is not None and cached is None:
+      qcache.put(key, qtables)
+    with instrument.stage("average"):
+        summarize(statistics)
+
+#Print how much training an ending actually needed when stopping early
+def report(final_state, iterations_used):
+    if tolerance is not None or replica_tolerance is not None:
+        print(final_state + ":", len(iterations_used), "replicas,", np.mean(iterations_used), "iterations on average")
+
+#Keep the averaged table and spread of an ending's statistics
+def summarize(statistics):
+    averaged_tables.append(statistics.mean)
+    averaged_spread.append(statistics.std)
+
+#Handle q-learning for all endings at once, spread over worker processes
+def pqmaster(final_states):
+    with instrument.stage("parallel"):
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = scoring.train_endings(rewards, location_to_state, final_states, 100, 1000, alpha, gamma, seed,
+                                            executor=executor, cache=qcache)
+    for final_state, qtables in zip(final_states, results):
+        save_run(qtables, final_state)
+        summarize(RunningTable().add_all(qtables))
+
+#Handle q-learning for all endings at once, checkpointing every (ending, replica) unit. The tables
+#equal those of pqmaster, so they share its cache entries; every ending trains unless all are cached
+def cqmaster(final_states):
+    results = [None] * len(final_states)
+    if qcache is not None:
+        keys = scoring.cache_keys(rewards, location_to_state, final_states, 100, 1000, alpha, gamma, seed)
+        results = [qcache.get(key) for key in keys]
+        results = [None if cached is None else cached[0] for cached in results]
+    if any(qtables is None for qtables in results):
+        trained = train_checkpointed(checkpoint, rewards, location_to_state, final_states, 100, 1000, alpha, gamma, seed)
+        for ending, qtables in enumerate(trained):
+            if qcache is not None and results[ending] is None:
+                qcache.put(keys[ending], qtables)
+        results = trained
+    for final_state, qtables in zip(final_states, results):
+        save_run(qtables, final_state)
+        summarize(RunningTable().add_all(qtables))
 
 #run qmaster for each file name input
-for i in range(4):
-    qmaster('E' + str(i + 1))
+final_states = ['E' + str(i + 1) for i in range(4)]
+#the parallel and checkpointed paths always train every replica for every iteration
+if (checkpoint is not None or workers > 1) and solver != "exact" and (tolerance is not None or replica_tolerance is not None):
+    raise ValueError("tolerance and replica_tolerance only work with workers = 1 and no checkpoint")
+if checkpoint is not None and solver != "exact":
+    cqmaster(final_states)
+elif workers > 1 and solver != "exact":
+    pqmaster(final_states)
+else:
+    for final_state in final_states:
+        with instrument.stage(final_state):
+            qmaster(final_state)
+    
+#store the averaged table of every ending together for the distance tools
+save_qtables(filename, averaged_tables, location_to_state, names=final_states)
+save_qtables(filename + 'Std', averaged_spread, location_to_state, names=final_states)
     
-print(averaged_tables[i])
+print(averaged_tables[-1])
 
 
 # ### Pairwise Minkowski Difference
@@ -200,76 +320,28 @@ print(averaged_tables[i])
 #altered from
 #https://www.geeksforgeeks.org/minkowski-distance-python/
 
-#convert array into 1D vector for ease of manipulation
-def vectorize(input_array):
-    output_array = []
-    for i in range(21):
-        for j in range(21):
-            output_array.append(input_array[i][j])
-            
-    return output_array
-
-#Apply weighting function to give high score to early states
-def apply_weights(array):
-    #These values can be adjusted to change weights
-    #----------------------------------------------
-    level_one = 0.3
-    level_two = 0.25
-    level_three = 0.2
-    level_four = 0.15
-    level_five = 0.1
-    #----------------------------------------------
-    
-    for i in range(441):
-        #check what the i index would be in a 21x21 2D array
-        index = i // 21
-
-        if index == 0:
-            array[i] = array[i] * level_one
-        elif index in range(1, 5):
-            array[i] = array[i] * level_two
-        elif index in range(5, 9):
-            array[i] = array[i] * level_three
-        elif index in range(9, 13):
-            array[i] = array[i] * level_four
-        elif index in range(13, 17):
-            array[i] = array[i] * level_five
-        elif index in range(17, 21):
-            array[i] = 0
-            
-#Calculate Minkowski distance between arrays
-  
-# Function distance between two points  
-# and calculate distance value to given 
-# root value(p is root value) 
-def p_root(value, root): 
-      
-    root_value = 1 / float(root) 
-    return round (Decimal(value) **
-             Decimal(root_value), 3) 
-  
-def minkowski_distance(x, y, p_value): 
-    # pass the p_root function to calculate 
-    # all the values of vector in parallel 
-    return (p_root(sum(pow(abs(a-b), p_value) 
-            for a, b in zip(x, y)), p_value))
+#Apply weighting function to give high score to early states: every row is scaled by the weight of
+#its layer (its breadth-first depth from Start). A list gives the weight of each layer from Start on,
+#a function gets the number of layers and returns that list; None leaves the tables unweighted.
+layer_weights = None # e.g. lambda layers: weight_calculator(layers)[::-1], importing weight_calculator from mplay.weights
 
 #vectorize averaged tables and apply weights
+if layer_weights is not None:
+    with instrument.stage("weighting"):
+        averaged_tables = list(weight_layers(averaged_tables, rewards, location_to_state['Start'], layer_weights))
 vectors = []
 for i in range(len(averaged_tables)):
     vectors.append(vectorize(averaged_tables[i]))
     vectorize(averaged_tables[i])
     
 #calculate minkowski distances in a pairwise fashion
-distances = []
-acc = 0
-for i in range(len(averaged_tables) - 1):
-    for j in range(i + 1, len(vectors)):
-        distance = minkowski_distance(vectors[i], vectors[j], 1)
-        distances.append(distance)
-        acc += distance
+with instrument.stage("minkowski"):
+    distances = pair_values(pairwise_distances(vectors, 1, 3))
         
-print(acc / len(distances))
+print(distances.mean())
+
+if timings is not None:
+    instrument.stop_recording().save(timings)
 
 
 # In[ ]:
@@ -1,20 +1,24 @@
 #altered from
 #https://www.geeksforgeeks.org/reading-excel-file-using-python/
 #https://www.geeksforgeeks.org/minkowski-distance-python/
-import xlrd
 from math import *
-from decimal import Decimal
+import numpy as np
+from mplay.distance import minkowski_distance
+from mplay.store import find_table
 
-#Set up arrays of average q-values
-first_average = []
-second_average = []
-    
-#Prompt user for input of file names
+#Prompt user for input of file names; a stored stack of several tables needs the one to use in
+#brackets, e.g. NoIntegrated.txt[E2] or NoIntegrated.txtE1[mean]
 file_name_one = input("Please input name of first averaged q-table: ")
 file_name_two = input("Please input name of second averaged q-table: ")
 
-#Read files into arrays
-def read_from_excel(file_name, array):
+#Read files into arrays, preferring a stored .npy/.npz stack over a workbook
+def read_from_excel(file_name):
+    stored = find_table(file_name)
+    if stored is not None:
+        return np.ravel(stored)
+    
+    array = []
+    import xlrd
     loc = (file_name + ".xlsx") 
       
     wb = xlrd.open_workbook(loc) 
@@ -26,55 +30,20 @@ def read_from_excel(file_name, array):
     for i in range(21):
         for j in range(21):
             array.append(sheet.cell_value(i, j)) 
+    return array
             
-read_from_excel(file_name_one, first_average)
-read_from_excel(file_name_two, second_average)
+first_average = read_from_excel(file_name_one)
+second_average = read_from_excel(file_name_two)
+
+#weight of each row of a 21x21 table: Start, then four layers of four states, then the endings
+row_weights = np.repeat([0.3, 0.25, 0.2, 0.15, 0.1, 0.05], [1, 4, 4, 4, 4, 4])
 
 #Apply weighting function to give high score to early states
 def apply_weights(array):
-    level_one = 0
-    level_two = 0
-    level_three = 0
-    level_four = 0
-    level_five = 0
-    
-    for i in range(441):
-        #check what the i index would be in a 21x21 2D array
-        index = i // 21
+    return np.asarray(array, dtype=float) * np.repeat(row_weights, 21)
 
-        if index == 0:
-            array[i] = array[i] * 0.3
-        elif index in range(1, 5):
-            array[i] = array[i] * 0.25
-        elif index in range(5, 9):
-            array[i] = array[i] * 0.2
-        elif index in range(9, 13):
-            array[i] = array[i] * 0.15
-        elif index in range(13, 17):
-            array[i] = array[i] * 0.1
-        elif index in range(17, 21):
-            array[i] = array[i] * 0.05
-
-apply_weights(first_average)
-apply_weights(second_average)
-
-#Calculate Minkowski distance between arrays
-  
-# Function distance between two points  
-# and calculate distance value to given 
-# root value(p is root value) 
-def p_root(value, root): 
-      
-    root_value = 1 / float(root) 
-    return round (Decimal(value) **
-             Decimal(root_value), 3) 
-  
-def minkowski_distance(x, y, p_value): 
-      
-    # pass the p_root function to calculate 
-    # all the value of vector parallely  
-    return (p_root(sum(pow(abs(a-b), p_value) 
-            for a, b in zip(x, y)), p_value))
+first_average = apply_weights(first_average)
+second_average = apply_weights(second_average)
 
 #Output distances with p-values 1 and 2
 print("Minkowski distance with p-value 1 (Manhattan Distance): " + str(minkowski_distance(first_average, second_average, 1)))
@@ -1,5 +1,6 @@
 import numpy as np
 import xlsxwriter
+from mplay.topology import TopologyIndex
 
 # Define the states
 location_to_state = {
@@ -62,20 +63,17 @@ class QAgent():
         ending_state = self.location_to_state[end_location]
         rewards_new[ending_state, ending_state] = 999
 
+        #index the possible actions of every state once
+        playable = TopologyIndex(rewards_new)
+
         #Loop for iterations
         for i in range(iterations):
             #Randomly pick a state to observe
             current_state = np.random.randint(0,len(self.rewards)) 
-            playable_actions = []
-
-            #Construct list of possible actions
-            for j in range(len(self.rewards)):
-                if rewards_new[current_state,j] > 0:
-                    playable_actions.append(j)
 
             #Only run updates if observed state has performable actions
-            if len(playable_actions) > 0:
-                next_state = np.random.choice(playable_actions)
+            if playable.degrees[current_state] > 0:
+                next_state = playable.sample_action(current_state)
 
                 #Calculate temporal difference
                 TD = rewards_new[current_state,next_state] + \
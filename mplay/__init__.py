@@ -0,0 +1,14 @@
+"""Meaningful Play scoring tools
+
+Reusable pieces of the q-learning pipeline used by MPD_V1.py and the Mplay notebooks. The package
+itself imports nothing heavy: load_topology, train and score load numpy and the pipeline the first
+time one of them is used.
+"""
+
+__all__ = ['load_topology', 'train', 'score']
+
+def __getattr__(name):
+    if name in __all__:
+        from mplay import api
+        return getattr(api, name)
+    raise AttributeError("module 'mplay' has no attribute " + repr(name))
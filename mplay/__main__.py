@@ -0,0 +1,43 @@
+import importlib
+import sys
+
+
+# ### Command Line
+# 
+# One entry point for the package's tools. Each command is the main() of its module, imported only
+# when that command runs.
+# 
+#     python -m mplay score "variants/*.xml" --workers 8
+#     python -m mplay rescore Diagram.xml --solver exact
+
+COMMANDS = {
+    'score': ('mplay.batchscore', "score topology files and write a summary table"),
+    'rescore': ('mplay.incremental', "rescore an edited topology from its last snapshot"),
+    'train': ('mplay.checkpoint', "train every ending with resumable checkpoints"),
+    'fused': ('mplay.fused', "score a topology forward and with its edges reversed in one pass"),
+    'sweep': ('mplay.sweep', "score topologies over grids of training settings"),
+    'similar': ('mplay.similarity', "index averaged tables and find the nearest stored ones"),
+    'server': ('mplay.server', "serve scoring over local HTTP, or ask a running server for a score"),
+    'loadtest': ('mplay.loadtest', "measure the throughput and latency of a scoring server"),
+    'benchmark': ('mplay.benchmark', "time every scoring stage"),
+    'excel': ('mplay.store', "write stored q-table stacks to .xlsx workbooks"),
+}
+
+def usage():
+    """Help text listing the commands
+    """
+    lines = ["usage: python -m mplay <command> [arguments]", "", "commands:"]
+    lines += ["  %-10s %s" % (command, description) for command, (module, description) in COMMANDS.items()]
+    return "\n".join(lines)
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in COMMANDS:
+        print(usage(), file=sys.stderr)
+        return 0 if argv and argv[0] in ("-h", "--help") else 2
+    
+    module = importlib.import_module(COMMANDS[argv[0]][0])
+    return module.main(argv[1:])
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,106 @@
+import numpy as np
+
+
+# ### Aggregation
+# 
+# Averages q-tables as they come in instead of after collecting all of them. RunningTable keeps the
+# running sum (so its mean matches qaverage exactly) and Welford's sum of squared deviations, which
+# gives the spread of every cell and how many replicas it would take to pin the mean down.
+
+class RunningTable():
+    
+    def __init__(self, tolerance=None):
+        """ Start with no tables
+
+        With a tolerance, steady counts the latest tables in a row that moved no cell of the mean by
+        tolerance or more.
+        """
+        self.count = 0
+        self.total = None
+        self.m2 = None
+        self._mean = None
+        
+        self.tolerance = tolerance
+        self.change = None
+        self.steady = 0
+    
+    def add(self, table):
+        """Fold one table into the running statistics and return how far it moved the mean
+        """
+        table = np.asarray(table, dtype=float)
+        if self.count == 0:
+            self.total = np.zeros_like(table)
+            self.m2 = np.zeros_like(table)
+            self._mean = np.zeros_like(table)
+        
+        self.count += 1
+        self.total += table
+        delta = table - self._mean
+        self._mean += delta / self.count
+        self.m2 += delta * (table - self._mean)
+        
+        self.change = float(np.max(np.abs(delta), initial=0)) / self.count
+        if self.tolerance is not None and self.count > 1 and self.change < self.tolerance:
+            self.steady += 1
+        else:
+            self.steady = 0
+        return self.change
+    
+    def add_all(self, tables):
+        """Fold a stack or any iterable of tables in, one at a time
+        """
+        for table in tables:
+            self.add(table)
+        return self
+    
+    def converged(self, window):
+        """Whether the last window tables all left the mean where it was, within tolerance
+        """
+        return self.tolerance is not None and self.steady >= window
+    
+    @property
+    def mean(self):
+        """Average table, identical to qaverage over the same tables
+        """
+        return self.total / self.count
+    
+    @property
+    def variance(self):
+        """Sample variance of every cell, 0 until there are two tables
+        """
+        if self.count < 2:
+            return np.zeros_like(self.total)
+        return self.m2 / (self.count - 1)
+    
+    @property
+    def std(self):
+        """Sample standard deviation of every cell
+        """
+        return np.sqrt(self.variance)
+    
+    @property
+    def standard_error(self):
+        """Standard error of the mean of every cell
+        """
+        return self.std / np.sqrt(max(self.count, 1))
+    
+    def confidence_bounds(self, z=1.96):
+        """Lower and upper confidence bounds on the mean of every cell (95% by default)
+        """
+        margin = z * self.standard_error
+        return self.mean - margin, self.mean + margin
+    
+    def replicas_needed(self, tolerance, z=1.96):
+        """Fewest replicas that would bring every cell's confidence margin within tolerance
+        """
+        if self.count < 2:
+            return None
+        return int(np.ceil(np.max((z * self.std / tolerance) ** 2, initial=1)))
+
+#Take set of q-tables and average them into one q-table
+def qaverage(table_set):
+    return RunningTable().add_all(table_set).mean
+
+#convert array into 1D vector for ease of manipulation
+def vectorize(input_array):
+    return np.ravel(input_array)
@@ -0,0 +1,53 @@
+import os
+
+from mplay import loaders, scoring
+from mplay.sparse import EdgeTopology, load_edge_topology, train_endings as train_edge_endings
+
+
+# ### Library API
+# 
+# Scoring without the scripts: nothing here prompts, prints or writes files, so a long-lived process
+# can import it once and score any number of topologies. A topology is a file name, a
+# (rewards, location_to_state) pair or an EdgeTopology.
+# 
+#     import mplay
+#     mplay.score("NoIntegrated.txt", replicas=100, iterations=1000)
+
+def load_topology(filename, sparse=False):
+    """Read a .txt matrix or draw.io .xml file into (rewards, location_to_state)
+
+    sparse returns an EdgeTopology instead, which never builds an N x N matrix for diagrams.
+    """
+    if sparse:
+        return load_edge_topology(os.fspath(filename))
+    return loaders.load_topology(os.fspath(filename))
+
+def _resolve(topology, final_states):
+    """Load file names and fill in the endings of a topology when none are given
+    """
+    if isinstance(topology, (str, os.PathLike)):
+        topology = load_topology(topology)
+    if final_states is None:
+        final_states = topology.goals if isinstance(topology, EdgeTopology) else loaders.ending_names(topology[1])
+    return topology, list(final_states)
+
+def train(topology, final_states=None, **training):
+    """Trained tables of every ending: a (replicas, N, N) stack each, or (replicas, edges) for an EdgeTopology
+
+    training takes the settings of scoring.train_endings: replicas, iterations, alpha, gamma, seed,
+    solver, executor and cache.
+    """
+    topology, final_states = _resolve(topology, final_states)
+    if isinstance(topology, EdgeTopology):
+        return train_edge_endings(topology, final_states, **training)
+    rewards, location_to_state = topology
+    return scoring.train_endings(rewards, location_to_state, final_states, **training)
+
+def score(topology, final_states=None, p_value=1, **training):
+    """Meaningfulness score of a topology: the mean Minkowski distance between its averaged tables
+    """
+    topology, final_states = _resolve(topology, final_states)
+    if isinstance(topology, EdgeTopology):
+        return scoring.score_edge_topology(topology, final_states, p_value, **training)[0]
+    rewards, location_to_state = topology
+    return scoring.score_topology(rewards, location_to_state, final_states, p_value, **training)[0]
@@ -0,0 +1,123 @@
+import argparse
+import csv
+import glob
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from mplay import instrument
+from mplay.cache import QCache
+from mplay.loaders import ending_names, load_topology
+from mplay.scoring import score_edge_topology, score_topology
+from mplay.sparse import load_edge_topology
+
+
+# ### Batch Scoring
+# 
+# Scores a whole list of topology files without prompting and writes one summary table.
+# 
+#     python -m mplay.batchscore "variants/*.xml" NoIntegrated.txt --manifest nightly.txt --workers 32
+# 
+# --instrument timings.json records wall and cpu time, peak memory and counters per file and stage.
+# Stages that run on worker processes are timed as a whole from the parent.
+
+#columns of the summary table. max_stderr is the largest standard error of any averaged cell
+FIELDS = ['file', 'states', 'endings', 'score', 'max_stderr', 'seconds', 'error']
+
+def topology_files(patterns, manifest=None):
+    """Expand glob patterns and the lines of a manifest file into a list of paths, dropping repeats
+    """
+    if manifest is not None:
+        with open(manifest) as manifestFile:
+            patterns = list(patterns) + [line.strip() for line in manifestFile if line.strip() and not line.startswith("#")]
+    
+    files = []
+    for pattern in patterns:
+        for filename in sorted(glob.glob(pattern)) or [pattern]:
+            if filename not in files:
+                files.append(filename)
+    return files
+
+def score_files(files, executor=None, p_value=1, sparse=False, **training):
+    """Yield one summary row per topology file, recording the error instead of stopping on a bad file
+
+    sparse keeps Q-values on edges only, for graphs too large for N x N tables.
+    """
+    for filename in files:
+        started = time.time()
+        row = dict((field, '') for field in FIELDS)
+        row['file'] = filename
+        try:
+            with instrument.stage(filename):
+                row.update(score_file(filename, executor, p_value, sparse, **training))
+        except Exception as error:
+            row['error'] = repr(error)
+        row['seconds'] = round(time.time() - started, 3)
+        yield row
+
+def score_file(filename, executor=None, p_value=1, sparse=False, **training):
+    """Summary fields of one topology file
+    """
+    if sparse:
+        topology = load_edge_topology(filename)
+        final_states = topology.goals
+        score, statistics = score_edge_topology(topology, final_states, p_value, executor=executor, **training)
+        states = topology.size
+    else:
+        rewards, location_to_state = load_topology(filename)
+        final_states = ending_names(location_to_state)
+        score, statistics = score_topology(rewards, location_to_state, final_states, p_value,
+                                                executor=executor, **training)
+        states = len(rewards)
+    return dict(states=states, endings=len(final_states), score=round(score, 3),
+                max_stderr=round(max(float(np.max(ending.standard_error, initial=0)) for ending in statistics), 3))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score many topology files (.txt matrices or draw.io .xml) in one run.")
+    parser.add_argument("patterns", nargs="*", help="topology files or glob patterns")
+    parser.add_argument("--manifest", help="file listing one topology path or glob per line")
+    parser.add_argument("--output", default="-", help="summary csv to write, - for stdout")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes shared by every file")
+    parser.add_argument("--replicas", type=int, default=100)
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--alpha", type=float, default=0.9)
+    parser.add_argument("--gamma", type=float, default=0.75)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--solver", choices=["sampled", "exact"], default="sampled")
+    parser.add_argument("--p", type=float, default=1, dest="p_value", help="Minkowski p of the score")
+    parser.add_argument("--sparse", action="store_true", help="keep q-values on edges only, for large graphs")
+    parser.add_argument("--cache", help="directory to keep trained q-tables in, so rescoring with other p reuses them")
+    parser.add_argument("--cache-size", type=float, default=1024, help="megabytes the --cache directory may hold")
+    parser.add_argument("--instrument", help="json file to write per-stage timings and counters to")
+    parser.add_argument("--profile", action="store_true", help="also record a cProfile summary in the --instrument file")
+    parser.add_argument("--trace-memory", action="store_true", help="also record tracemalloc peaks per stage")
+    args = parser.parse_args(argv)
+    
+    files = topology_files(args.patterns, args.manifest)
+    if not files:
+        parser.error("no topology files given")
+    
+    cache = QCache(args.cache, int(args.cache_size * (1 << 20))) if args.cache is not None else None
+    executor = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+    output = sys.stdout if args.output == "-" else open(args.output, "w", newline="")
+    recorder = None
+    if args.instrument is not None:
+        recorder = instrument.start_recording(instrument.Recorder(args.profile, args.trace_memory))
+    try:
+        writer = csv.DictWriter(output, fieldnames=FIELDS)
+        writer.writeheader()
+        for row in score_files(files, executor, args.p_value, args.sparse, replicas=args.replicas, iterations=args.iterations,
+                               alpha=args.alpha, gamma=args.gamma, seed=args.seed, solver=args.solver, cache=cache):
+            writer.writerow(row)
+            output.flush()
+    finally:
+        if recorder is not None:
+            instrument.stop_recording().save(args.instrument)
+        if executor is not None:
+            executor.shutdown()
+        if output is not sys.stdout:
+            output.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+from mplay import loaders
+from mplay.aggregate import RunningTable
+from mplay.distance import pairwise_distances
+from mplay.parallel import replica_seed
+from mplay.qbatch import BatchQAgent
+from mplay.rollout import RolloutQAgent
+from mplay.solver import exact_qtable
+from mplay.sparse import EdgeTopology, SparseQAgent, exact_edge_table, softmax_positive, softmax_segments, weight_states
+from mplay.store import export_excel
+from mplay.topology import TopologyIndex
+from mplay.weights import layer_depths, state_weights, weight_calculator, weight_tables
+
+
+# ### Benchmarks
+# 
+# Times each stage of scoring on the bundled topologies and on synthetic layered graphs, and writes
+# the results to a JSON file that can be compared against the run of another commit.
+# 
+#     python -m mplay.benchmark --output bench.json
+#     python -m mplay.benchmark --synthetic 1000 10000 50000 --compare bench.json
+
+BUNDLED = ['NoIntegrated.txt', 'OnlyIntegrated.txt', 'TopNonIntegrated.txt', 'split.txt', 'ShadowTopology1.txt',
+           'SteinsGateMatrix.txt', 'NoIntegrated.xml', 'OnlyIntegrated.xml', 'SteinsGateChoicesAdjusted.xml',
+           'SteinsGateChoicesSimplified.xml', 'SteinsGateChoicesSimplified2.xml']
+
+#largest state count that still runs the dense N x N stages, and the workbook export
+DENSE_LIMIT = 2000
+EXCEL_LIMIT = 500
+
+def layered_topology(states, width=20, branching=3, endings=4, seed=0):
+    """Synthetic story graph: a start state, layers of width states, and the endings as the last layer
+
+    Every state connects to branching random states of the next layer.
+    """
+    rng = np.random.default_rng(seed)
+    layers = [np.array([0])]
+    first = 1
+    while first < states - endings:
+        layers.append(np.arange(first, min(first + width, states - endings)))
+        first += width
+    layers.append(np.arange(states - endings, states))
+    
+    sources = []
+    targets = []
+    for layer, following in zip(layers, layers[1:]):
+        picks = rng.integers(0, len(following), size=(len(layer), branching))
+        sources.append(np.repeat(layer, branching))
+        targets.append(following[picks.ravel()])
+    
+    location_to_state = {'Start': 0}
+    location_to_state.update((str(state), state) for state in range(1, states - endings))
+    location_to_state.update(('E' + str(i + 1), state) for i, state in enumerate(layers[-1]))
+    return TopologyIndex.from_edges(states, np.concatenate(sources), np.concatenate(targets)), location_to_state
+
+def measure(stage, work, items=None, memory=True):
+    """Run work once for its time and, when memory is set, once more under tracemalloc for its peak
+    """
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    result = work()
+    seconds = time.perf_counter() - started
+    record = {'stage': stage, 'seconds': seconds, 'cpu_seconds': time.process_time() - cpu_started,
+              'items': items, 'items_per_second': items / seconds if items and seconds > 0 else None,
+              'peak_bytes': None}
+    
+    if memory:
+        tracemalloc.start()
+        work()
+        record['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, record
+
+def benchmark_topology(name, index, location_to_state, parse=None, replicas=10, iterations=1000, memory=True,
+                       excel=True):
+    """Time every stage of scoring one topology and return one record per stage
+    """
+    records = []
+    if parse is not None:
+        records.append(measure('parse', parse, memory=memory)[1])
+    
+    final_states = loaders.ending_names(location_to_state)
+    topology = EdgeTopology(index, location_to_state)
+    dense = index.size <= DENSE_LIMIT
+    rewards = index.to_dense() if dense else None
+    updates = replicas * iterations * len(final_states)
+    
+    def train_dense():
+        tables = []
+        for ending, final_state in enumerate(final_states):
+            qagent = BatchQAgent(0.9, 0.75, location_to_state, rewards, {}, replicas)
+            qagent.training('Start', final_state, iterations, [replica_seed(0, ending, r) for r in range(replicas)], routes=False)
+            tables.append(qagent.Q)
+        return tables
+    
+    def train_sparse():
+        tables = []
+        for ending, final_state in enumerate(final_states):
+            qagent = SparseQAgent(0.9, 0.75, topology, replicas)
+            qagent.training(final_state, iterations, [replica_seed(0, ending, r) for r in range(replicas)])
+            tables.append(qagent.Q)
+        return tables
+    
+    if dense:
+        dense_tables, record = measure('training', train_dense, updates, memory)
+        records.append(record)
+        records.append(measure('exact', lambda: [exact_qtable(rewards, location_to_state[final_state], 0.75)
+                                                  for final_state in final_states], len(final_states), memory)[1])
+        
+        #the epsilon-greedy walk trainer, on the first ending only since its episodes are long
+        def rollout():
+            qagent = RolloutQAgent(0.9, 0.75, 0.2, location_to_state, rewards, {}, replicas)
+            qagent.training('Start', final_states[0], iterations, np.random.RandomState(0), routes=False)
+            return qagent.steps.sum()
+        steps, record = measure('rollout', rollout, None, memory)
+        record.update(items=int(steps), items_per_second=steps / record['seconds'] if record['seconds'] > 0 else None)
+        records.append(record)
+    sparse_tables, record = measure('training_sparse', train_sparse, updates, memory)
+    records.append(record)
+    records.append(measure('exact_sparse', lambda: [exact_edge_table(topology, final_state, 0.75)
+                                                    for final_state in final_states], len(final_states), memory)[1])
+    
+    tables = dense_tables if dense else sparse_tables
+    averaged, record = measure('qaverage', lambda: np.array([RunningTable().add_all(stack).mean for stack in tables]),
+                               replicas * len(final_states), memory)
+    records.append(record)
+    
+    def layer_weights():
+        return state_weights(layer_depths(index, location_to_state['Start']), lambda layers: weight_calculator(layers)[::-1])
+    if dense:
+        weighted, record = measure('weighting', lambda: weight_tables(averaged, layer_weights()), len(final_states), memory)
+    else:
+        weighted, record = measure('weighting', lambda: weight_states(averaged, topology, layer_weights()), len(final_states), memory)
+    records.append(record)
+    
+    normalized, record = measure('normalize', lambda: softmax_positive(weighted.reshape(len(weighted), -1)), len(final_states), memory)
+    records.append(record)
+    edge_weighted = topology.edge_values(weighted) if dense else weighted
+    records.append(measure('normalize_state', lambda: softmax_segments(edge_weighted, topology.index), len(final_states), memory)[1])
+    records.append(measure('minkowski', lambda: pairwise_distances(normalized, 1), len(final_states) ** 2, memory)[1])
+    
+    if excel and index.size <= EXCEL_LIMIT:
+        with tempfile.TemporaryDirectory() as directory:
+            records.append(measure('to_excel', lambda: export_excel(os.path.join(directory, 'bench.xlsx'), tables[0]),
+                                   replicas, memory)[1])
+    
+    for record in records:
+        record.update(input=name, states=index.size, edges=len(index.targets), endings=len(final_states))
+    return records
+
+def current_commit():
+    """Hash of the checked out commit, or None outside a git work tree
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def bundled_inputs(directory):
+    """(name, index, location_to_state, parse) for every bundled topology found in directory
+    """
+    for filename in BUNDLED:
+        path = os.path.join(directory, filename)
+        if not os.path.exists(path):
+            continue
+        
+        def parse(path=path):
+            loaders._parsed.clear()
+            return loaders.load_topology(path)
+        rewards, location_to_state = parse()
+        yield filename, TopologyIndex(rewards), location_to_state, parse
+
+def compare(results, baseline):
+    """Print how much faster each (input, stage) got relative to a baseline results file
+    """
+    before = dict(((record['input'], record['stage']), record['seconds']) for record in baseline['results'])
+    print("%-36s %-16s %10s %10s %8s" % ("input", "stage", "before", "after", "speedup"))
+    for record in results['results']:
+        key = (record['input'], record['stage'])
+        if key in before:
+            print("%-36s %-16s %10.4f %10.4f %7.2fx" % (key[0], key[1], before[key], record['seconds'],
+                                                     before[key] / max(record['seconds'], 1e-12)))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time every scoring stage on the bundled and synthetic topologies.")
+    parser.add_argument("--directory", default=".", help="where the bundled topologies are")
+    parser.add_argument("--synthetic", type=int, nargs="*", default=[1000, 10000, 50000], help="state counts of synthetic graphs")
+    parser.add_argument("--no-bundled", action="store_true", help="skip the bundled topologies")
+    parser.add_argument("--replicas", type=int, default=10)
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc pass of each stage")
+    parser.add_argument("--no-excel", action="store_true", help="skip the to_excel stage")
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    args = parser.parse_args(argv)
+    
+    inputs = [] if args.no_bundled else list(bundled_inputs(args.directory))
+    for states in args.synthetic:
+        index, location_to_state = layered_topology(states)
+        inputs.append(('layered-' + str(states), index, location_to_state, None))
+    
+    results = {'commit': current_commit(), 'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'python': platform.python_version(), 'numpy': np.__version__,
+               'settings': {'replicas': args.replicas, 'iterations': args.iterations}, 'results': []}
+    for name, index, location_to_state, parse in inputs:
+        for record in benchmark_topology(name, index, location_to_state, parse, args.replicas, args.iterations,
+                                         not args.no_memory, not args.no_excel):
+            results['results'].append(record)
+            print("%-36s %-16s %10.4f s" % (name, record['stage'], record['seconds']), flush=True)
+    
+    with open(args.output, 'w') as outputFile:
+        json.dump(results, outputFile, indent=1)
+    if args.compare:
+        with open(args.compare) as baselineFile:
+            compare(results, json.load(baselineFile))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import hashlib
+import io
+import json
+import os
+import zipfile
+import numpy as np
+
+from mplay import instrument
+from mplay.aggregate import RunningTable
+
+
+# ### Q-Table Cache
+# 
+# Trained q-tables on disk, addressed by what they were trained from: the rewards of the topology,
+# the ending and the training settings. Rescoring a topology with different weights, normalization
+# or Minkowski p then reuses the tables instead of training every replica again. The cache keeps its
+# total size under a limit by dropping the entries that were used least recently.
+# 
+#     cache = QCache(".qcache")
+#     score_topology(rewards, location_to_state, final_states, cache=cache)
+
+#bump when the stored layout or the training code changes in a way that alters the tables
+FORMAT_VERSION = 1
+
+DEFAULT_DIRECTORY = ".qcache"
+DEFAULT_MAX_BYTES = 1 << 30
+
+def topology_digest(topology):
+    """sha256 of a dense reward matrix or of the edges and rewards of an EdgeTopology
+    
+    Dense and edge layouts hash differently, since their tables are laid out differently.
+    """
+    digest = hashlib.sha256()
+    if hasattr(topology, 'index'):
+        index = topology.index
+        digest.update(b"edges %d " % index.size)
+        for values in (index.sources, index.targets, topology.rewards):
+            digest.update(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+    else:
+        rewards = np.ascontiguousarray(topology, dtype=np.float64)
+        digest.update(b"dense %r " % (rewards.shape,))
+        digest.update(rewards.tobytes())
+    return digest.hexdigest()
+
+def cache_key(topology, ending, **settings):
+    """Key of the tables trained for one ending of topology with the given settings
+    
+    topology may be a digest from topology_digest, to hash a large matrix once for many endings.
+    ending is the state number of the ending, settings are alpha, gamma, iterations, replicas, seed
+    and whatever else changes the tables.
+    """
+    if not isinstance(topology, str):
+        topology = topology_digest(topology)
+    settings = dict(settings, ending=int(ending), version=FORMAT_VERSION)
+    text = json.dumps(settings, sort_keys=True, default=str)
+    return hashlib.sha256((topology + text).encode()).hexdigest()
+
+class QCache():
+
+    def __init__(self, directory=DEFAULT_DIRECTORY, max_bytes=DEFAULT_MAX_BYTES):
+        """ Open (and create if needed) a cache directory holding at most max_bytes of tables
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+    
+    def path(self, key):
+        """File of the entry for key
+        """
+        return os.path.join(self.directory, key + '.npz')
+    
+    def get(self, key):
+        """Return (qtables, mean, paths_taken) stored under key, or None on a miss
+        
+        A hit counts as a use for eviction.
+        """
+        path = self.path(key)
+        try:
+            with np.load(path) as stored:
+                entry = stored['qtables'], stored['mean'], json.loads(str(stored['paths_taken']))
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            #missing, or left half written or truncated by a process that died
+            if os.path.exists(path):
+                os.remove(path)
+            instrument.count("cache_misses")
+            return None
+        os.utime(path)
+        instrument.count("cache_hits")
+        return entry
+    
+    def put(self, key, qtables, paths_taken=None):
+        """Store a (replicas, ...) stack of tables, its average and the routes under key
+        
+        The average is folded like RunningTable, so it equals the one a fresh run would give.
+        """
+        qtables = np.asarray(qtables, dtype=np.float64)
+        mean = RunningTable().add_all(qtables).mean
+        buffer = io.BytesIO()
+        np.savez(buffer, qtables=qtables, mean=mean, paths_taken=np.array(json.dumps(paths_taken)))
+        
+        #write next to the entry and rename, so readers never see a partial file
+        temporary = self.path(key) + '.%d.tmp' % os.getpid()
+        with open(temporary, 'wb') as entryFile:
+            entryFile.write(buffer.getvalue())
+        os.replace(temporary, self.path(key))
+        self.evict(keep=key)
+    
+    def entries(self):
+        """(last used, bytes, path) of every entry, least recently used first
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                path = os.path.join(self.directory, name)
+                try:
+                    status = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((status.st_mtime, status.st_size, path))
+        return sorted(entries)
+    
+    def size(self):
+        """Total bytes held
+        """
+        return sum(size for used, size, path in self.entries())
+    
+    def evict(self, keep=None):
+        """Drop least recently used entries until the cache fits in max_bytes, never dropping keep
+        """
+        entries = self.entries()
+        total = sum(size for used, size, path in entries)
+        for used, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if keep is not None and path == self.path(keep):
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            instrument.count("cache_evictions")
+    
+    def clear(self):
+        """Drop every entry
+        """
+        for used, size, path in self.entries():
+            os.remove(path)
@@ -0,0 +1,194 @@
+import argparse
+import json
+import os
+import time
+import numpy as np
+
+from mplay import instrument
+from mplay.aggregate import RunningTable
+from mplay.cache import topology_digest
+from mplay.loaders import ending_names, load_topology
+from mplay.parallel import replica_seed
+from mplay.qbatch import BatchQAgent
+from mplay.sparse import EdgeTopology
+from mplay.store import save_qtables, state_names
+
+
+# ### Checkpoints
+# 
+# Long runs save their progress as they go, so a run that dies can pick up where it stopped. Training
+# advances every (ending, replica) unit a block of iterations at a time with the unit's own generator,
+# and a checkpoint holds how far each unit got, the state of its generator and its Q-values. Since a
+# replica draws the same numbers whether its iterations run in one call or many, a resumed run gives
+# the same tables as one that never stopped. Q-values live only on the edges of the topology (plus
+# the ending self loops), so a checkpoint stores those instead of whole N x N tables.
+# 
+#     python -m mplay.checkpoint SteinsGateMatrix.txt --checkpoint steins.ckpt.npz --output steins
+#     python -m mplay.checkpoint --resume steins.ckpt.npz --output steins
+
+class Checkpoint():
+
+    def __init__(self, rewards, location_to_state, final_states, replicas=100, iterations=1000, alpha=0.9,
+                 gamma=0.75, seed=0):
+        """ Start a run with no progress: every unit at iteration 0 with all Q-values at 0
+        """
+        self.rewards = np.asarray(rewards)
+        self.location_to_state = location_to_state
+        self.final_states = list(final_states)
+        self.settings = {'replicas': replicas, 'iterations': iterations, 'alpha': alpha, 'gamma': gamma, 'seed': seed}
+        self.layout = EdgeTopology.from_dense(self.rewards, location_to_state, self.final_states).index
+        
+        shape = (len(self.final_states), replicas)
+        self.progress = np.zeros(shape, dtype=np.int64)
+        self.values = np.zeros(shape + (len(self.layout.targets),))
+        #MT19937 state of the generator of every unit, valid where progress is above 0
+        self.keys = np.zeros(shape + (624,), dtype=np.uint32)
+        self.positions = np.zeros(shape, dtype=np.int64)
+        self.gaussians = np.zeros(shape + (2,))
+    
+    def matches(self, rewards, final_states, **settings):
+        """Whether this checkpoint belongs to a run of the given topology, endings and settings
+        """
+        return (topology_digest(rewards) == topology_digest(self.rewards) and list(final_states) == self.final_states
+                and all(self.settings[name] == value for name, value in settings.items()))
+    
+    def done(self):
+        """Whether every unit has run all its iterations
+        """
+        return bool((self.progress >= self.settings['iterations']).all())
+    
+    def generators(self, ending, replicas):
+        """Generators of the given replicas of an ending, picking up where the checkpoint left them
+        """
+        random_states = []
+        for r in replicas:
+            random_state = replica_seed(self.settings['seed'], ending, r)
+            if self.progress[ending, r] > 0:
+                has_gauss, gauss = self.gaussians[ending, r]
+                random_state.set_state(('MT19937', self.keys[ending, r], int(self.positions[ending, r]),
+                                        int(has_gauss), float(gauss)))
+            random_states.append(random_state)
+        return random_states
+    
+    def tables(self, ending, replicas):
+        """Dense (replicas, N, N) Q-tables of the given replicas of an ending
+        """
+        Q = np.zeros([len(replicas), len(self.rewards), len(self.rewards)])
+        Q[:, self.layout.sources, self.layout.targets] = self.values[ending, replicas]
+        return Q
+    
+    def record(self, ending, replicas, Q, random_states, iterations):
+        """Take in the tables and generators of some replicas of an ending after iterations more iterations
+        """
+        self.values[ending, replicas] = Q[:, self.layout.sources, self.layout.targets]
+        self.progress[ending, replicas] += iterations
+        for r, random_state in zip(replicas, random_states):
+            name, keys, position, has_gauss, gauss = random_state.get_state()
+            self.keys[ending, r] = keys
+            self.positions[ending, r] = position
+            self.gaussians[ending, r] = has_gauss, gauss
+    
+    def save(self, filename):
+        """Write the checkpoint to an .npz file, replacing the old one only once the new one is complete
+        """
+        header = {'states': state_names(self.location_to_state), 'final_states': self.final_states,
+                  'settings': self.settings}
+        temporary = filename + '.tmp'
+        with open(temporary, 'wb') as checkpointFile:
+            np.savez(checkpointFile, rewards=self.rewards, progress=self.progress, values=self.values, keys=self.keys,
+                     positions=self.positions, gaussians=self.gaussians, header=np.array(json.dumps(header)))
+        os.replace(temporary, filename)
+    
+    @classmethod
+    def load(cls, filename):
+        """Read a checkpoint written by save
+        """
+        with np.load(filename) as stored:
+            header = json.loads(str(stored['header']))
+            location_to_state = dict((location, state) for state, location in enumerate(header['states']))
+            checkpoint = cls(stored['rewards'], location_to_state, header['final_states'], **header['settings'])
+            for name in ('progress', 'values', 'keys', 'positions', 'gaussians'):
+                setattr(checkpoint, name, stored[name])
+        return checkpoint
+
+def train_checkpointed(filename, rewards, location_to_state, final_states, replicas=100, iterations=1000,
+                       alpha=0.9, gamma=0.75, seed=0, block=1000, interval=60):
+    """Train every (ending, replica) unit, saving progress to filename at least every interval seconds
+    
+    An existing checkpoint of the same run in filename is resumed; one of a different run is an error.
+    Returns a (replicas, N, N) stack of tables for each ending, equal to scoring.train_endings.
+    """
+    settings = {'replicas': replicas, 'iterations': iterations, 'alpha': alpha, 'gamma': gamma, 'seed': seed}
+    if os.path.exists(filename):
+        checkpoint = Checkpoint.load(filename)
+        if not checkpoint.matches(rewards, final_states, **settings):
+            raise ValueError(filename + " is a checkpoint of a different run")
+    else:
+        checkpoint = Checkpoint(rewards, location_to_state, final_states, **settings)
+    return resume(filename, checkpoint, block, interval)
+
+def resume(filename, checkpoint, block=1000, interval=60):
+    """Finish the run of a checkpoint, saving it to filename as it goes, and return its tables
+    """
+    settings = checkpoint.settings
+    state_to_location = dict((state, location) for location, state in checkpoint.location_to_state.items())
+    saved = time.time()
+    
+    for ending, final_state in enumerate(checkpoint.final_states):
+        #replicas of an ending that are at the same iteration train together
+        for start in np.unique(checkpoint.progress[ending]):
+            replicas = np.flatnonzero(checkpoint.progress[ending] == start)
+            random_states = checkpoint.generators(ending, replicas)
+            qagent = BatchQAgent(settings['alpha'], settings['gamma'], checkpoint.location_to_state, checkpoint.rewards,
+                                 state_to_location, len(replicas), checkpoint.tables(ending, replicas))
+            
+            for first in range(start, settings['iterations'], block):
+                count = min(block, settings['iterations'] - first)
+                qagent.training('Start', final_state, count, random_states, routes=False)
+                checkpoint.record(ending, replicas, qagent.Q, random_states, count)
+                if time.time() - saved >= interval:
+                    with instrument.stage("checkpoint"):
+                        checkpoint.save(filename)
+                    saved = time.time()
+    
+    checkpoint.save(filename)
+    return [checkpoint.tables(ending, np.arange(settings['replicas'])) for ending in range(len(checkpoint.final_states))]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Train every ending of a topology with resumable checkpoints.")
+    parser.add_argument("filename", nargs="?", help="topology file (.txt matrix or draw.io .xml)")
+    parser.add_argument("--checkpoint", help="checkpoint file to save to, resumed if it already holds this run")
+    parser.add_argument("--resume", help="checkpoint file to finish, without the topology file")
+    parser.add_argument("--output", help="basename of the .npz stacks to write, one per ending plus the averages")
+    parser.add_argument("--replicas", type=int, default=100)
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--alpha", type=float, default=0.9)
+    parser.add_argument("--gamma", type=float, default=0.75)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--block", type=int, default=1000, help="iterations between chances to save")
+    parser.add_argument("--interval", type=float, default=60, help="seconds between saves")
+    args = parser.parse_args(argv)
+    
+    if args.resume is not None:
+        checkpoint_file = args.resume
+        checkpoint = Checkpoint.load(checkpoint_file)
+        final_states, location_to_state = checkpoint.final_states, checkpoint.location_to_state
+        qtables = resume(checkpoint_file, checkpoint, args.block, args.interval)
+    elif args.filename is not None:
+        checkpoint_file = args.checkpoint or args.filename + '.ckpt.npz'
+        rewards, location_to_state = load_topology(args.filename)
+        final_states = ending_names(location_to_state)
+        qtables = train_checkpointed(checkpoint_file, rewards, location_to_state, final_states, args.replicas,
+                                     args.iterations, args.alpha, args.gamma, args.seed, args.block, args.interval)
+    else:
+        parser.error("give a topology file or --resume")
+    
+    output = args.output
+    if output is None:
+        output = checkpoint_file[:-len('.ckpt.npz')] if checkpoint_file.endswith('.ckpt.npz') else os.path.splitext(checkpoint_file)[0]
+    for final_state, tables in zip(final_states, qtables):
+        print(save_qtables(output + final_state, tables, location_to_state, compressed=True))
+    print(save_qtables(output, [RunningTable().add_all(tables).mean for tables in qtables], location_to_state, names=final_states))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+import numpy as np
+
+
+# ### Minkowski Distance
+# 
+# Pairwise Minkowski distances between a whole stack of averaged q-tables in one pass, replacing the
+# Decimal based p_root / minkowski_distance pair that compared two Python lists at a time.
+
+#largest number of floats to hold in one block of differences
+BLOCK_SIZE = 1 << 23
+
+def minkowski_norm(difference, p_value=1):
+    """Minkowski length of absolute differences along their last axis
+    """
+    if p_value == np.inf:
+        return difference.max(axis=-1, initial=0)
+    if p_value == 1:
+        return difference.sum(axis=-1)
+    if p_value == 2:
+        return np.sqrt(np.einsum('...k,...k->...', difference, difference))
+    return np.power(np.power(difference, p_value).sum(axis=-1), 1 / p_value)
+
+def pairwise_distances(tables, p_value=1, decimals=None):
+    """Return the (T, T) matrix of Minkowski distances between T tables
+
+    Tables of any shape are flattened first. p_value may be any positive number or np.inf for the
+    largest difference. Distances are rounded to the given number of decimals when one is passed.
+    """
+    vectors = np.asarray(tables, dtype=float).reshape(len(tables), -1)
+    count, length = vectors.shape
+    distances = np.zeros([count, count])
+    
+    #difference every row against the whole stack, a block of rows at a time to bound memory
+    rows = max(1, BLOCK_SIZE // max(1, count * length))
+    for start in range(0, count, rows):
+        difference = np.abs(vectors[start:start + rows, np.newaxis, :] - vectors[np.newaxis, :, :])
+        distances[start:start + rows] = minkowski_norm(difference, p_value)
+    
+    if decimals is not None:
+        distances = np.round(distances, decimals)
+    return distances
+
+def minkowski_distance(x, y, p_value, decimals=3):
+    """Minkowski distance between two vectors, rounded to 3 places like the original scripts
+    """
+    return pairwise_distances([x, y], p_value, decimals)[0, 1]
+
+def pair_values(distances):
+    """Flatten the distance of every unordered pair (i < j), in the order the nested loops visited them
+    """
+    return distances[np.triu_indices(len(distances), 1)]
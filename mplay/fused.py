@@ -0,0 +1,193 @@
+import argparse
+import numpy as np
+
+from mplay import instrument
+from mplay.aggregate import RunningTable
+from mplay.parallel import replica_seed
+from mplay.policy import REACHED, edge_successors, resolve
+from mplay.scoring import meaningfulness
+from mplay.sparse import EdgeTopology, SparseQAgent, load_edge_topology, playable_edges, train_endings
+from mplay.store import save_qtables
+from mplay.topology import TopologyIndex
+
+
+# ### Forward and Reverse Training
+# 
+# The UpsideDown notebook scores a diagram with its edges reversed, training every ending back to
+# Start, on top of the forward training of MPD_V1. Here both directions train in one pass: the
+# forward layout (edges plus ending self loops) and the reversed one (reversed edges plus a self loop
+# on Start) are laid side by side as one index over 2N states, states N..2N-1 being the reversed
+# copies. Each iteration a replica observes one state and updates one playable edge of it in each
+# direction, so both directions share the draw of the observed state and one update step, and a
+# comparison of the two directions costs about as much as training one of them.
+# 
+#     python -m mplay.fused NoIntegrated.xml --output NoIntegrated
+# 
+# Draws come off each replica's generator three at a time (state, forward edge, reverse edge) instead
+# of through randint, so forward tables agree with scoring.train_endings in distribution, not bit for
+# bit. Every ending trains the same reversed problem, to reach Start, as the notebook did, and like
+# the notebook an ending averages only the reversed replicas whose greedy route from that ending
+# reaches Start. An ending with no such replica is left out of the reverse score.
+
+class FusedTopology():
+
+    def __init__(self, index, location_to_state, edge_rewards=None, goals=None):
+        """ Lay out the forward edges with a self loop on every goal and the reversed edges with a self
+        loop on Start, then index both together
+        """
+        self.location_to_state = location_to_state
+        self.size = index.size
+        self.forward = EdgeTopology(index, location_to_state, edge_rewards, goals)
+        self.goals = self.forward.goals
+        
+        reverse = TopologyIndex.from_edges(index.size, index.targets, index.sources)
+        reverse_rewards = None
+        if edge_rewards is not None:
+            reverse_rewards = np.asarray(edge_rewards)[index.edge_ids(reverse.targets, reverse.sources)]
+        self.reverse = EdgeTopology(reverse, location_to_state, reverse_rewards, goals=['Start'])
+        
+        #states of the reversed copy come after every forward state, so the fused layout is the
+        #forward layout followed by the reversed one
+        forward_index, reverse_index = self.forward.index, self.reverse.index
+        self.index = TopologyIndex.from_edges(2 * self.size,
+                                              np.concatenate([forward_index.sources, reverse_index.sources + self.size]),
+                                              np.concatenate([forward_index.targets, reverse_index.targets + self.size]))
+        self.split = len(forward_index.targets)
+    
+    @classmethod
+    def from_dense(cls, rewards, location_to_state, goals=None):
+        """Fused layout of a dense reward matrix
+        """
+        index = TopologyIndex(rewards)
+        return cls(index, location_to_state, np.asarray(rewards)[index.sources, index.targets], goals)
+    
+    def ending_rewards(self, end_location, final_reward=999):
+        """Fused edge rewards for training end_location forward and Start in reverse
+        """
+        return np.concatenate([self.forward.ending_rewards(end_location, final_reward),
+                               self.reverse.ending_rewards('Start', final_reward)])
+    
+    def directions(self, values):
+        """Split (..., edges) fused values into the forward and reverse layouts
+        """
+        values = np.asarray(values)
+        return values[..., :self.split], values[..., self.split:]
+
+def sample_fused(playable, size, replicas, iterations, random_state):
+    """Draw the observed state and the forward and reverse edge of every replica for every iteration
+    
+    playable is a fused index of 2 * size states. random_state is one generator per replica, each
+    drawing a (iterations, 3) block. Edges of -1 mark a direction in which the state has no playable
+    actions.
+    """
+    draws = np.stack([random_state[r].random_sample((iterations, 3)) for r in range(replicas)], axis=1)
+    states = (draws[..., 0] * size).astype(np.int64)
+    
+    edges = []
+    for direction, state in enumerate([states, states + size]):
+        degrees = playable.degrees[state]
+        edge = playable.offsets[state] + (draws[..., direction + 1] * degrees).astype(np.int64)
+        edges.append(np.where(degrees > 0, edge, -1))
+    return states, edges[0], edges[1]
+
+class FusedQAgent(SparseQAgent):
+    
+    def training(self, end_location, iterations, random_state, final_reward=999):
+        """Train every replica to reach end_location forward and Start in reverse, updating Q on edges only
+        
+        random_state is a list with one generator per replica.
+        """
+        with instrument.stage("training"):
+            rewards_new = self.topology.ending_rewards(end_location, final_reward)
+            playable_ids, playable = playable_edges(self.topology.index, rewards_new)
+            states, forward, reverse = sample_fused(playable, self.topology.size, self.replicas, iterations, random_state)
+            #both directions of every replica update together; their edges never overlap
+            self.update_edges(np.concatenate([forward, reverse], axis=1), rewards_new, playable_ids, playable)
+
+def load_fused_topology(filename):
+    """Read a topology file straight into a FusedTopology
+    """
+    return load_edge_topology(filename, FusedTopology)
+
+def train_fused_ending(topology, final_state, ending, replicas=100, iterations=1000, alpha=0.9, gamma=0.75,
+                       seed=0, final_reward=999):
+    """(replicas, fused edges) Q-values for one ending, seeded like scoring.train_endings
+    """
+    qagent = FusedQAgent(alpha, gamma, topology, replicas)
+    qagent.training(final_state, iterations, [replica_seed(seed, ending, r) for r in range(replicas)], final_reward)
+    return qagent.Q
+
+def train_fused(topology, final_states=None, executor=None, **training):
+    """Forward and reverse Q-values of every ending, optionally one ending per worker
+    
+    Returns two lists with a (replicas, edges) stack for each ending, in the layouts of
+    topology.forward and topology.reverse.
+    """
+    if final_states is None:
+        final_states = topology.goals
+    results = train_endings(topology, final_states, executor, train=train_fused_ending, **training)
+    
+    forward, reverse = [], []
+    for tables in results:
+        forward_tables, reverse_tables = topology.directions(tables)
+        forward.append(forward_tables)
+        reverse.append(reverse_tables)
+    return forward, reverse
+
+def reaching_replicas(layout, tables, start_location, end_location):
+    """Mask of the replicas of a (replicas, edges) stack whose greedy route from start_location reaches end_location
+    """
+    outcomes = resolve(edge_successors(layout, tables), layout.location_to_state[end_location])[0]
+    return outcomes[:, layout.location_to_state[start_location]] == REACHED
+
+def score_fused(topology, final_states=None, p_value=1, **training):
+    """Meaningfulness score of each direction, with a RunningTable per ending for each direction
+    
+    Returns (forward_score, reverse_score, forward_statistics, reverse_statistics); the means of the
+    statistics are the averaged edge tables of each ending. The reverse statistics of an ending only
+    hold the replicas whose greedy route from it reaches Start, and are None when no replica does.
+    """
+    if final_states is None:
+        final_states = topology.goals
+    with instrument.stage("train"):
+        forward, reverse = train_fused(topology, final_states, **training)
+    with instrument.stage("average"):
+        forward_statistics = [RunningTable().add_all(tables) for tables in forward]
+        reverse_statistics = []
+        for final_state, tables in zip(final_states, reverse):
+            reaching = reaching_replicas(topology.reverse, tables, final_state, 'Start')
+            reverse_statistics.append(RunningTable().add_all(tables[reaching]) if reaching.any() else None)
+    with instrument.stage("score"):
+        return (meaningfulness([ending.mean for ending in forward_statistics], p_value),
+                meaningfulness([ending.mean for ending in reverse_statistics if ending is not None], p_value),
+                forward_statistics, reverse_statistics)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Train and score a topology forward and with its edges reversed in one pass.")
+    parser.add_argument("filename", help="topology file (.txt matrix or draw.io .xml)")
+    parser.add_argument("--output", help="basename of the averaged .npy stacks to write, plus .forward and .reverse")
+    parser.add_argument("--replicas", type=int, default=100)
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--alpha", type=float, default=0.9)
+    parser.add_argument("--gamma", type=float, default=0.75)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--final-reward", type=float, default=999, help="reward of the goal self loop in both directions")
+    parser.add_argument("--p", type=float, default=1, dest="p_value", help="Minkowski p of the score")
+    args = parser.parse_args(argv)
+    
+    topology = load_fused_topology(args.filename)
+    forward_score, reverse_score, forward_statistics, reverse_statistics = score_fused(
+        topology, p_value=args.p_value, replicas=args.replicas, iterations=args.iterations, alpha=args.alpha,
+        gamma=args.gamma, seed=args.seed, final_reward=args.final_reward)
+    print("forward", round(forward_score, 3))
+    print("reverse", round(reverse_score, 3))
+    
+    if args.output is not None:
+        for name, layout, statistics in (('.forward', topology.forward, forward_statistics),
+                                         ('.reverse', topology.reverse, reverse_statistics)):
+            kept = [ending for ending in range(len(statistics)) if statistics[ending] is not None]
+            means = layout.to_dense([statistics[ending].mean for ending in kept])
+            print(save_qtables(args.output + name, means, topology.location_to_state, names=[topology.goals[ending] for ending in kept]))
+
+if __name__ == "__main__":
+    main()
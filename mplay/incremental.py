@@ -0,0 +1,262 @@
+import argparse
+import json
+import os
+import numpy as np
+
+from mplay import instrument
+from mplay.aggregate import RunningTable
+from mplay.cache import DEFAULT_DIRECTORY, QCache, cache_key, topology_digest
+from mplay.distance import minkowski_distance, pair_values, pairwise_distances
+from mplay.parallel import replica_seed
+from mplay.sparse import (TRAINING_DEFAULTS, EdgeTopology, SparseQAgent, cache_keys, exact_edge_table, load_edge_topology, train_ending,
+                          train_endings)
+from mplay.store import state_names
+from mplay.topology import TopologyIndex
+
+
+# ### Incremental Rescoring
+# 
+# Rescores an edited diagram from the snapshot of its last scoring instead of from scratch. The edges
+# of the two versions are matched by the ids of their cells, and only the states that can reach an
+# edited edge can have different Q-values. For every ending those states are solved or retrained,
+# starting from the cached tables of the last scoring, and only the distances between endings whose
+# averaged tables changed are computed again.
+# 
+#     python -m mplay.incremental Diagram.xml --solver exact
+# 
+# With solver "exact" the result equals a full rescore. Sampled training warm-starts the affected
+# states from the old tables and observes only them, as often per state as a full run would. That
+# agrees with a full rescore once the tables have converged, but tables trained far from convergence
+# keep the head start of the warm tables and score higher, so prefer "exact" for those.
+
+class Snapshot():
+
+    def __init__(self, topology, means, distances, keys, settings):
+        """ Hold what a scoring left behind: the topology, the averaged table and cache key of every
+        goal, the distance matrix between the averaged tables and the settings it was scored with
+        """
+        self.topology = topology
+        self.means = np.asarray(means, dtype=np.float64)
+        self.distances = np.asarray(distances, dtype=np.float64)
+        self.keys = list(keys)
+        self.settings = dict(settings)
+    
+    def save(self, filename):
+        """Write the snapshot to one .npz file
+        """
+        index = self.topology.index
+        header = {'states': state_names(self.topology.location_to_state), 'goals': self.topology.goals,
+                  'keys': self.keys, 'settings': self.settings}
+        with open(filename, 'wb') as snapshotFile:
+            np.savez(snapshotFile, size=index.size, sources=index.sources, targets=index.targets,
+                     rewards=self.topology.rewards, means=self.means, distances=self.distances,
+                     header=np.array(json.dumps(header)))
+    
+    @classmethod
+    def load(cls, filename):
+        """Read a snapshot written by save
+        """
+        with np.load(filename) as stored:
+            header = json.loads(str(stored['header']))
+            location_to_state = dict((location, state) for state, location in enumerate(header['states']))
+            
+            #goal self loops are part of the stored layout, so rebuilding it adds nothing
+            index = TopologyIndex.from_edges(int(stored['size']), stored['sources'], stored['targets'])
+            topology = EdgeTopology(index, location_to_state, goals=header['goals'])
+            topology.rewards = stored['rewards']
+            return cls(topology, stored['means'], stored['distances'], header['keys'], header['settings'])
+
+def match_edges(old, new):
+    """Position in old's layout of every edge of new's layout, -1 for edges old does not have
+    
+    Edges are matched by the names of their states, so renumbered states still line up.
+    """
+    old_names = state_names(old.location_to_state)
+    new_names = state_names(new.location_to_state)
+    positions = dict(((old_names[source], old_names[target]), edge) for edge, (source, target)
+                     in enumerate(zip(old.index.sources.tolist(), old.index.targets.tolist())))
+    return np.array([positions.get((new_names[source], new_names[target]), -1) for source, target
+                     in zip(new.index.sources.tolist(), new.index.targets.tolist())], dtype=np.int64)
+
+def changed_states(old, new, matches):
+    """Boolean mask over new's states whose playable edges or their rewards differ from old's
+    """
+    changed = np.zeros(new.size, dtype=bool)
+    
+    #edges that are new or whose reward moved
+    known = matches >= 0
+    moved = ~known
+    moved[known] = old.rewards[matches[known]] != new.rewards[known]
+    changed[new.index.sources[moved]] = True
+    
+    #edges that were removed, from states that are still there
+    removed = np.ones(len(old.rewards), dtype=bool)
+    removed[matches[known]] = False
+    new_states = new.location_to_state
+    old_names = state_names(old.location_to_state)
+    for source in np.unique(old.index.sources[removed]):
+        if old_names[source] in new_states:
+            changed[new_states[old_names[source]]] = True
+    
+    #states that did not exist before
+    for location, state in new_states.items():
+        if location not in old.location_to_state:
+            changed[state] = True
+    return changed
+
+def ancestors(index, states):
+    """Boolean mask of the states that can reach any state in the states mask, including those states
+    
+    Breadth-first search over the reversed edges, one whole frontier at a time.
+    """
+    reverse = TopologyIndex.from_edges(index.size, index.targets, index.sources)
+    reached = np.array(states, dtype=bool)
+    frontier = np.flatnonzero(reached)
+    while len(frontier) > 0:
+        parents = reverse.targets[reverse.out_edges(frontier)]
+        frontier = np.unique(parents[~reached[parents]])
+        reached[frontier] = True
+    return reached
+
+def score_snapshot(topology, p_value=1, cache=None, executor=None, **training):
+    """Score topology from scratch and return the Snapshot of the scoring
+    """
+    settings = dict(TRAINING_DEFAULTS, **training)
+    qtables = train_endings(topology, topology.goals, executor, cache, **settings)
+    means = [RunningTable().add_all(tables).mean for tables in qtables]
+    distances = pairwise_distances(means, p_value, 3)
+    keys = cache_keys(topology, topology.goals, **settings)
+    return Snapshot(topology, means, distances, keys, dict(settings, p_value=p_value))
+
+def retrain_goal(topology, goal, ending, warm, affected, settings):
+    """(replicas, edges) tables for one goal, redoing only the affected states of the warm tables
+    """
+    observed = np.flatnonzero(affected)
+    if len(observed) == 0:
+        return warm
+    if settings['solver'] == "exact":
+        return exact_edge_table(topology, goal, settings['gamma'], warm=warm[0], solved=~affected)[np.newaxis]
+    
+    #observe each affected state about as often as a full run would
+    iterations = max(1, int(round(settings['iterations'] * len(observed) / topology.size)))
+    qagent = SparseQAgent(settings['alpha'], settings['gamma'], topology, len(warm), warm)
+    qagent.training(goal, iterations, [replica_seed(settings['seed'], ending, r) for r in range(len(warm))],
+                    observed=observed)
+    return qagent.Q
+
+def rescore(topology, snapshot, cache, p_value=1, **training):
+    """Score an edited topology against the snapshot of its last scoring
+    
+    Returns the new Snapshot and a summary of what was redone. Goals whose tables are no longer in
+    the cache, or any change of settings, fall back to training those goals from scratch.
+    """
+    settings = dict(TRAINING_DEFAULTS, **training)
+    old = snapshot.topology
+    if dict(settings, p_value=p_value) != snapshot.settings:
+        return score_snapshot(topology, p_value, cache, **settings), {'full': True}
+    
+    with instrument.stage("diff"):
+        matches = match_edges(old, topology)
+        changed = changed_states(old, topology, matches)
+        affected = ancestors(topology.index, changed)
+    known = matches >= 0
+    removed = np.ones(len(old.rewards), dtype=bool)
+    removed[matches[known]] = False
+    
+    digest = topology_digest(topology)
+    fresh_keys = cache_keys(topology, topology.goals, **settings)
+    means = []
+    keys = []
+    unchanged = []
+    retrained = []
+    for ending, goal in enumerate(topology.goals):
+        previous = old.goals.index(goal) if goal in old.goals else None
+        cached = cache.get(snapshot.keys[previous]) if previous is not None else None
+        if cached is None:
+            key = fresh_keys[ending]
+            qtables = cache.get(key)
+            if qtables is None:
+                with instrument.stage("train"):
+                    qtables = train_ending(topology, goal, ending, **settings)
+                cache.put(key, qtables)
+            else:
+                qtables = qtables[0]
+            retrained.append(goal)
+        elif not affected.any() and not removed.any():
+            qtables, key = cached[0], snapshot.keys[previous]
+        else:
+            #carry the old tables over to the new layout, then redo the affected states
+            warm = np.zeros([len(cached[0]), len(topology.rewards)])
+            warm[:, known] = cached[0][:, matches[known]]
+            with instrument.stage("retrain"):
+                qtables = retrain_goal(topology, goal, ending, warm, affected, settings)
+            key = cache_key(digest, topology.location_to_state[goal], number=ending, warm=snapshot.keys[previous], **settings)
+            cache.put(key, qtables)
+            retrained.append(goal)
+        means.append(RunningTable().add_all(qtables).mean)
+        keys.append(key)
+        
+        #a table is unchanged if it matches the old one edge for edge and lost nothing with removed edges
+        if previous is not None:
+            old_mean = snapshot.means[previous]
+            carried = np.zeros(len(topology.rewards))
+            carried[known] = old_mean[matches[known]]
+            unchanged.append(not old_mean[removed].any() and np.array_equal(carried, means[-1]))
+        else:
+            unchanged.append(False)
+    
+    #reuse the distance of every pair of unchanged tables
+    distances = np.zeros([len(means), len(means)])
+    recomputed = 0
+    with instrument.stage("distance"):
+        for i in range(len(means)):
+            for j in range(i + 1, len(means)):
+                if unchanged[i] and unchanged[j]:
+                    distance = snapshot.distances[old.goals.index(topology.goals[i]), old.goals.index(topology.goals[j])]
+                else:
+                    distance = minkowski_distance(means[i], means[j], p_value)
+                    recomputed += 1
+                distances[i, j] = distances[j, i] = distance
+    
+    summary = {'full': False, 'changed_states': int(changed.sum()),
+               'affected_states': int(affected.sum()), 'retrained': retrained, 'recomputed_pairs': recomputed}
+    return Snapshot(topology, means, distances, keys, dict(settings, p_value=p_value)), summary
+
+def snapshot_score(snapshot):
+    """Meaningfulness score of a snapshot, nan with fewer than two goals
+    """
+    if len(snapshot.distances) < 2:
+        return float('nan')
+    return float(pair_values(snapshot.distances).mean())
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rescore an edited topology from the snapshot of its last scoring.")
+    parser.add_argument("filename", help="topology file (.txt matrix or draw.io .xml)")
+    parser.add_argument("--snapshot", help="snapshot file, by default the topology file name plus .snapshot.npz")
+    parser.add_argument("--cache", default=DEFAULT_DIRECTORY, help="directory of the q-table cache")
+    parser.add_argument("--replicas", type=int, default=100)
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--alpha", type=float, default=0.9)
+    parser.add_argument("--gamma", type=float, default=0.75)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--solver", choices=["sampled", "exact"], default="sampled")
+    parser.add_argument("--p", type=float, default=1, dest="p_value", help="Minkowski p of the score")
+    args = parser.parse_args(argv)
+    
+    snapshot_file = args.snapshot or args.filename + '.snapshot.npz'
+    cache = QCache(args.cache)
+    topology = load_edge_topology(args.filename)
+    training = dict(replicas=args.replicas, iterations=args.iterations, alpha=args.alpha, gamma=args.gamma,
+                    seed=args.seed, solver=args.solver)
+    
+    if os.path.exists(snapshot_file):
+        snapshot, summary = rescore(topology, Snapshot.load(snapshot_file), cache, args.p_value, **training)
+    else:
+        snapshot, summary = score_snapshot(topology, args.p_value, cache, **training), {'full': True}
+    snapshot.save(snapshot_file)
+    
+    print(json.dumps(summary))
+    print(round(snapshot_score(snapshot), 3))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+from contextlib import contextmanager
+import json
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# ### Instrumentation
+# 
+# Lightweight timing and counters for the scoring pipeline. Code marks its stages with stage() and
+# its work with count(); both do nothing unless a Recorder is active, so the hooks can stay in the
+# hot paths. A recorder collects wall and CPU time, call counts and memory per stage (stages nest as
+# "E1/training"), optionally a cProfile and tracemalloc capture, and exports it all as JSON.
+# 
+#     with recording(Recorder(profile=True)) as recorder:
+#         score_topology(...)
+#     recorder.save("run.json")
+
+#recorder that stage() and count() report to, None when instrumentation is off
+_current = None
+
+class Recorder():
+    
+    def __init__(self, profile=False, trace_memory=False, top=30):
+        """ Start an empty record; profile and trace_memory turn on cProfile and tracemalloc
+        """
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.top = top
+        
+        self.stages = {}
+        self.stage_counters = {}
+        self.counters = {}
+        self._path = []
+        #peak traced memory of each running stage up to its latest child's reset
+        self._peaks = []
+        self._profiler = None
+        self.started = None
+        self.seconds = None
+        self.profile_stats = None
+        self.previous = None
+    
+    def start(self):
+        """Begin the run, switching on the optional captures
+        """
+        self.started = time.time()
+        self._wall = time.perf_counter()
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self.profile:
+            import cProfile
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+    
+    def stop(self):
+        """End the run and collect the optional captures
+        """
+        self.seconds = time.perf_counter() - self._wall
+        if self._profiler is not None:
+            self._profiler.disable()
+            self.profile_stats = profile_rows(self._profiler, self.top)
+            self._profiler = None
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+    
+    @contextmanager
+    def stage(self, name):
+        """Time a stage of work, nested under any stage that is already running
+        """
+        self._path.append(str(name))
+        path = "/".join(self._path)
+        if self.trace_memory and tracemalloc.is_tracing():
+            #the reset would lose the enclosing stage's peak so far, so fold it in first
+            if self._peaks:
+                self._peaks[-1] = max(self._peaks[-1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        self._peaks.append(0)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            record = self.stages.setdefault(path, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0,
+                                                   'peak_bytes': None, 'max_rss_bytes': None})
+            record['calls'] += 1
+            record['wall_seconds'] += time.perf_counter() - wall
+            record['cpu_seconds'] += time.process_time() - cpu
+            peak = self._peaks.pop()
+            if self.trace_memory and tracemalloc.is_tracing():
+                peak = max(peak, tracemalloc.get_traced_memory()[1])
+                record['peak_bytes'] = max(record['peak_bytes'] or 0, peak)
+                if self._peaks:
+                    self._peaks[-1] = max(self._peaks[-1], peak)
+            if resource is not None:
+                #ru_maxrss is in kilobytes on Linux
+                record['max_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+            self._path.pop()
+    
+    def count(self, name, amount=1):
+        """Add to a counter, kept per running stage as well as in total
+        """
+        amount = int(amount)
+        self.counters[name] = self.counters.get(name, 0) + amount
+        if self._path:
+            counters = self.stage_counters.setdefault("/".join(self._path), {})
+            counters[name] = counters.get(name, 0) + amount
+    
+    def to_dict(self):
+        """Everything recorded so far as plain JSON-ready data
+        """
+        stages = dict((path, dict(record)) for path, record in self.stages.items())
+        for path, counters in self.stage_counters.items():
+            stages.setdefault(path, {})['counters'] = dict(counters)
+        return {'started': self.started, 'seconds': self.seconds, 'stages': stages,
+                'counters': dict(self.counters), 'profile': self.profile_stats}
+    
+    def save(self, filename):
+        """Write the record to a JSON file
+        """
+        with open(filename, 'w') as recordFile:
+            json.dump(self.to_dict(), recordFile, indent=1)
+
+def profile_rows(profiler, top):
+    """The top functions of a cProfile run by cumulative time, as dictionaries
+    """
+    import pstats
+    
+    stats = pstats.Stats(profiler)
+    rows = []
+    for (filename, line, function), (calls, primitive, total, cumulative, callers) in stats.stats.items():
+        rows.append({'function': function, 'file': filename, 'line': line, 'calls': calls,
+                     'total_seconds': total, 'cumulative_seconds': cumulative})
+    rows.sort(key=lambda row: row['cumulative_seconds'], reverse=True)
+    return rows[:top]
+
+def start_recording(recorder):
+    """Make recorder the active one and start it
+    """
+    global _current
+    recorder.previous = _current
+    _current = recorder
+    recorder.start()
+    return recorder
+
+def stop_recording():
+    """Stop the active recorder and return it, restoring whichever was active before
+    """
+    global _current
+    recorder = _current
+    recorder.stop()
+    _current = recorder.previous
+    return recorder
+
+@contextmanager
+def recording(recorder):
+    """Make recorder the active one for the duration of the block
+    """
+    start_recording(recorder)
+    try:
+        yield recorder
+    finally:
+        stop_recording()
+
+@contextmanager
+def stage(name):
+    """Time a stage on the active recorder, if there is one
+    """
+    if _current is None:
+        yield
+    else:
+        with _current.stage(name):
+            yield
+
+def count(name, amount=1):
+    """Add to a counter on the active recorder, if there is one
+    """
+    if _current is not None:
+        _current.count(name, amount)
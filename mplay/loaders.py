@@ -0,0 +1,110 @@
+from collections import OrderedDict
+import hashlib
+import os
+import re
+import numpy as np
+
+from mplay.topology import TopologyIndex
+
+
+# ### Topology Loaders
+# 
+# Read a topology into a reward matrix and a location_to_state map. Matrix .txt files are comma
+# separated adjacency matrices; draw.io .xml files are diagrams of ellipse nodes joined by arrows.
+
+#parsed diagrams by sha256 of the file, most recently used last
+_parsed = OrderedDict()
+PARSE_CACHE_SIZE = 64
+
+def load_matrix(filename):
+    """Read a comma separated adjacency matrix
+
+    State 0 is 'Start' and states with no outgoing actions are the endings E1, E2, ... in order.
+    Every other state is named after its index.
+    """
+    with open(filename) as textFile:
+        rewards = np.array([[int(digit) for digit in line.strip().strip(",").split(",")] for line in textFile if line.strip()])
+    
+    location_to_state = {}
+    endingIndex = 1
+    for i in range(len(rewards)):
+        if i == 0:
+            location_to_state['Start'] = i
+        elif not rewards[i].any():
+            location_to_state['E' + str(endingIndex)] = i
+            endingIndex = endingIndex + 1
+        else:
+            location_to_state[str(i)] = i
+    
+    return rewards, location_to_state
+
+def parse_drawio(filename):
+    """Stream a draw.io diagram into a TopologyIndex and a location_to_state map
+
+    Ellipses are states and endArrow cells are connections. A state whose label contains "ending" is
+    E1, E2, ... in document order, the one containing "start" is 'Start', and the rest keep their ids.
+    Results are cached by the hash of the file, so parsing an unchanged diagram again is free.
+    """
+    with open(filename, 'rb') as diagramFile:
+        digest = hashlib.sha256(diagramFile.read()).hexdigest()
+    if digest in _parsed:
+        _parsed.move_to_end(digest)
+        index, location_to_state = _parsed[digest]
+        return index, dict(location_to_state)
+    
+    #only pay for the xml parser when a diagram is read
+    from xml.etree import ElementTree
+    
+    #Mapping for the states
+    location_to_state = {}
+    #Map from cell id to state index
+    tempMap = {}
+    #endpoints of every connection, by cell id
+    connections = []
+    
+    endingIndex = 1
+    for event, cell in ElementTree.iterparse(filename):
+        if cell.tag != "mxCell":
+            continue
+        style = cell.get("style", "")
+        if style.startswith("ellipse"):
+            value = cell.get("value", "")
+            if "ending" in value:
+                location_to_state["E" + str(endingIndex)] = len(tempMap)
+                endingIndex = endingIndex + 1
+            elif "start" in value:
+                location_to_state["Start"] = len(tempMap)
+            else:
+                location_to_state[cell.get("id", "")] = len(tempMap)
+            tempMap[cell.get("id", "")] = len(tempMap)
+        elif style.startswith("endArrow"):
+            connections.append((cell.get("source", ""), cell.get("target", "")))
+        #drop the finished cell and its geometry so the tree never grows
+        cell.clear()
+    
+    sources = [tempMap[source] for source, target in connections]
+    targets = [tempMap[target] for source, target in connections]
+    index = TopologyIndex.from_edges(len(tempMap), sources, targets)
+    
+    _parsed[digest] = (index, dict(location_to_state))
+    if len(_parsed) > PARSE_CACHE_SIZE:
+        _parsed.popitem(last=False)
+    return index, location_to_state
+
+def load_drawio(filename):
+    """Read a draw.io diagram into a dense reward matrix the way the Mplay notebooks do
+    """
+    index, location_to_state = parse_drawio(filename)
+    return index.to_dense(), location_to_state
+
+def load_topology(filename):
+    """Read a .txt matrix or a draw.io .xml diagram, chosen by file extension
+    """
+    if os.path.splitext(filename)[1].lower() == ".xml":
+        return load_drawio(filename)
+    return load_matrix(filename)
+
+def ending_names(location_to_state):
+    """Names of the endings E1, E2, ... in numeric order
+    """
+    return sorted((name for name in location_to_state if re.fullmatch(r"E\d+", name)), key=lambda name: int(name[1:]))
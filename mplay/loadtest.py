@@ -0,0 +1,97 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+import numpy as np
+
+from mplay.server import SETTINGS, request_score
+
+
+# ### Load Test
+# 
+# Sends many score requests to a running mplay.server at once and reports its throughput and the
+# spread of its latencies. --distinct gives every request its own seed, so none of them can follow
+# another's job or be answered from memory.
+# 
+#     python -m mplay.server serve --port 8765 &
+#     python -m mplay.loadtest NoIntegrated.xml split.txt --requests 200 --concurrency 16 --replicas 10
+
+PERCENTILES = [50, 90, 99]
+
+async def timed_request(payload, name, connection, settings):
+    """Seconds to the first event and to the last, and the last event, of one request
+    """
+    started = time.perf_counter()
+    first = None
+    event = {'event': "error", 'error': "no response"}
+    try:
+        async for event in request_score(payload, name, **dict(connection, **settings)):
+            if first is None:
+                first = time.perf_counter() - started
+    except (OSError, ValueError) as error:
+        event = {'event': "error", 'error': repr(error)}
+    return first, time.perf_counter() - started, event
+
+async def load_test(payloads, requests=100, concurrency=8, distinct=False, connection=None, **settings):
+    """Send requests score requests, at most concurrency at a time, cycling through the (name, payload) list
+    
+    Returns a summary with the throughput, latency percentiles and counts of errors and remembered
+    scores.
+    """
+    connection = connection or {}
+    limit = asyncio.Semaphore(concurrency)
+    
+    async def one(number):
+        name, payload = payloads[number % len(payloads)]
+        request_settings = dict(settings)
+        if distinct:
+            request_settings['seed'] = settings.get('seed', 0) + number
+        async with limit:
+            return await timed_request(payload, name, connection, request_settings)
+    
+    started = time.perf_counter()
+    results = await asyncio.gather(*[one(number) for number in range(requests)])
+    elapsed = time.perf_counter() - started
+    
+    latencies = np.array([latency for first, latency, event in results if event['event'] == "score"])
+    firsts = np.array([first for first, latency, event in results if first is not None])
+    summary = {'requests': requests, 'concurrency': concurrency, 'seconds': round(elapsed, 3),
+               'scores_per_second': round(len(latencies) / elapsed, 3),
+               'errors': sum(event['event'] != "score" for first, latency, event in results),
+               'remembered': sum(bool(event.get('cached')) for first, latency, event in results)}
+    for name, values in (('latency', latencies), ('first_event', firsts)):
+        for percentile in PERCENTILES:
+            summary['%s_p%d' % (name, percentile)] = round(float(np.percentile(values, percentile)), 4) if len(values) else None
+        summary[name + '_max'] = round(float(values.max()), 4) if len(values) else None
+    return summary
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the throughput and latency of a running scoring server.")
+    parser.add_argument("filenames", nargs="+", help="topology files to send, in turn")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--distinct", action="store_true", help="give every request its own seed")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--socket", dest="path", help="Unix socket to use instead of a port")
+    parser.add_argument("--output", help="json file to write the summary to")
+    for name, kind in SETTINGS.items():
+        parser.add_argument("--" + name, type=kind)
+    args = parser.parse_args(argv)
+    
+    payloads = []
+    for filename in args.filenames:
+        with open(filename, 'rb') as topologyFile:
+            payloads.append((os.path.basename(filename), topologyFile.read()))
+    settings = dict((name, getattr(args, name)) for name in SETTINGS if getattr(args, name) is not None)
+    connection = {'host': args.host, 'port': args.port, 'path': args.path}
+    
+    summary = asyncio.run(load_test(payloads, args.requests, args.concurrency, args.distinct, connection, **settings))
+    print(json.dumps(summary, indent=1))
+    if args.output is not None:
+        with open(args.output, 'w') as summaryFile:
+            json.dump(summary, summaryFile, indent=1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import numpy as np
+
+from mplay.qbatch import BatchQAgent
+
+
+# ### Parallel Training
+# 
+# Spreads (ending, replica) training jobs over a pool of processes. The reward matrix and the output
+# Q-tensor live in shared memory, so each job only ships a few integers and its routes back.
+# Every replica is seeded from (seed, ending, replica), so results do not depend on the number of
+# workers or on how the replicas are chunked.
+
+#shared memory segments this worker process has attached to, by name
+_attached = {}
+
+def replica_seed(seed, ending, replica):
+    """Random generator for one (ending, replica) unit
+    """
+    return np.random.RandomState([seed, ending, replica])
+
+def _attach(names):
+    """Map the shared memory segments created by the parent process into this worker
+
+    Segments of earlier calls are closed first, so a reused worker only holds on to the current ones.
+    """
+    from multiprocessing import shared_memory
+    
+    for stale in [name for name in _attached if name not in names]:
+        _attached.pop(stale).close()
+    for name in names:
+        if name not in _attached:
+            _attached[name] = shared_memory.SharedMemory(name=name)
+    return [_attached[name] for name in names]
+
+def _train_unit(job):
+    """Train one chunk of replicas of one ending straight into the shared output tensor
+    """
+    (rewards_name, rewards_shape, rewards_dtype, out_name, out_shape, location_to_state, state_to_location,
+        alpha, gamma, iterations, seed, ending, number, final_state, first, count, routes) = job
+    rewards_memory, out_memory = _attach([rewards_name, out_name])
+    rewards = np.ndarray(rewards_shape, dtype=rewards_dtype, buffer=rewards_memory.buf)
+    out = np.ndarray(out_shape, dtype=np.float64, buffer=out_memory.buf)
+    
+    qagent = BatchQAgent(alpha, gamma, location_to_state, rewards, state_to_location, count)
+    random_states = [replica_seed(seed, number, r) for r in range(first, first + count)]
+    paths_taken = qagent.training('Start', final_state, iterations, random_states, routes)
+    out[ending, first:first + count] = qagent.Q
+    del rewards, out
+    return ending, first, paths_taken or [None] * count
+
+def parallel_qtables(rewards, location_to_state, state_to_location, final_states, replicas, iterations,
+                     alpha, gamma, seed=0, workers=None, chunk_size=None, executor=None, routes=True, endings=None):
+    """Train replicas of every ending across processes
+
+    Returns a list with (paths_taken, qtables) for each ending in final_states, in the same order.
+    qtables is a (replicas, N, N) array and each route is None when routes is False. An existing
+    executor can be passed in to reuse its workers. endings gives the number each ending is seeded
+    with, by default its position in final_states.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import shared_memory
+    
+    if endings is None:
+        endings = range(len(final_states))
+    rewards = np.ascontiguousarray(rewards)
+    out_shape = (len(final_states), replicas, len(rewards), len(rewards))
+    if chunk_size is None:
+        chunk_size = max(1, -(-replicas * len(final_states) // (4 * (workers or 8))))
+    
+    rewards_memory = shared_memory.SharedMemory(create=True, size=max(1, rewards.nbytes))
+    out_memory = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(out_shape)) * 8))
+    pool = executor or ProcessPoolExecutor(max_workers=workers)
+    try:
+        np.ndarray(rewards.shape, dtype=rewards.dtype, buffer=rewards_memory.buf)[:] = rewards
+        
+        jobs = []
+        for ending, (number, final_state) in enumerate(zip(endings, final_states)):
+            for first in range(0, replicas, chunk_size):
+                jobs.append((rewards_memory.name, rewards.shape, rewards.dtype.str, out_memory.name, out_shape,
+                             location_to_state, state_to_location, alpha, gamma, iterations, seed, ending,
+                             number, final_state, first, min(chunk_size, replicas - first), routes))
+        
+        #gather routes by position so the output order never depends on which job finished first
+        paths_taken = [[None] * replicas for ending in final_states]
+        for ending, first, paths in pool.map(_train_unit, jobs):
+            paths_taken[ending][first:first + len(paths)] = paths
+        
+        qtables = np.ndarray(out_shape, dtype=np.float64, buffer=out_memory.buf).copy()
+    finally:
+        if executor is None:
+            pool.shutdown()
+        rewards_memory.close()
+        rewards_memory.unlink()
+        out_memory.close()
+        out_memory.unlink()
+    
+    return [(paths_taken[ending], qtables[ending]) for ending in range(len(final_states))]
@@ -0,0 +1,124 @@
+from collections import Counter
+import numpy as np
+
+
+# ### Greedy Policies
+# 
+# Reads the greedy policy of every replica out of its Q-table all at once. The greedy successor of
+# every state is one argmax over the whole (replicas, N, N) stack, and where each state's greedy walk
+# ends up is found by pointer jumping: following the successor of the successor doubles the distance
+# covered each round, so log2(N) rounds settle every state of every replica. Walks that reach a state
+# with no learned action (a dead end) or come back to a state they passed (a cycle) are flagged
+# instead of followed forever, and the routes of the replicas are counted into a histogram.
+# 
+#     successors = greedy_successors(qtables)
+#     rows = route_histogram(successors, location_to_state, 'Start', 'E1')
+
+#outcome of a greedy walk, indexed by the codes resolve returns
+OUTCOMES = ("reached", "dead end", "cycle")
+REACHED, DEAD_END, CYCLE = range(3)
+
+def greedy_successors(Q):
+    """(..., N) greedy successor of every state of a (..., N, N) stack of tables, -1 for dead ends
+    
+    The successor is the argmax of the state's row, as the old route walk took it. A state is a
+    dead end when no action in its row has a positive Q-value, since every playable action of a
+    trained table earns one.
+    """
+    Q = np.asarray(Q)
+    return np.where(Q.max(axis=-1) > 0, Q.argmax(axis=-1), -1)
+
+def edge_successors(topology, values):
+    """greedy_successors of (..., edges) values laid out on an EdgeTopology
+    
+    Ties go to the lowest target state, like the argmax of a dense row.
+    """
+    values = np.asarray(values)
+    index = topology.index
+    successors = np.full(values.shape[:-1] + (index.size,), -1, dtype=np.int64)
+    if len(index.active) == 0:
+        return successors
+    starts = index.offsets[index.active]
+    best = np.maximum.reduceat(values, starts, axis=-1)
+    
+    #first edge of each state holding its best value
+    owner = np.repeat(np.arange(len(index.active)), index.degrees[index.active])
+    positions = np.where(values == best[..., owner], np.arange(values.shape[-1]), values.shape[-1])
+    first = np.minimum.reduceat(positions, starts, axis=-1)
+    successors[..., index.active] = np.where(best > 0, index.targets[np.minimum(first, len(index.targets) - 1)], -1)
+    return successors
+
+def resolve(successors, goal):
+    """Outcome code of the greedy walk from every state and the number of steps it takes
+    
+    Returns two arrays shaped like successors: REACHED, DEAD_END or CYCLE for each state, and the
+    steps to the goal or to the dead end, -1 for cycles.
+    """
+    successors = np.asarray(successors, dtype=np.int64)
+    size = successors.shape[-1]
+    
+    #dead ends point at an extra sink state; the goal and the sink point at themselves
+    jump = np.concatenate([np.where(successors < 0, size, successors),
+                           np.full(successors.shape[:-1] + (1,), size, dtype=np.int64)], axis=-1)
+    jump[..., goal] = goal
+    steps = (jump != np.arange(size + 1)).astype(np.int64)
+    
+    #after k rounds every state has jumped 2^k steps, or stopped at the goal or the sink
+    for doubling in range(int(np.ceil(np.log2(size + 1)))):
+        steps = steps + np.take_along_axis(steps, jump, axis=-1)
+        jump = np.take_along_axis(jump, jump, axis=-1)
+    
+    terminal, steps = jump[..., :size], steps[..., :size]
+    outcomes = np.where(terminal == goal, REACHED, np.where(terminal == size, DEAD_END, CYCLE))
+    steps = np.where(outcomes == REACHED, steps, np.where(outcomes == DEAD_END, steps - 1, -1))
+    return outcomes, steps
+
+def walk(successors, start, goal):
+    """Greedy route of every replica of a (replicas, N) successor array from start
+    
+    Returns the routes as lists of states and the outcome code of each. A route stops at the goal,
+    at a dead end, or at the first state it visits twice, which is left on the end to show the cycle.
+    """
+    successors = np.asarray(successors, dtype=np.int64)
+    replicas, size = successors.shape
+    outcomes = resolve(successors, goal)[0][:, start]
+    
+    replica_index = np.arange(replicas)
+    current = np.full(replicas, start, dtype=np.int64)
+    seen = np.zeros([replicas, size], dtype=bool)
+    seen[:, start] = True
+    lengths = np.ones(replicas, dtype=np.int64)
+    path = [current.copy()]
+    walking = (current != goal) & (successors[:, start] >= 0)
+    
+    #every step either ends a walk or visits a new state, so this runs at most N times
+    while walking.any():
+        r = replica_index[walking]
+        current[r] = successors[r, current[r]]
+        path.append(current.copy())
+        lengths[r] += 1
+        walking[r] = (current[r] != goal) & (successors[r, current[r]] >= 0) & ~seen[r, current[r]]
+        seen[r, current[r]] = True
+    
+    path = np.array(path)
+    return [path[:lengths[r], r].tolist() for r in range(replicas)], outcomes
+
+def policy_routes(successors, location_to_state, start_location, end_location):
+    """Greedy route of every replica as a list of locations, or None where it does not reach end_location
+    """
+    state_to_location = dict((state, location) for location, state in location_to_state.items())
+    routes, outcomes = walk(successors, location_to_state[start_location], location_to_state[end_location])
+    return [[state_to_location[state] for state in route] if outcome == REACHED else None
+            for route, outcome in zip(routes, outcomes)]
+
+def route_histogram(successors, location_to_state, start_location, end_location):
+    """How many replicas take each greedy route, most common first
+    
+    Each row is [count, outcome, location, location, ...], the locations being the route as walk
+    returns it.
+    """
+    state_to_location = dict((state, location) for location, state in location_to_state.items())
+    routes, outcomes = walk(successors, location_to_state[start_location], location_to_state[end_location])
+    counts = Counter((int(outcome), tuple(route)) for route, outcome in zip(routes, outcomes))
+    return [[count, OUTCOMES[outcome]] + [state_to_location[state] for state in route]
+            for (outcome, route), count in sorted(counts.items(), key=lambda item: (-item[1], item[0]))]
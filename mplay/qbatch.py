@@ -0,0 +1,147 @@
+import numpy as np
+
+from mplay import instrument
+from mplay.policy import greedy_successors, policy_routes
+from mplay.topology import TopologyIndex
+
+
+# ### Batched Q-Learning
+# 
+# Trains every replica of a topology at once. All Q-tables live in one (replicas, N, N) tensor and the
+# temporal difference update of every replica is applied together at each iteration.
+
+def sample_edges(playable, replicas, iterations, random_state, observed=None):
+    """Draw the observed state and playable edge of every replica for every iteration
+
+    Draws come off random_state in exactly the order that running one QAgent per replica would
+    consume them, so seeding numpy gives the same tables as the per-agent path. random_state may
+    also be a list with one generator per replica. An edge of -1 marks an iteration that landed
+    on a state with no playable actions. observed limits the states drawn from, all by default.
+    """
+    states = np.empty([iterations, replicas], dtype=np.int64)
+    edges = np.full([iterations, replicas], -1, dtype=np.int64)
+    for r in range(replicas):
+        replica_state = random_state[r] if isinstance(random_state, (list, tuple)) else random_state
+        for i in range(iterations):
+            #Randomly pick a state to observe
+            if observed is None:
+                current_state = replica_state.randint(0, playable.size)
+            else:
+                current_state = observed[replica_state.randint(0, len(observed))]
+            states[i, r] = current_state
+            
+            if playable.degrees[current_state] > 0:
+                edges[i, r] = playable.sample_edge(current_state, replica_state)
+    
+    return states, edges
+
+class BatchQAgent():
+    
+    def __init__(self, alpha, gamma, location_to_state, rewards, state_to_location, replicas, Q=None):
+        """ Initialize alpha, gamma, states, actions, rewards, and the stacked Q-values of every replica
+        """
+        self.gamma = gamma
+        self.alpha = alpha
+        
+        self.location_to_state = location_to_state
+        self.rewards = rewards
+        self.state_to_location = state_to_location
+        
+        self.replicas = replicas
+        if Q is None:
+            Q = np.zeros([replicas, len(rewards), len(rewards)])
+        self.Q = Q
+        
+    def sample(self, rewards_new, iterations, random_state):
+        """Draw the observed state and action of every replica for every iteration
+
+        An action of -1 marks an iteration that landed on a state with no playable actions. A list of
+        generators draws for as many replicas as it holds.
+        """
+        playable = TopologyIndex(rewards_new)
+        replicas = len(random_state) if isinstance(random_state, (list, tuple)) else self.replicas
+        states, edges = sample_edges(playable, replicas, iterations, random_state)
+        return states, np.where(edges >= 0, playable.targets[edges], -1)
+        
+    def training(self, start_location, end_location, iterations, random_state=np.random, routes=True,
+                 tolerance=None, window=100):
+        """Training every replica in the given environment to move from a start state to an end state
+
+        With a tolerance, a replica stops once no Q-value has moved by tolerance or more over its last
+        window iterations, and iterations_used records how many iterations each replica ran. Only
+        replicas with their own generators stop drawing when they stop; a shared random stream is
+        still drawn in full, so stopping saves updates but hardly any time.
+        Returns the greedy route of each replica (None where it never reaches end_location), or None
+        when routes is False.
+        """
+        with instrument.stage("training"):
+            rewards_new = np.copy(self.rewards)
+        
+            #set reward for end state to 999 to incentivize reaching desired end
+            ending_state = self.location_to_state[end_location]
+            rewards_new[ending_state, ending_state] = 999
+        
+            replica_index = np.arange(self.replicas)
+            td_updates = 0
+            dead_end_hits = 0
+            self.iterations_used = np.full(self.replicas, iterations)
+            #last iteration in which each replica moved a Q-value by tolerance or more
+            last_moved = np.full(self.replicas, -1)
+            running = np.ones(self.replicas, dtype=bool)
+        
+            #replicas with their own generators are sampled a window at a time, and only while they run,
+            #so stopping early also saves the draws; a shared stream has to be drawn in full to keep the
+            #per-agent order
+            block = iterations
+            if tolerance is not None and isinstance(random_state, (list, tuple)):
+                block = max(window, 1)
+        
+            #Loop for iterations, updating all replicas together
+            for start in range(0, iterations, block):
+                count = min(block, iterations - start)
+                if block < iterations:
+                    sampled = replica_index[running]
+                    states = np.zeros([count, self.replicas], dtype=np.int64)
+                    actions = np.full([count, self.replicas], -1, dtype=np.int64)
+                    states[:, sampled], actions[:, sampled] = self.sample(rewards_new, count, [random_state[r] for r in sampled])
+                else:
+                    states, actions = self.sample(rewards_new, count, random_state)
+                for i in range(start, start + len(states)):
+                    #Only run updates for running replicas whose observed state has performable actions
+                    live = (actions[i - start] >= 0) & running
+                    dead_end_hits += np.count_nonzero(running) - np.count_nonzero(live)
+                    r = replica_index[live]
+                    td_updates += len(r)
+                    current_state = states[i - start, live]
+                    next_state = actions[i - start, live]
+                
+                    #Calculate temporal difference
+                    TD = rewards_new[current_state, next_state] + \
+                            self.gamma * self.Q[r, next_state].max(axis=1) - self.Q[r, current_state, next_state]
+                
+                    #updates Q-values using Bellman equation
+                    self.Q[r, current_state, next_state] += self.alpha * TD
+                
+                    if tolerance is not None:
+                        last_moved[r[np.abs(self.alpha * TD) >= tolerance]] = i
+                        settled = running & (i - last_moved >= window)
+                        self.iterations_used[settled] = i + 1
+                        running &= ~settled
+                if not running.any():
+                    break
+            
+            instrument.count("iterations", self.iterations_used.sum())
+            instrument.count("td_updates", td_updates)
+            instrument.count("dead_end_hits", dead_end_hits)
+        
+        if not routes:
+            return None
+        
+        # Get the routes
+        with instrument.stage("routes"):
+            return policy_routes(greedy_successors(self.Q), self.location_to_state, start_location, end_location)
+        
+    def get_optimal_route(self, start_location, end_location, Q):
+        """Greedy route of a single replica's table, or None where it ends in a dead end or a cycle
+        """
+        return policy_routes(greedy_successors(Q[np.newaxis]), self.location_to_state, start_location, end_location)[0]
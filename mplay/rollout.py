@@ -0,0 +1,133 @@
+import warnings
+import numpy as np
+
+from mplay import instrument
+from mplay.policy import greedy_successors, policy_routes
+from mplay.topology import TopologyIndex
+
+
+# ### Episode Rollouts
+# 
+# The epsilon-greedy walk trainer of the V5 and UpsideDown notebooks, run for every replica at once.
+# Each training iteration there is one episode: start on a random state and keep stepping (a random
+# playable action with probability epsilon, the greedy one otherwise) until the walk takes a self
+# loop, reaches a dead end or has taken limit steps. Here every replica walks its own episodes in
+# lockstep with the others, so a step is a handful of array operations over the replicas that are
+# still walking. A replica starts its next episode as soon as one ends, and stops after iterations
+# episodes.
+
+class RolloutQAgent():
+
+    def __init__(self, alpha, gamma, epsilon, location_to_state, rewards, state_to_location, replicas, Q=None,
+                 limit=100000):
+        """ Initialize alpha, gamma, epsilon, states, actions, rewards, the step limit of an episode and the
+        stacked Q-values of every replica
+        """
+        self.gamma = gamma
+        self.alpha = alpha
+        self.epsilon = epsilon
+        self.limit = limit
+        
+        self.location_to_state = location_to_state
+        self.rewards = rewards
+        self.state_to_location = state_to_location
+        
+        self.replicas = replicas
+        if Q is None:
+            Q = np.zeros([replicas, len(rewards), len(rewards)])
+        self.Q = Q
+    
+    def training(self, start_location, end_location, iterations, random_state=np.random, final_reward=100,
+                 policy="rewards", routes=True):
+        """Walk iterations episodes with every replica, updating Q at each step
+        
+        policy "rewards" takes the greedy step the notebooks take, the argmax of the reward row, and
+        "q" takes the playable action with the highest Q-value of the replica. Random draws come off
+        random_state a step of all walking replicas at a time. limit_hits and steps count the episodes
+        that ran into the limit and the updates of each replica.
+        Returns the greedy route of each replica (None where it never reaches end_location), or None
+        when routes is False.
+        """
+        with instrument.stage("rollout"):
+            rewards_new = np.copy(self.rewards)
+            
+            #set reward for end state to incentivize reaching desired end
+            ending_state = self.location_to_state[end_location]
+            rewards_new[ending_state, ending_state] = final_reward
+            
+            playable = TopologyIndex(rewards_new)
+            greedy = np.argmax(rewards_new, axis=1)
+            size = len(rewards_new)
+            
+            replica_index = np.arange(self.replicas)
+            self.limit_hits = np.zeros(self.replicas, dtype=np.int64)
+            self.steps = np.zeros(self.replicas, dtype=np.int64)
+            dead_ends = 0
+            
+            #every replica starts its first episode on a random state
+            running = np.full(self.replicas, iterations > 0)
+            episodes = np.where(running, 1, 0)
+            current = random_state.randint(0, size, self.replicas)
+            counter = np.zeros(self.replicas, dtype=np.int64)
+            
+            while running.any():
+                r = replica_index[running]
+                state = current[r]
+                counter[r] += 1
+                explore = random_state.random_sample(len(r)) < self.epsilon
+                pick = random_state.random_sample(len(r))
+                
+                #walks that hit the limit or stand on a dead end stop without an update
+                hit = counter[r] == self.limit
+                walking = (playable.degrees[state] > 0) & ~hit
+                w = r[walking]
+                s = state[walking]
+                
+                #Decide whether to random walk or follow the policy
+                if policy == "q":
+                    chosen = np.where(rewards_new[s] > 0, self.Q[w, s], -np.inf).argmax(axis=1)
+                else:
+                    chosen = greedy[s]
+                degrees = playable.degrees[s]
+                sampled = playable.targets[playable.offsets[s] + (pick[walking] * degrees).astype(np.int64)]
+                next_state = np.where(explore[walking], sampled, chosen)
+                
+                #Calculate temporal difference and update Q using the Bellman equation
+                TD = rewards_new[s, next_state] + \
+                        self.gamma * self.Q[w, next_state].max(axis=1) - self.Q[w, s, next_state]
+                self.Q[w, s, next_state] += self.alpha * TD
+                current[w] = next_state
+                self.steps[w] += 1
+                
+                #episodes end on a self loop, a dead end or the limit
+                ended = ~walking
+                ended[walking] = next_state == s
+                self.limit_hits[r[hit]] += 1
+                dead_ends += np.count_nonzero(~walking & ~hit)
+                
+                #start the next episode of every replica that has one left
+                finished = r[ended]
+                done = episodes[finished] >= iterations
+                running[finished[done]] = False
+                restart = finished[~done]
+                episodes[restart] += 1
+                current[restart] = random_state.randint(0, size, len(restart))
+                counter[restart] = 0
+            
+            instrument.count("episodes", episodes.sum())
+            instrument.count("td_updates", self.steps.sum())
+            instrument.count("dead_end_hits", dead_ends)
+            instrument.count("limit_hits", self.limit_hits.sum())
+        
+        #the notebook printed this; a warning keeps it off stdout, where callers write their results
+        if self.limit_hits.any():
+            warnings.warn("Hit limit before reaching an end while training %d times" % self.limit_hits.sum(), RuntimeWarning)
+        
+        if not routes:
+            return None
+        return policy_routes(greedy_successors(self.Q), self.location_to_state, start_location, end_location)
+    
+    def get_optimal_route(self, start_location, end_location, Q):
+        """Follow the best action of Q from start_location, or return None if it never reaches end_location
+        """
+        return policy_routes(greedy_successors(Q[np.newaxis]), self.location_to_state, start_location, end_location)[0]
@@ -0,0 +1,93 @@
+import numpy as np
+
+from mplay import instrument, sparse
+from mplay.aggregate import RunningTable
+from mplay.cache import cache_key, topology_digest
+from mplay.distance import pair_values, pairwise_distances
+from mplay.parallel import parallel_qtables, replica_seed
+from mplay.qbatch import BatchQAgent
+from mplay.solver import exact_qtable
+
+
+# ### Scoring
+# 
+# The MPD_V1 pipeline as functions: train every ending, average the replicas of each one, and score
+# the topology by the mean pairwise Minkowski distance between the averaged tables.
+
+def cache_keys(rewards, location_to_state, final_states, replicas=100, iterations=1000, alpha=0.9, gamma=0.75,
+               seed=0, solver="sampled"):
+    """QCache key of the tables train_endings gives each ending in final_states
+    """
+    digest = topology_digest(rewards)
+    return [cache_key(digest, location_to_state[final_state], replicas=replicas, iterations=iterations, alpha=alpha,
+                      gamma=gamma, seed=seed, solver=solver, number=ending)
+            for ending, final_state in enumerate(final_states)]
+
+def train_endings(rewards, location_to_state, final_states, replicas=100, iterations=1000, alpha=0.9,
+                  gamma=0.75, seed=0, solver="sampled", executor=None, cache=None):
+    """Return a (replicas, N, N) stack of trained q-tables for each ending in final_states
+
+    Replicas are seeded the same way whether they train here or on executor, so the tables do not
+    depend on where they ran. solver "exact" returns the single converged table of each ending.
+    With a QCache, endings trained before with the same rewards and settings are read back instead.
+    """
+    state_to_location = dict((state,location) for location,state in location_to_state.items())
+    
+    qtables = [None] * len(final_states)
+    if cache is not None:
+        keys = cache_keys(rewards, location_to_state, final_states, replicas, iterations, alpha, gamma, seed, solver)
+        for ending in range(len(final_states)):
+            cached = cache.get(keys[ending])
+            if cached is not None:
+                qtables[ending] = cached[0]
+    missing = [ending for ending in range(len(final_states)) if qtables[ending] is None]
+    
+    if solver == "exact":
+        for ending in missing:
+            qtables[ending] = exact_qtable(rewards, location_to_state[final_states[ending]], gamma)[np.newaxis]
+    elif executor is not None and missing:
+        results = parallel_qtables(rewards, location_to_state, state_to_location, [final_states[ending] for ending in missing],
+                                   replicas, iterations, alpha, gamma, seed, executor=executor, routes=False, endings=missing)
+        for ending, (paths_taken, tables) in zip(missing, results):
+            qtables[ending] = tables
+    else:
+        for ending in missing:
+            qagent = BatchQAgent(alpha, gamma, location_to_state, rewards, state_to_location, replicas)
+            qagent.training('Start', final_states[ending], iterations, [replica_seed(seed, ending, r) for r in range(replicas)], routes=False)
+            qtables[ending] = qagent.Q
+    
+    if cache is not None:
+        for ending in missing:
+            cache.put(keys[ending], qtables[ending])
+    return qtables
+
+def meaningfulness(averaged_tables, p_value=1):
+    """Mean pairwise Minkowski distance between averaged tables, nan with fewer than two
+    """
+    if len(averaged_tables) < 2:
+        return float('nan')
+    return float(pair_values(pairwise_distances(averaged_tables, p_value, 3)).mean())
+
+def score_topology(rewards, location_to_state, final_states, p_value=1, **training):
+    """Train every ending and return the meaningfulness score with a RunningTable per ending
+
+    Each RunningTable's mean is the averaged table of that ending.
+    """
+    with instrument.stage("train"):
+        qtables = train_endings(rewards, location_to_state, final_states, **training)
+    with instrument.stage("average"):
+        statistics = [RunningTable().add_all(tables) for tables in qtables]
+    with instrument.stage("score"):
+        return meaningfulness([ending.mean for ending in statistics], p_value), statistics
+
+def score_edge_topology(topology, final_states, p_value=1, **training):
+    """Sparse score_topology: the averaged tables are (edges,) arrays in the topology's layout
+
+    Cells off the edges are 0 in every table, so the score equals the dense one.
+    """
+    with instrument.stage("train"):
+        qtables = sparse.train_endings(topology, final_states, **training)
+    with instrument.stage("average"):
+        statistics = [RunningTable().add_all(tables) for tables in qtables]
+    with instrument.stage("score"):
+        return meaningfulness([ending.mean for ending in statistics], p_value), statistics
@@ -0,0 +1,395 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from mplay.sparse import TRAINING_DEFAULTS
+
+
+# ### Scoring Server
+# 
+# Scores topologies for a long-running tool instead of an interactive MPD_V1 session. The server
+# speaks plain HTTP on a local port or a Unix socket: POST a .txt matrix or draw.io .xml diagram to
+# /score and the response streams one JSON line per event, the progress of every ending and then the
+# meaningfulness score. Training runs on a pool of worker processes started (with NumPy and the
+# scoring code imported) before the first request. Requests for a topology already being scored with
+# the same settings follow that job instead of starting another, recent scores are answered from
+# memory, and small tasks arriving together travel to a worker in one batch.
+# 
+#     python -m mplay.server serve --port 8765 --workers 4
+#     python -m mplay.server score NoIntegrated.xml --port 8765 --replicas 100
+# 
+# Scores are the sparse scoring path's, equal to mplay.score(filename) with the same settings.
+
+#query parameters a request may set, with their types
+SETTINGS = {'replicas': int, 'iterations': int, 'alpha': float, 'gamma': float, 'seed': int, 'solver': str, 'p': float}
+
+#small tasks (replica-iterations times edges, or payload bytes for parsing) are gathered into batches
+#of about this much work, which take long enough to be worth a trip to a worker but short enough that
+#a topology's endings still spread over the pool
+SMALL_COST = 1000000
+
+def _warm():
+    """Worker initializer: import everything a task needs before the first one arrives
+    """
+    import numpy
+    from mplay import aggregate, loaders, scoring, sparse
+
+def _ready():
+    """No-op task that makes the pool start a worker
+    """
+    return os.getpid()
+
+def _run_task(task):
+    """Parse a payload into an EdgeTopology, or train one ending of one and return its averaged edge table
+    """
+    if task[0] == "parse":
+        from mplay.sparse import load_edge_topology
+        kind, payload, suffix = task
+        #the loaders read files, so the payload goes through a temporary one
+        descriptor, path = tempfile.mkstemp(suffix=suffix)
+        try:
+            with os.fdopen(descriptor, 'wb') as payloadFile:
+                payloadFile.write(payload)
+            return load_edge_topology(path)
+        finally:
+            os.remove(path)
+    
+    from mplay.aggregate import RunningTable
+    from mplay.sparse import train_ending
+    kind, topology, final_state, ending, training = task
+    return RunningTable().add_all(train_ending(topology, final_state, ending, **training)).mean
+
+def _run_tasks(tasks):
+    """Run a batch of tasks in one worker, returning each result or the error it raised
+    """
+    results = []
+    for task in tasks:
+        try:
+            results.append((True, _run_task(task)))
+        except Exception as error:
+            results.append((False, repr(error)))
+    return results
+
+def payload_format(payload, name=None):
+    """".xml" or ".txt" for a payload, from its file name when given and from its first character otherwise
+    """
+    if name:
+        return ".xml" if name.lower().endswith(".xml") else ".txt"
+    return ".xml" if payload.lstrip()[:1] == b"<" else ".txt"
+
+class Job():
+
+    def __init__(self):
+        """ Start a job with no events and no listeners
+        """
+        self.events = []
+        self.listeners = []
+    
+    def publish(self, event):
+        """Record an event and pass it to every listener
+        """
+        self.events.append(event)
+        for queue in self.listeners:
+            queue.put_nowait(event)
+    
+    async def follow(self):
+        """Yield every event of the job, those from before the call first, until its last one
+        """
+        queue = asyncio.Queue()
+        for event in self.events:
+            queue.put_nowait(event)
+        self.listeners.append(queue)
+        try:
+            while True:
+                event = await queue.get()
+                yield event
+                if event['event'] in ("score", "error"):
+                    return
+        finally:
+            self.listeners.remove(queue)
+
+class ScoringServer():
+
+    def __init__(self, workers=None, linger=0.005, batch_size=16, small_cost=SMALL_COST, cache_size=256):
+        """ Set up the pool size, how long and how far small tasks are gathered into a batch, and how
+        many finished scores to remember
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.linger = linger
+        self.batch_size = batch_size
+        self.small_cost = small_cost
+        self.cache_size = cache_size
+        
+        self.pool = None
+        self.jobs = {}
+        self.finished = OrderedDict()
+        self.statistics = {'requests': 0, 'coalesced': 0, 'cached': 0, 'tasks': 0, 'batches': 0}
+    
+    async def start(self):
+        """Start the worker pool and wait until every worker has loaded the scoring code
+        """
+        from concurrent.futures import ProcessPoolExecutor
+        
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_warm)
+        self.tasks = asyncio.Queue()
+        self.batcher = asyncio.ensure_future(self._batch_tasks())
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.pool, _ready) for worker in range(self.workers)])
+    
+    async def close(self):
+        """Stop gathering tasks and shut the pool down
+        """
+        self.batcher.cancel()
+        self.pool.shutdown(cancel_futures=True)
+    
+    def _run(self, task, cost=0):
+        """Future of a task's result, queued for the next batch
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.tasks.put_nowait((task, cost, future))
+        return future
+    
+    async def _batch_tasks(self):
+        """Hand queued tasks to the pool, gathering small ones that arrive within linger into one call
+        
+        A batch closes once it holds small_cost of work, so large tasks always travel alone.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.tasks.get()]
+            total = batch[0][1]
+            deadline = loop.time() + self.linger
+            while total < self.small_cost and len(batch) < self.batch_size:
+                try:
+                    item = await asyncio.wait_for(self.tasks.get(), max(0, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+                batch.append(item)
+                total += item[1]
+            self.statistics['batches'] += 1
+            self.statistics['tasks'] += len(batch)
+            asyncio.ensure_future(self._settle(batch, loop.run_in_executor(self.pool, _run_tasks, [task for task, cost, future in batch])))
+    
+    async def _settle(self, batch, results):
+        """Pass the results of a batch on to the futures of its tasks
+        """
+        try:
+            results = await results
+        except Exception as error:
+            results = [(False, repr(error))] * len(batch)
+        for (task, cost, future), (succeeded, result) in zip(batch, results):
+            if future.done():
+                continue
+            if succeeded:
+                future.set_result(result)
+            else:
+                future.set_exception(RuntimeError(result))
+    
+    def score(self, payload, suffix, settings):
+        """Events of scoring a payload: its own job, the running job of an identical request, or a remembered score
+        """
+        self.statistics['requests'] += 1
+        text = json.dumps(settings, sort_keys=True)
+        key = hashlib.sha256(payload + suffix.encode() + text.encode()).hexdigest()
+        if key in self.finished:
+            self.finished.move_to_end(key)
+            self.statistics['cached'] += 1
+            return self._remembered(self.finished[key])
+        if key in self.jobs:
+            self.statistics['coalesced'] += 1
+        else:
+            self.jobs[key] = Job()
+            asyncio.ensure_future(self._score(key, payload, suffix, settings))
+        return self.jobs[key].follow()
+    
+    async def _remembered(self, event):
+        """The one event of a score answered from memory
+        """
+        yield dict(event, cached=True)
+    
+    async def _score(self, key, payload, suffix, settings):
+        """Parse, train every ending on the pool and publish the score
+        """
+        from mplay.scoring import meaningfulness
+        
+        job = self.jobs[key]
+        started = time.time()
+        training = dict((name, value) for name, value in settings.items() if name != 'p')
+        try:
+            topology = await self._run(("parse", payload, suffix), len(payload))
+            job.publish({'event': "parsed", 'states': topology.size, 'endings': len(topology.goals)})
+            
+            cost = len(topology.rewards) * training['replicas'] * training['iterations']
+            futures = [self._run(("train", topology, goal, ending, training), cost) for ending, goal in enumerate(topology.goals)]
+            means = [None] * len(futures)
+            done = 0
+            for finished in asyncio.as_completed([self._numbered(ending, future) for ending, future in enumerate(futures)]):
+                ending, mean = await finished
+                means[ending] = mean
+                done += 1
+                job.publish({'event': "progress", 'ending': topology.goals[ending], 'done': done, 'endings': len(futures)})
+            
+            #fewer than two endings have no pairs to compare; NaN is not JSON, so the score is null
+            score = meaningfulness(means, settings['p'])
+            event = {'event': "score", 'score': None if math.isnan(score) else round(score, 3),
+                     'seconds': round(time.time() - started, 3)}
+            self.finished[key] = event
+            if len(self.finished) > self.cache_size:
+                self.finished.popitem(last=False)
+        except Exception as error:
+            event = {'event': "error", 'error': str(error)}
+        del self.jobs[key]
+        job.publish(event)
+    
+    async def _numbered(self, ending, future):
+        """Result of an ending's task along with the ending
+        """
+        return ending, await future
+    
+    async def handle(self, reader, writer):
+        """Answer one HTTP request: POST /score streams events, GET /status reports the counters
+        """
+        try:
+            request = await reader.readline()
+            method, target, version = request.decode('latin-1').split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, value = line.decode('latin-1').split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+            payload = await reader.readexactly(int(headers.get('content-length', 0)))
+            url = urlsplit(target)
+            query = dict(parse_qsl(url.query))
+            
+            if method == "GET" and url.path == "/status":
+                status = dict(self.statistics, workers=self.workers, running=len(self.jobs), remembered=len(self.finished))
+                await self._respond(writer, 200, [status])
+            elif method == "POST" and url.path == "/score":
+                try:
+                    settings = dict(TRAINING_DEFAULTS, p=1)
+                    settings.update((name, SETTINGS[name](value)) for name, value in query.items() if name in SETTINGS)
+                except ValueError as error:
+                    await self._respond(writer, 400, [{'event': "error", 'error': str(error)}])
+                    return
+                await self._respond(writer, 200, self.score(payload, payload_format(payload, query.get('name')), settings))
+            else:
+                await self._respond(writer, 404, [{'event': "error", 'error': "unknown request " + method + " " + url.path}])
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError) as error:
+            try:
+                await self._respond(writer, 400, [{'event': "error", 'error': repr(error)}])
+            except ConnectionError:
+                pass
+        finally:
+            writer.close()
+    
+    async def _respond(self, writer, status, events):
+        """Write a chunked response of one JSON line per event, flushing each as it comes
+        """
+        reason = {200: "OK", 400: "Bad Request", 404: "Not Found"}[status]
+        writer.write(("HTTP/1.1 %d %s\r\nContent-Type: application/x-ndjson\r\nTransfer-Encoding: chunked\r\n"
+                      "Connection: close\r\n\r\n" % (status, reason)).encode())
+        if hasattr(events, '__aiter__'):
+            async for event in events:
+                await self._chunk(writer, event)
+        else:
+            for event in events:
+                await self._chunk(writer, event)
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+    
+    async def _chunk(self, writer, event):
+        """Write one event as a chunk of its own
+        """
+        line = (json.dumps(event) + "\n").encode()
+        writer.write(b"%x\r\n%s\r\n" % (len(line), line))
+        await writer.drain()
+
+async def serve(host="127.0.0.1", port=8765, path=None, **options):
+    """Run a ScoringServer on a local port, or on a Unix socket when path is given, until cancelled
+    """
+    server = ScoringServer(**options)
+    await server.start()
+    if path is not None:
+        listener = await asyncio.start_unix_server(server.handle, path)
+    else:
+        listener = await asyncio.start_server(server.handle, host, port)
+    print("serving on", path or "%s:%d" % (host, port), "with", server.workers, "workers", flush=True)
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        await server.close()
+
+async def request_score(payload, name=None, host="127.0.0.1", port=8765, path=None, **settings):
+    """Client side of /score: yield each event the server streams back for a payload
+    """
+    if path is not None:
+        reader, writer = await asyncio.open_unix_connection(path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    query = dict(settings, name=name) if name else settings
+    writer.write(("POST /score?%s HTTP/1.1\r\nHost: %s\r\nContent-Length: %d\r\n\r\n"
+                  % (urlencode(query), host, len(payload))).encode() + payload)
+    await writer.drain()
+    try:
+        while (await reader.readline()) not in (b"\r\n", b""):
+            pass
+        while True:
+            size = int((await reader.readline()).strip() or b"0", 16)
+            if size == 0:
+                return
+            line = await reader.readexactly(size + 2)
+            yield json.loads(line[:-2])
+    finally:
+        writer.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve topology scoring over local HTTP, or ask a running server for a score.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for command in ("serve", "score"):
+        subparser = commands.add_parser(command)
+        subparser.add_argument("--host", default="127.0.0.1")
+        subparser.add_argument("--port", type=int, default=8765)
+        subparser.add_argument("--socket", dest="path", help="Unix socket to use instead of a port")
+        if command == "serve":
+            subparser.add_argument("--workers", type=int, help="worker processes, one per core by default")
+            subparser.add_argument("--linger", type=float, default=0.005, help="seconds to gather small tasks into a batch")
+            subparser.add_argument("--batch-size", type=int, default=16)
+        else:
+            subparser.add_argument("filename", help="topology file (.txt matrix or draw.io .xml)")
+            for name, kind in SETTINGS.items():
+                subparser.add_argument("--" + name, type=kind)
+    args = parser.parse_args(argv)
+    
+    if args.command == "serve":
+        try:
+            asyncio.run(serve(args.host, args.port, args.path, workers=args.workers, linger=args.linger,
+                              batch_size=args.batch_size))
+        except KeyboardInterrupt:
+            pass
+        return 0
+    
+    with open(args.filename, 'rb') as topologyFile:
+        payload = topologyFile.read()
+    settings = dict((name, getattr(args, name)) for name in SETTINGS if getattr(args, name) is not None)
+    
+    async def show():
+        async for event in request_score(payload, os.path.basename(args.filename), args.host, args.port, args.path, **settings):
+            print(json.dumps(event), flush=True)
+            if event['event'] == "error":
+                return 1
+        return 0
+    return asyncio.run(show())
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,364 @@
+import argparse
+import json
+import math
+import os
+import numpy as np
+
+from mplay import instrument
+from mplay.distance import minkowski_norm
+from mplay.loaders import load_topology
+from mplay.sparse import normalize
+from mplay.store import find_qtables, load_qtables, select_table
+from mplay.topology import TopologyIndex
+from mplay.weights import weight_calculator, weight_layers
+
+
+# ### Similarity Index
+# 
+# Finds the stored averaged tables closest to a new one under the Minkowski distance of
+# MinkowskiDistance.py, over a whole corpus instead of two workbooks at a time. Tables are flattened
+# shell by shell (every cell whose row or column is k comes after those of smaller k), so a table of n
+# states is the first n * n entries of the vector of any larger one, and tables of different sizes
+# line up state by state with the missing cells at 0, as if padded to the largest size. Stored vectors
+# keep their L1 and squared L2 norms: p=2 distances come from one matrix product with the query, and
+# p=1 skips blocks of tables whose difference in L1 norm already rules them out. The approximate mode
+# compares random projections of the vectors first and computes exact distances only for the best
+# few candidates.
+# 
+# Stored averaged tables are raw Q-values, so the command line first turns them into the vectors the
+# score compares: every row weighted by its layer, as layer_weights does in MPD_V1, and the positive
+# values softmax normalized, as the V5 notebook did. The weighting needs the topology of each stack,
+# which is the file the stack was saved after unless --topology names it. An index keeps the settings
+# it was built with, and queries use them.
+# 
+#     python -m mplay.similarity add corpus.index NoIntegrated.txt split.txt
+#     python -m mplay.similarity query corpus.index TopNonIntegrated.txt --table E1 --k 5 --p 2
+
+#rows of stored vectors to difference against the query in one block
+BLOCK_ROWS = 1024
+
+#length of the random projections the approximate mode compares
+SKETCH_SIZE = 32
+
+#how the command line turns stored tables into vectors, unless an index was built otherwise
+SCORING_DEFAULTS = {'layer_weights': "calculator", 'normalize': "global"}
+
+_shells = {}
+
+def shell_indices(size):
+    """(rows, columns) of the cells of a size x size table in shell order
+    """
+    if size not in _shells:
+        rows, columns = [], []
+        for k in range(size):
+            rows += [k] * (k + 1) + list(range(k))
+            columns += list(range(k + 1)) + [k] * k
+        _shells[size] = np.array(rows, dtype=np.int64), np.array(columns, dtype=np.int64)
+    return _shells[size]
+
+def shell_vector(table):
+    """Flatten a square table, or the vectorize output of one, in shell order
+    """
+    table = np.asarray(table, dtype=np.float64)
+    if table.ndim == 1:
+        size = int(round(np.sqrt(len(table))))
+        if size * size != len(table):
+            raise ValueError("a vector of %d values is not a square table" % len(table))
+        table = table.reshape(size, size)
+    if table.ndim != 2 or table.shape[0] != table.shape[1]:
+        raise ValueError("tables must be square, not %r" % (table.shape,))
+    return table[shell_indices(len(table))]
+
+def projection_rows(first, last, sketch_size=SKETCH_SIZE, seed=0):
+    """Rows first..last-1 of the random projection, the same whatever width they are drawn for
+    
+    Each shell draws its rows from a generator of its own, so widening the index never changes the
+    rows, and the sketches, of the shells it already had.
+    """
+    blocks = []
+    k = math.isqrt(first)
+    while k * k < last:
+        block = np.random.RandomState([seed, k]).standard_normal((2 * k + 1, sketch_size)) / np.sqrt(sketch_size)
+        blocks.append(block[max(first, k * k) - k * k:min(last, (k + 1) * (k + 1)) - k * k])
+        k += 1
+    return np.concatenate(blocks) if blocks else np.zeros((0, sketch_size))
+
+def minkowski_rows(vectors, query, p_value):
+    """Minkowski distance from every row of vectors to query, a block of rows at a time
+    """
+    distances = np.empty(len(vectors))
+    for start in range(0, len(vectors), BLOCK_ROWS):
+        distances[start:start + BLOCK_ROWS] = minkowski_norm(np.abs(vectors[start:start + BLOCK_ROWS] - query), p_value)
+    return distances
+
+def layer_weight_function(text):
+    """layer_weights of MPD_V1 from a command line value: "none", "calculator" for the reversed
+    weight_calculator of the V5 notebook, or the comma separated weights of the layers from Start on
+    """
+    if text == "none":
+        return None
+    if text == "calculator":
+        return lambda layers: weight_calculator(layers)[::-1]
+    return [float(weight) for weight in text.split(",")]
+
+def scoring_tables(tables, rewards, location_to_state, layer_weights="calculator", normalize_mode="global"):
+    """Weight and normalize a (tables, N, N) stack of averaged tables the way the score compares them
+    
+    layer_weights is a layer_weight_function value and normalize_mode "none", "global" (over every
+    positive value of a table) or "state" (over each state's actions).
+    """
+    tables = np.array(tables, dtype=np.float64)
+    weights = layer_weight_function(layer_weights)
+    if weights is not None:
+        tables = weight_layers(tables, rewards, location_to_state['Start'], weights)
+    if normalize_mode == "none":
+        return tables
+    
+    #every action plus the self loops, the only cells a trained table can be positive in
+    size = len(rewards)
+    adjacency = np.asarray(rewards) > 0
+    sources, targets = np.nonzero(adjacency)
+    index = TopologyIndex.from_edges(size, np.concatenate([sources, np.arange(size)]), np.concatenate([targets, np.arange(size)]))
+    normalized = np.zeros_like(tables)
+    normalized[:, index.sources, index.targets] = normalize(tables[:, index.sources, index.targets], index,
+                                                            per_state=normalize_mode == "state")
+    return normalized
+
+class SimilarityIndex():
+
+    def __init__(self, sketch_size=SKETCH_SIZE, seed=0, scoring=None):
+        """ Start an empty index; scoring records how the stored tables were weighted and normalized
+        """
+        self.sketch_size = sketch_size
+        self.seed = seed
+        self.scoring = dict(SCORING_DEFAULTS if scoring is None else scoring)
+        self.width = 0
+        self.labels = []
+        self.sizes = []
+        self.vectors = np.zeros((0, 0))
+        self.norms = np.zeros(0)
+        self.squares = np.zeros(0)
+        self.sketches = np.zeros((0, sketch_size))
+        self.projection = np.zeros((0, sketch_size))
+        #tables added since the arrays were last rebuilt
+        self._pending = []
+    
+    def __len__(self):
+        return len(self.labels)
+    
+    def add(self, label, table):
+        """Store a table, or the vectorize output of one, under label
+        """
+        vector = shell_vector(table)
+        self.labels.append(label)
+        self.sizes.append(int(round(np.sqrt(len(vector)))))
+        self._pending.append(vector)
+    
+    def add_all(self, labels, tables):
+        """Store every table of a stack under the matching label
+        """
+        for label, table in zip(labels, tables):
+            self.add(label, table)
+        return self
+    
+    def _flush(self):
+        """Fold the pending tables into the stored arrays, widening them if a table is larger
+        """
+        if not self._pending:
+            return
+        width = max([self.width] + [len(vector) for vector in self._pending])
+        if width > self.width:
+            #older vectors are 0 in the new cells and their projection rows only grow
+            self.vectors = np.pad(self.vectors, ((0, 0), (0, width - self.width)))
+            self.projection = np.concatenate([self.projection, projection_rows(self.width, width, self.sketch_size, self.seed)])
+            self.width = width
+        
+        added = np.zeros((len(self._pending), self.width))
+        for row, vector in enumerate(self._pending):
+            added[row, :len(vector)] = vector
+        self.vectors = np.concatenate([self.vectors, added])
+        self.norms = np.concatenate([self.norms, np.abs(added).sum(axis=1)])
+        self.squares = np.concatenate([self.squares, np.einsum('ij,ij->i', added, added)])
+        self.sketches = np.concatenate([self.sketches, added @ self.projection])
+        self._pending = []
+    
+    def _query_vector(self, table):
+        """Query vector cut or padded to the stored width, with the values past the width apart
+        """
+        vector = shell_vector(table)
+        common = np.zeros(self.width)
+        common[:min(len(vector), self.width)] = vector[:self.width]
+        return common, vector[self.width:]
+    
+    def query(self, table, k=5, p_value=1, approximate=False, candidates=10):
+        """The k stored tables nearest to table as (label, distance) pairs, nearest first
+        
+        p_value is the Minkowski p, as in MinkowskiDistance.py. approximate ranks the tables by
+        their random projections and computes exact distances for the best k * candidates only, so
+        it can miss a neighbour whose projection lands further away than those of others.
+        """
+        with instrument.stage("similarity"):
+            self._flush()
+            if len(self) == 0 or k <= 0:
+                return []
+            query, extra = self._query_vector(table)
+            
+            if approximate:
+                sketch = query @ self.projection
+                close = np.einsum('ij,ij->i', self.sketches, self.sketches) - 2 * (self.sketches @ sketch)
+                rows = np.argpartition(close, min(len(close), k * candidates) - 1)[:k * candidates]
+                distances = minkowski_rows(self.vectors[rows], query, p_value)
+            elif p_value == 2:
+                rows, distances = self._nearest_euclidean(query, k)
+            elif p_value == 1:
+                rows, distances = self._nearest_manhattan(query, k)
+            else:
+                rows = np.arange(len(self))
+                distances = minkowski_rows(self.vectors, query, p_value)
+            instrument.count("similarity_distances", len(distances))
+            
+            #values of a query larger than every stored table differ from stored zeros
+            if len(extra) > 0:
+                if p_value == np.inf:
+                    distances = np.maximum(distances, np.abs(extra).max())
+                else:
+                    distances = np.power(np.power(distances, p_value) + np.power(np.abs(extra), p_value).sum(), 1 / p_value)
+            
+            order = np.lexsort((rows, distances))[:k]
+            return [(self.labels[rows[i]], float(distances[i])) for i in order]
+    
+    def _nearest_euclidean(self, query, k):
+        """Rows and p=2 distances of about the k nearest tables, from the stored squared norms
+        """
+        squared = np.empty(len(self))
+        for start in range(0, len(self), BLOCK_ROWS):
+            squared[start:start + BLOCK_ROWS] = self.squares[start:start + BLOCK_ROWS] - 2 * (self.vectors[start:start + BLOCK_ROWS] @ query)
+        squared += query @ query
+        
+        #the expansion loses digits to cancellation, so rank a few extra and measure those directly
+        rows = np.argpartition(squared, min(len(self), 2 * k) - 1)[:2 * k]
+        return rows, minkowski_rows(self.vectors[rows], query, 2)
+    
+    def _nearest_manhattan(self, query, k):
+        """Rows and p=1 distances of the k nearest tables, skipping blocks the L1 norms rule out
+        
+        | |x|_1 - |q|_1 | is at most the distance between x and q, so once the k-th best distance is
+        below the bound of the next block in bound order, no later table can beat it.
+        """
+        bounds = np.abs(self.norms - np.abs(query).sum())
+        order = np.argsort(bounds, kind='stable')
+        rows, distances = np.zeros(0, dtype=np.int64), np.zeros(0)
+        for start in range(0, len(order), BLOCK_ROWS):
+            if len(distances) >= k and bounds[order[start]] > np.partition(distances, k - 1)[k - 1]:
+                break
+            block = order[start:start + BLOCK_ROWS]
+            rows = np.concatenate([rows, block])
+            distances = np.concatenate([distances, minkowski_rows(self.vectors[block], query, 1)])
+        return rows, distances
+    
+    def save(self, directory):
+        """Write the index to a directory, replacing each file only once its new version is complete
+        """
+        self._flush()
+        os.makedirs(directory, exist_ok=True)
+        header = {'labels': self.labels, 'sizes': self.sizes, 'width': self.width, 'sketch_size': self.sketch_size,
+                  'seed': self.seed, 'scoring': self.scoring}
+        for name, values in (('vectors.npy', self.vectors), ('sketches.npy', self.sketches)):
+            temporary = os.path.join(directory, name + '.tmp')
+            with open(temporary, 'wb') as arrayFile:
+                np.save(arrayFile, values)
+            os.replace(temporary, os.path.join(directory, name))
+        temporary = os.path.join(directory, 'index.json.tmp')
+        with open(temporary, 'w') as headerFile:
+            json.dump(header, headerFile)
+        os.replace(temporary, os.path.join(directory, 'index.json'))
+    
+    @classmethod
+    def load(cls, directory):
+        """Read an index written by save; the norms are recomputed rather than stored
+        """
+        with open(os.path.join(directory, 'index.json')) as headerFile:
+            header = json.load(headerFile)
+        #indexes from before the scoring settings held raw tables
+        index = cls(header['sketch_size'], header['seed'], header.get('scoring', {'layer_weights': "none", 'normalize': "none"}))
+        index.labels, index.sizes, index.width = header['labels'], header['sizes'], header['width']
+        index.vectors = np.load(os.path.join(directory, 'vectors.npy'))
+        index.sketches = np.load(os.path.join(directory, 'sketches.npy'))
+        index.norms = np.abs(index.vectors).sum(axis=1)
+        index.squares = np.einsum('ij,ij->i', index.vectors, index.vectors)
+        index.projection = projection_rows(0, index.width, index.sketch_size, index.seed)
+        return index
+
+def stored_tables(name):
+    """Tables and header of a stored stack, given its path or the basename it was saved under
+    """
+    path = find_qtables(name) or name
+    return load_qtables(path, mmap=False)
+
+def stack_topology(name, topology=None):
+    """Reward matrix and location_to_state of a stack: the topology file if given, else the file the
+    stack was saved after, as MPD_V1 names its averaged tables
+    """
+    if topology is None:
+        topology = name[:-len('.npy')] if name.endswith(('.npy', '.npz')) else name
+        if not os.path.exists(topology):
+            raise ValueError("no topology file for " + name + "; give it with --topology")
+    return load_topology(topology)
+
+def scoring_stack(name, scoring, topology=None):
+    """Tables of a stored stack made into scoring tables, with the header of the stack
+    """
+    tables, header = stored_tables(name)
+    if scoring['layer_weights'] == "none" and scoring['normalize'] == "none":
+        return tables, header
+    rewards, location_to_state = stack_topology(name, topology)
+    if len(rewards) != tables.shape[-1]:
+        raise ValueError("%s has %d states but its tables have %d" % (topology or name, len(rewards), tables.shape[-1]))
+    return scoring_tables(tables, rewards, location_to_state, scoring['layer_weights'], scoring['normalize']), header
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Keep an index of averaged q-tables and find the nearest ones to a new table.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    add = commands.add_parser("add", help="store every table of some averaged stacks")
+    add.add_argument("index", help="index directory, created if needed")
+    add.add_argument("stacks", nargs="+", help="stored stacks, by path or by the basename they were saved under")
+    add.add_argument("--layer-weights", default=SCORING_DEFAULTS['layer_weights'],
+                     help='weights of the layers from Start on, "calculator" (the V5 notebook) or "none"; only for a new index')
+    add.add_argument("--normalize", choices=["global", "state", "none"], default=SCORING_DEFAULTS['normalize'],
+                     help="softmax over each table's positive values, over each state's, or none; only for a new index")
+    query = commands.add_parser("query", help="list the stored tables nearest to one table of a stack")
+    query.add_argument("index", help="index directory")
+    query.add_argument("stack", help="stored stack holding the table to look up")
+    query.add_argument("--table", help="position or name of the table in the stack, or mean; needed when it holds several")
+    query.add_argument("--k", type=int, default=5)
+    query.add_argument("--p", type=float, default=1, dest="p_value", help="Minkowski p")
+    query.add_argument("--approximate", action="store_true", help="rank by random projections first")
+    for command in (add, query):
+        command.add_argument("--topology", help="topology file of the stacks, by default the file each was saved after")
+    args = parser.parse_args(argv)
+    
+    exists = os.path.exists(os.path.join(args.index, 'index.json'))
+    if args.command == "query" and not exists:
+        parser.error("no index in " + args.index)
+    try:
+        if args.command == "add":
+            if exists:
+                index = SimilarityIndex.load(args.index)
+            else:
+                index = SimilarityIndex(scoring={'layer_weights': args.layer_weights, 'normalize': args.normalize})
+            for stack in args.stacks:
+                tables, header = scoring_stack(stack, index.scoring, args.topology)
+                names = header.get('tables') or [str(position) for position in range(len(tables))]
+                index.add_all([stack + '#' + name for name in names], tables)
+            index.save(args.index)
+            print(len(index), "tables")
+        else:
+            index = SimilarityIndex.load(args.index)
+            tables, header = scoring_stack(args.stack, index.scoring, args.topology)
+            for label, distance in index.query(select_table(tables, header, args.table), args.k, args.p_value, args.approximate):
+                print(label, round(distance, 3))
+    except ValueError as error:
+        parser.error(str(error))
+
+if __name__ == "__main__":
+    main()
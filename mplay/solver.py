@@ -0,0 +1,110 @@
+import numpy as np
+
+from mplay import instrument
+from mplay.topology import TopologyIndex
+
+
+# ### Exact Solver
+# 
+# The topologies we score are small deterministic graphs, so the table that QAgent.training approaches
+# after many random updates can be computed directly. Every playable action converges to
+# Q[s, a] = reward[s, a] + gamma * max(Q[a,]), which we solve over the playable edges only.
+
+def exact_qtable(rewards, ending_state, gamma, method="dag", tolerance=1e-12, final_reward=999):
+    """Return the converged Q-table for reaching ending_state
+
+    method "dag" solves the graph in reverse topological order and falls back to value iteration when
+    the graph has cycles other than self loops. method "iteration" always runs synchronous Bellman
+    backups until no value moves by more than tolerance.
+    """
+    rewards_new = np.copy(rewards)
+    
+    #set reward for end state to incentivize reaching desired end
+    rewards_new[ending_state, ending_state] = final_reward
+    
+    index = TopologyIndex(rewards_new)
+    Q = np.zeros([index.size, index.size])
+    Q[index.sources, index.targets] = exact_edge_values(index, rewards_new[index.sources, index.targets], gamma, method, tolerance)
+    return Q
+
+def exact_edge_values(index, edge_rewards, gamma, method="dag", tolerance=1e-12, edge_values=None, solved=None):
+    """Converged Q-value of every playable edge of index, given the reward of each edge
+
+    edge_values warm-starts the solve from earlier values. States marked in solved keep the values
+    their edges already have, which is only right if nothing they can reach has changed.
+    """
+    edge_rewards = np.asarray(edge_rewards, dtype=float)
+    warm = edge_values
+    edge_values = None
+    with instrument.stage("exact"):
+        if method == "dag":
+            edge_values = solve_dag(index, edge_rewards, gamma, warm, solved)
+        if edge_values is None:
+            instrument.count("value_iterations")
+            edge_values = value_iteration(index, edge_rewards, gamma, tolerance, edge_values=warm)
+        instrument.count("edges", len(edge_rewards))
+    return edge_values
+
+def state_values(index, edge_values):
+    """Best Q-value of each state, zero for states with no playable actions
+    """
+    values = np.zeros(index.size)
+    if len(index.active) > 0:
+        values[index.active] = np.maximum.reduceat(edge_values, index.offsets[index.active])
+    return values
+
+def value_iteration(index, edge_rewards, gamma, tolerance, max_sweeps=100000, edge_values=None):
+    """Synchronous Bellman backups over the playable edges until the table stops moving
+
+    Starts from edge_values when given, which converges to the same table in fewer sweeps.
+    """
+    edge_values = np.zeros(len(edge_rewards)) if edge_values is None else np.array(edge_values, dtype=float)
+    for sweep in range(max_sweeps):
+        updated = edge_rewards + gamma * state_values(index, edge_values)[index.targets]
+        delta = np.abs(updated - edge_values).max(initial=0)
+        edge_values = updated
+        if delta <= tolerance:
+            break
+    
+    return edge_values
+
+def solve_dag(index, edge_rewards, gamma, edge_values=None, solved=None):
+    """Solve layer by layer from the dead ends back to the start, or return None if the graph has a cycle
+
+    Self loops are solved in closed form: a looping state is worth the larger of its best other action
+    and reward / (1 - gamma) from taking the loop forever. States marked in solved keep their values
+    from edge_values, so only the rest of the graph is solved.
+    """
+    sources = index.sources
+    self_loops = sources == index.targets
+    if solved is None:
+        edge_values = np.zeros(len(edge_rewards))
+        values = np.zeros(index.size)
+        solved = np.zeros(index.size, dtype=bool)
+    else:
+        edge_values = np.array(edge_values, dtype=float)
+        values = np.where(solved, np.maximum(state_values(index, edge_values), 0), 0.0)
+        solved = np.array(solved, dtype=bool)
+    
+    while not solved.all():
+        #a state is ready once every state it can move to (other than itself) is solved
+        waiting = ~self_loops & ~solved[index.targets]
+        ready = ~solved & (np.bincount(sources[waiting], minlength=index.size) == 0)
+        if not ready.any():
+            return None
+        
+        edges = ready[sources]
+        moves = edges & ~self_loops
+        loops = edges & self_loops
+        edge_values[moves] = edge_rewards[moves] + gamma * values[index.targets[moves]]
+        
+        #best action that leaves the state, then let any self loop compete with it
+        best = np.zeros(index.size)
+        np.maximum.at(best, sources[moves], edge_values[moves])
+        np.maximum.at(best, sources[loops], edge_rewards[loops] / (1 - gamma))
+        edge_values[loops] = edge_rewards[loops] + gamma * best[sources[loops]]
+        
+        values[ready] = best[ready]
+        solved |= ready
+    
+    return edge_values
@@ -0,0 +1,271 @@
+import numpy as np
+
+from mplay import instrument
+from mplay.cache import cache_key, topology_digest
+from mplay.loaders import ending_names, load_matrix, parse_drawio
+from mplay.parallel import replica_seed
+from mplay.qbatch import sample_edges
+from mplay.solver import exact_edge_values
+from mplay.topology import TopologyIndex
+
+
+# ### Sparse Q-Values
+# 
+# Keeps Q-values only on the edges of a topology instead of in N x N tables. Every table of a
+# topology shares one edge layout (its CSR index plus the self loop of each goal state), so a
+# stack of tables is a (tables, edges) array and memory and time scale with the number of edges.
+
+class EdgeTopology():
+    
+    def __init__(self, index, location_to_state, edge_rewards=None, goals=None):
+        """ Lay out the edges of index plus a self loop on every goal state (the endings by default)
+        """
+        if goals is None:
+            goals = ending_names(location_to_state)
+        goal_states = np.array([location_to_state[goal] for goal in goals], dtype=np.int64)
+        
+        self.location_to_state = location_to_state
+        self.goals = list(goals)
+        self.index = TopologyIndex.from_edges(index.size, np.concatenate([index.sources, goal_states]),
+                                              np.concatenate([index.targets, goal_states]))
+        self.size = self.index.size
+        
+        #reward of every layout edge; goal self loops that are not real connections start at 0
+        self.rewards = np.zeros(len(self.index.targets))
+        self.rewards[self.index.edge_ids(index.sources, index.targets)] = 1 if edge_rewards is None else edge_rewards
+    
+    @classmethod
+    def from_dense(cls, rewards, location_to_state, goals=None):
+        """Edge layout of a dense reward matrix
+        """
+        index = TopologyIndex(rewards)
+        return cls(index, location_to_state, np.asarray(rewards)[index.sources, index.targets], goals)
+    
+    def ending_rewards(self, end_location, final_reward=999):
+        """Edge rewards with the goal self loop of end_location set to final_reward
+        """
+        rewards_new = self.rewards.copy()
+        ending_state = self.location_to_state[end_location]
+        rewards_new[self.index.edge_ids([ending_state], [ending_state])] = final_reward
+        return rewards_new
+    
+    def to_dense(self, values):
+        """Scatter (..., edges) values into (..., N, N) tables
+        """
+        values = np.asarray(values)
+        dense = np.zeros(values.shape[:-1] + (self.size, self.size))
+        dense[..., self.index.sources, self.index.targets] = values
+        return dense
+    
+    def edge_values(self, tables):
+        """Gather the layout edges out of (..., N, N) tables
+        """
+        return np.asarray(tables)[..., self.index.sources, self.index.targets]
+
+class SparseQAgent():
+    
+    def __init__(self, alpha, gamma, topology, replicas, Q=None):
+        """ Initialize alpha, gamma, the edge topology and the edge Q-values of every replica
+        """
+        self.gamma = gamma
+        self.alpha = alpha
+        
+        self.topology = topology
+        self.replicas = replicas
+        if Q is None:
+            Q = np.zeros([replicas, len(topology.index.targets)])
+        self.Q = Q
+    
+    def training(self, end_location, iterations, random_state=np.random, final_reward=999, observed=None):
+        """Train every replica to reach end_location, updating Q on edges only
+
+        Draws the same transitions as BatchQAgent.training, so the edge values equal the matching
+        cells of the dense tables. observed limits the states whose edges are updated.
+        """
+        with instrument.stage("training"):
+            rewards_new = self.topology.ending_rewards(end_location, final_reward)
+            playable_ids, playable = playable_edges(self.topology.index, rewards_new)
+            states, edges = sample_edges(playable, self.replicas, iterations, random_state, observed)
+            self.update_edges(edges, rewards_new, playable_ids, playable)
+    
+    def update_edges(self, edges, rewards_new, playable_ids, playable):
+        """Apply the sampled updates of every iteration in turn
+        
+        edges is an (iterations, k * replicas) array of positions in playable, column c updating
+        replica c % replicas, with -1 where the observed state had no playable actions.
+        """
+        index = self.topology.index
+        
+        #best Q-value of each state for each replica. Cells off the edges hold 0 in a dense table,
+        #so a state's value never drops below 0 unless every action is playable
+        values = self.state_values()
+        floor = np.where(playable.degrees < self.topology.size, 0.0, -np.inf)
+        replica_index = np.tile(np.arange(self.replicas), edges.shape[1] // self.replicas)
+        td_updates = 0
+        
+        for i in range(len(edges)):
+            live = edges[i] >= 0
+            r = replica_index[live]
+            td_updates += len(r)
+            edge = playable_ids[edges[i, live]]
+            current_state = index.sources[edge]
+            next_state = index.targets[edge]
+            
+            #Calculate temporal difference and update Q using the Bellman equation
+            old = self.Q[r, edge]
+            TD = rewards_new[edge] + self.gamma * values[r, next_state] - old
+            new = old + self.alpha * TD
+            self.Q[r, edge] = new
+            
+            #keep the state values current without rescanning whole rows
+            values[r, current_state] = np.maximum(values[r, current_state], new)
+            dropped = (new < old) & (old == values[r, current_state])
+            for replica, state in zip(r[dropped], current_state[dropped]):
+                values[replica, state] = max(floor[state], self.Q[replica, index.offsets[state]:index.offsets[state + 1]].max())
+        
+        instrument.count("iterations", len(edges) * self.replicas)
+        instrument.count("td_updates", td_updates)
+        instrument.count("dead_end_hits", edges.size - td_updates)
+    
+    def state_values(self):
+        """(replicas, N) array of the best Q-value of every state, counting cells off the edges as 0
+        """
+        index = self.topology.index
+        values = np.zeros([self.replicas, index.size])
+        if len(index.active) > 0:
+            values[:, index.active] = np.maximum(0, np.maximum.reduceat(self.Q, index.offsets[index.active], axis=1))
+        return values
+
+def playable_edges(index, rewards):
+    """Layout positions of the edges with a positive reward, and a TopologyIndex over just those
+    """
+    playable_ids = np.flatnonzero(rewards > 0)
+    return playable_ids, TopologyIndex.from_edges(index.size, index.sources[playable_ids], index.targets[playable_ids])
+
+def load_edge_topology(filename, layout=EdgeTopology):
+    """Read a topology file straight into an EdgeTopology, or another layout built the same way
+
+    draw.io diagrams never go through a dense matrix; .txt files are dense to begin with.
+    """
+    if filename.lower().endswith(".xml"):
+        index, location_to_state = parse_drawio(filename)
+        return layout(index, location_to_state)
+    rewards, location_to_state = load_matrix(filename)
+    return layout.from_dense(rewards, location_to_state)
+
+#settings of train_ending when none are given
+TRAINING_DEFAULTS = {'replicas': 100, 'iterations': 1000, 'alpha': 0.9, 'gamma': 0.75, 'seed': 0, 'solver': "sampled"}
+
+def train_ending(topology, final_state, ending, replicas=100, iterations=1000, alpha=0.9, gamma=0.75,
+                 seed=0, solver="sampled"):
+    """(replicas, edges) Q-values for one ending, seeded like scoring.train_endings
+    """
+    if solver == "exact":
+        return exact_edge_table(topology, final_state, gamma)[np.newaxis]
+    
+    qagent = SparseQAgent(alpha, gamma, topology, replicas)
+    qagent.training(final_state, iterations, [replica_seed(seed, ending, r) for r in range(replicas)])
+    return qagent.Q
+
+def _train_ending(job):
+    """Worker entry point for train_ending, or the trainer the job names
+    """
+    train, topology, final_state, ending, training = job
+    return train(topology, final_state, ending, **training)
+
+def cache_keys(topology, final_states, **training):
+    """QCache key of the tables train_ending gives each ending in final_states
+    """
+    digest = topology_digest(topology)
+    #key on every setting, so passing a default explicitly still hits
+    settings = dict(TRAINING_DEFAULTS, **training)
+    return [cache_key(digest, topology.location_to_state[final_state], number=ending, **settings)
+            for ending, final_state in enumerate(final_states)]
+
+def train_endings(topology, final_states, executor=None, cache=None, train=train_ending, **training):
+    """Edge Q-values of every ending in final_states, optionally one ending per worker
+
+    With a QCache, endings trained before with the same topology and settings are read back instead.
+    train is called like train_ending for every ending that is not.
+    """
+    qtables = [None] * len(final_states)
+    if cache is not None:
+        keys = cache_keys(topology, final_states, **training)
+        for ending in range(len(final_states)):
+            cached = cache.get(keys[ending])
+            if cached is not None:
+                qtables[ending] = cached[0]
+    
+    jobs = [(train, topology, final_states[ending], ending, training) for ending in range(len(final_states)) if qtables[ending] is None]
+    results = executor.map(_train_ending, jobs) if executor is not None else map(_train_ending, jobs)
+    for job, tables in zip(jobs, results):
+        ending = job[3]
+        qtables[ending] = tables
+        if cache is not None:
+            cache.put(keys[ending], tables)
+    return qtables
+
+def exact_edge_table(topology, end_location, gamma, final_reward=999, method="dag", warm=None, solved=None):
+    """Converged edge Q-values for reaching end_location, laid out like SparseQAgent.Q
+
+    warm holds earlier edge values to start from; states marked in solved keep theirs and only the
+    rest of the graph is solved again.
+    """
+    rewards_new = topology.ending_rewards(end_location, final_reward)
+    playable_ids, playable = playable_edges(topology.index, rewards_new)
+    
+    values = np.zeros(len(rewards_new))
+    values[playable_ids] = exact_edge_values(playable, rewards_new[playable_ids], gamma, method,
+                                             edge_values=None if warm is None else warm[playable_ids], solved=solved)
+    return values
+
+def weight_states(values, topology, state_weights, zero_loops=True):
+    """Scale every edge value by the weight of the state it leaves
+
+    zero_loops first clears the self loop edges, as weights.weight_tables does for dense tables.
+    """
+    index = topology.index
+    values = np.array(values, dtype=float)
+    if zero_loops:
+        values[..., index.sources == index.targets] = 0
+    return values * np.asarray(state_weights)[index.sources]
+
+def softmax_positive(values):
+    """Softmax over the positive values of each table, leaving the rest untouched
+
+    Works on a single (edges,) table or a (tables, edges) stack.
+    """
+    values = np.array(values, dtype=float)
+    positive = values > 0
+    top = np.where(positive, values, 0).max(axis=-1, keepdims=True, initial=0)
+    exponent = np.where(positive, np.exp(np.where(positive, values, top) - top), 0)
+    total = exponent.sum(axis=-1, keepdims=True)
+    return np.where(positive, exponent / np.where(total > 0, total, 1), values)
+
+def softmax_segments(values, index):
+    """Softmax over the positive values of each state's edges, leaving the rest untouched
+    
+    values is a single (edges,) table or a (tables, edges) stack laid out on index, the layout of an
+    EdgeTopology, so every ending is normalized in one pass. Each state's values are shifted by
+    their own largest before exponentiating, so large Q-values never overflow.
+    """
+    values = np.array(values, dtype=float)
+    if len(index.active) == 0:
+        return values
+    positive = values > 0
+    starts = index.offsets[index.active]
+    #position among the active states of the state every edge leaves
+    owner = np.repeat(np.arange(len(index.active)), index.degrees[index.active])
+    
+    top = np.maximum.reduceat(np.where(positive, values, 0), starts, axis=-1)[..., owner]
+    exponent = np.where(positive, np.exp(np.where(positive, values, top) - top), 0)
+    total = np.add.reduceat(exponent, starts, axis=-1)[..., owner]
+    return np.where(positive, exponent / np.where(total > 0, total, 1), values)
+
+def normalize(values, index=None, per_state=False):
+    """Softmax normalization of edge values, over every positive value of each table as the notebooks
+    did, or over each state's own edges when per_state is set (which needs the layout's index)
+    """
+    if per_state:
+        return softmax_segments(values, index)
+    return softmax_positive(values)
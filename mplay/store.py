@@ -0,0 +1,181 @@
+import json
+import os
+import sys
+import numpy as np
+
+from mplay.aggregate import qaverage
+
+
+# ### Q-Table Store
+# 
+# Native output for stacks of q-tables. A stack is saved either as a raw .npy file with a small .json
+# header next to it, which loads memory-mapped without copying, or as one compressed .npz file.
+# StackWriter fills a .npy stack a batch at a time, so a run never has to hold all its tables. Excel
+# workbooks can still be made from a stored stack when someone wants to look at them.
+
+def state_names(location_to_state):
+    """Location names in state order
+    """
+    return [location for location, state in sorted(location_to_state.items(), key=lambda item: item[1])]
+
+def save_qtables(basename, qtables, location_to_state, paths_taken=None, compressed=False, names=None):
+    """Save a (tables, N, N) stack as basename.npy + basename.json, or basename.npz when compressed
+
+    names labels each table (the ending of each averaged table, say) so one can be picked by name.
+    Returns the path of the file holding the tables.
+    """
+    qtables = np.asarray(qtables, dtype=np.float64)
+    header = {'states': state_names(location_to_state), 'shape': list(qtables.shape), 'paths_taken': paths_taken}
+    if names is not None:
+        header['tables'] = list(names)
+    
+    if compressed:
+        np.savez_compressed(basename + '.npz', qtables=qtables, header=np.array(json.dumps(header)))
+        return basename + '.npz'
+    
+    np.save(basename + '.npy', qtables)
+    with open(basename + '.json', 'w') as headerFile:
+        json.dump(header, headerFile)
+    return basename + '.npy'
+
+class StackWriter():
+    
+    def __init__(self, basename, location_to_state, capacity):
+        """ Get ready to write up to capacity tables to basename.npy, a batch at a time
+        """
+        self.basename = basename
+        self.location_to_state = location_to_state
+        self.capacity = capacity
+        self.count = 0
+        self.tables = None
+    
+    def add_all(self, tables):
+        """Write a (tables, N, N) stack after the tables written so far
+        """
+        tables = np.asarray(tables, dtype=np.float64)
+        if self.tables is None:
+            self.tables = np.lib.format.open_memmap(self.basename + '.npy', mode='w+', dtype=np.float64,
+                                                    shape=(self.capacity,) + tables.shape[1:])
+        self.tables[self.count:self.count + len(tables)] = tables
+        self.count += len(tables)
+    
+    def close(self, paths_taken=None):
+        """Finish basename.npy with the tables written so far plus its .json header, and return the stored stack
+        """
+        path = self.basename + '.npy'
+        shape = (self.count,) + self.tables.shape[1:]
+        self.tables.flush()
+        self.tables = None
+        
+        #fewer tables than there was room for: shorten the first axis of the header in place, which
+        #numpy pads for, and drop the unused rows
+        if self.count < self.capacity:
+            with open(path, 'r+b') as stackFile:
+                version = np.lib.format.read_magic(stackFile)
+                read_header, write_header = ((np.lib.format.read_array_header_1_0, np.lib.format.write_array_header_1_0)
+                                             if version == (1, 0) else
+                                             (np.lib.format.read_array_header_2_0, np.lib.format.write_array_header_2_0))
+                read_header(stackFile)
+                offset = stackFile.tell()
+                stackFile.seek(0)
+                write_header(stackFile, {'descr': '<f8', 'fortran_order': False, 'shape': shape})
+                if stackFile.tell() != offset:
+                    raise ValueError("could not shorten the header of " + path)
+                stackFile.truncate(offset + int(np.prod(shape)) * 8)
+        
+        header = {'states': state_names(self.location_to_state), 'shape': list(shape), 'paths_taken': paths_taken}
+        with open(self.basename + '.json', 'w') as headerFile:
+            json.dump(header, headerFile)
+        return load_qtables(path)[0]
+
+def find_qtables(basename):
+    """Path of the stored stack for basename, or None if there is none
+    """
+    for path in (basename, basename + '.npy', basename + '.npz'):
+        if path.endswith(('.npy', '.npz')) and os.path.exists(path):
+            return path
+    return None
+
+def load_qtables(path, mmap=True):
+    """Return the stack of tables and its header
+
+    .npy stacks are memory-mapped read-only unless mmap is False.
+    """
+    if path.endswith('.npz'):
+        with np.load(path) as stored:
+            return stored['qtables'], json.loads(str(stored['header']))
+    
+    header = {}
+    if os.path.exists(path[:-len('.npy')] + '.json'):
+        with open(path[:-len('.npy')] + '.json') as headerFile:
+            header = json.load(headerFile)
+    return np.load(path, mmap_mode='r' if mmap else None), header
+
+def select_table(qtables, header, table=None):
+    """One table of a stored stack, by position, by its name in the header, or "mean" for the average
+
+    A stack of several tables is an error unless table says which one to take.
+    """
+    names = header.get('tables') or []
+    if table is None:
+        if len(qtables) != 1:
+            raise ValueError("stack holds %d tables %s; pick one by position, by name or the mean" % (len(qtables), names or ""))
+        return qtables[0]
+    if table == "mean":
+        return qaverage(qtables)
+    if table in names:
+        return qtables[names.index(table)]
+    if table.lstrip("-").isdigit() and -len(qtables) <= int(table) < len(qtables):
+        return qtables[int(table)]
+    raise ValueError("no table %r in a stack of %d tables %s" % (table, len(qtables), names or ""))
+
+def find_table(name):
+    """The single stored table a name picks, or None if nothing is stored under it
+
+    name is the basename or path of a stack, optionally followed by the table in brackets:
+    "NoIntegrated.txt[E2]", "NoIntegrated.txtE1[mean]" or "run.npy[0]".
+    """
+    basename, table = name, None
+    if name.endswith("]") and "[" in name:
+        basename, table = name[:-1].rsplit("[", 1)
+    path = find_qtables(basename)
+    if path is None:
+        return None
+    qtables, header = load_qtables(path)
+    return select_table(qtables, header, table)
+
+def export_excel(filename, qtables, paths_taken=None):
+    """Write the routes (if any) to the first worksheet and each table to a worksheet of its own
+    """
+    import xlsxwriter
+    
+    workbook = xlsxwriter.Workbook(filename)
+    if paths_taken is not None:
+        worksheet = workbook.add_worksheet()
+        for row, data in enumerate(paths_taken):
+            if data is not None:
+                worksheet.write_row(row, 0, data)
+    
+    for table in qtables:
+        worksheet = workbook.add_worksheet()
+        for row, data in enumerate(np.asarray(table).tolist()):
+            worksheet.write_row(row, 0, data)
+    
+    workbook.close()
+
+def stored_to_excel(path, filename=None):
+    """Turn a stored stack into an .xlsx workbook laid out like the old to_excel output
+    """
+    qtables, header = load_qtables(path)
+    filename = filename or os.path.splitext(path)[0] + '.xlsx'
+    export_excel(filename, qtables, header.get('paths_taken'))
+    return filename
+
+def main(argv=None):
+    """python -m mplay.store stack.npy [more.npz ...] writes an .xlsx next to each stored stack
+    """
+    for path in sys.argv[1:] if argv is None else argv:
+        print(stored_to_excel(path))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+import argparse
+import csv
+import itertools
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from mplay import instrument
+from mplay.aggregate import RunningTable
+from mplay.batchscore import topology_files
+from mplay.loaders import ending_names, load_topology
+from mplay.parallel import replica_seed
+from mplay.qbatch import sample_edges
+from mplay.rollout import RolloutQAgent
+from mplay.scoring import meaningfulness
+from mplay.topology import TopologyIndex
+
+
+# ### Hyperparameter Sweeps
+# 
+# Scores a topology for every combination of grids of alpha, gamma, iterations and ending reward (and
+# epsilon, for the episode trainer), reading and indexing each file once and writing one row per
+# combination. The batch trainer observes states and takes edges independently of the settings, so
+# every (alpha, gamma, ending reward) of an ending trains on one draw of transitions in one stacked
+# tensor. A replica draws one iteration at a time, so a short run is the start of a long one, and
+# every iteration count of the grid is read off the one longest run.
+# 
+#     python -m mplay.sweep NoIntegrated.txt --alpha 0.5,0.9 --gamma 0.5:0.95:0.15 --iterations 500:2000:500
+#     python -m mplay.sweep split.txt --trainer rollout --epsilon 0.1,0.3 --final-reward 100,999 --workers 4
+
+#grid columns of the output table, then the results of each combination
+PARAMETERS = ['alpha', 'gamma', 'epsilon', 'iterations', 'final_reward']
+FIELDS = ['file', 'trainer'] + PARAMETERS + ['score', 'max_stderr']
+
+#bytes of the stacked q-tensor a batch job may hold, which sets how many settings train together
+TENSOR_BYTES = 1 << 28
+
+def parse_values(text, kind=float):
+    """Values of a grid argument: comma separated numbers or inclusive start:stop:step ranges, without repeats
+    """
+    values = []
+    for part in text.split(","):
+        if ":" in part:
+            start, stop, step = (float(number) for number in part.split(":"))
+            if step <= 0:
+                raise ValueError("range step must be positive: " + part)
+            count = int(np.floor((stop - start) / step + 1e-9)) + 1
+            values += [kind(round(start + i * step, 12)) for i in range(count)]
+        else:
+            values.append(kind(part))
+    return list(dict.fromkeys(values))
+
+def train_grid(rewards, location_to_state, final_state, ending, settings, iterations, replicas=100, seed=0):
+    """RunningTables of one ending for every (alpha, gamma, final_reward) in settings, after each count in iterations
+    
+    Returns {count: [RunningTable of each setting]}. A setting's tables equal those BatchQAgent
+    trains with its alpha and gamma and its final_reward on the ending's self loop.
+    """
+    with instrument.stage("sweep"):
+        ending_state = location_to_state[final_state]
+        alphas, gammas, final_rewards = (np.array(column, dtype=float)[:, np.newaxis] for column in zip(*settings))
+        if (final_rewards <= 0).any():
+            raise ValueError("the ending reward must be positive to keep the ending playable")
+        
+        #every positive ending reward leaves the same playable edges, so one draw serves them all
+        rewards_new = np.array(rewards, dtype=float)
+        rewards_new[ending_state, ending_state] = 1
+        playable = TopologyIndex(rewards_new)
+        counts = sorted(set(iterations))
+        states, edges = sample_edges(playable, replicas, counts[-1], [replica_seed(seed, ending, r) for r in range(replicas)])
+        actions = np.where(edges >= 0, playable.targets[edges], -1)
+        
+        Q = np.zeros([len(settings), replicas, len(rewards_new), len(rewards_new)])
+        replica_index = np.arange(replicas)
+        results = {}
+        td_updates = 0
+        for i in range(counts[-1] + 1):
+            if i in counts:
+                results[i] = [RunningTable().add_all(tables) for tables in Q]
+            if i == counts[-1]:
+                break
+            
+            live = actions[i] >= 0
+            r = replica_index[live]
+            td_updates += len(r)
+            current_state = states[i, live]
+            next_state = actions[i, live]
+            
+            #Calculate temporal difference for every setting at once
+            loop = (current_state == ending_state) & (next_state == ending_state)
+            reward = np.where(loop, final_rewards, rewards_new[current_state, next_state])
+            TD = reward + gammas * Q[:, r, next_state].max(axis=2) - Q[:, r, current_state, next_state]
+            
+            #updates Q-values using Bellman equation
+            Q[:, r, current_state, next_state] += alphas * TD
+        
+        instrument.count("iterations", counts[-1] * replicas * len(settings))
+        instrument.count("td_updates", td_updates * len(settings))
+    return results
+
+def _train_grid(job):
+    """Worker entry point for train_grid
+    """
+    rewards, location_to_state, final_state, ending, settings, iterations, replicas, seed = job
+    return train_grid(rewards, location_to_state, final_state, ending, settings, iterations, replicas, seed)
+
+def _train_rollout(job):
+    """Worker entry point training one ending with the episode trainer, returning its RunningTable
+    """
+    rewards, location_to_state, final_state, ending, alpha, gamma, epsilon, iterations, final_reward, replicas, seed = job
+    state_to_location = dict((state, location) for location, state in location_to_state.items())
+    qagent = RolloutQAgent(alpha, gamma, epsilon, location_to_state, rewards, state_to_location, replicas)
+    #the episode trainer draws every replica from one generator per ending
+    qagent.training('Start', final_state, iterations, np.random.RandomState([seed, ending]), final_reward, routes=False)
+    return RunningTable().add_all(qagent.Q)
+
+def sweep(rewards, location_to_state, final_states, alphas=(0.9,), gammas=(0.75,), iterations=(1000,),
+          final_rewards=None, epsilons=(0.1,), trainer="batch", replicas=100, seed=0, p_value=1, executor=None,
+          batch=None):
+    """Score the topology for every combination of the grids and return one row per combination
+    
+    trainer "batch" is the BatchQAgent of MPD_V1 (final reward 999 by default), which has no epsilon,
+    and "rollout" the epsilon-greedy episodes of the V5 notebook (final reward 100 by default), which
+    trains each combination on its own. batch caps the settings trained in one tensor, by default as
+    many as fit in TENSOR_BYTES. Jobs run on executor when one is given.
+    """
+    if final_rewards is None:
+        final_rewards = (999,) if trainer == "batch" else (100,)
+    if trainer == "batch":
+        epsilons = (None,)
+    
+    #the RunningTable of every ending for each combination, filled in as jobs finish
+    tables = {}
+    run = executor.map if executor is not None else map
+    if trainer == "batch":
+        settings = list(itertools.product(alphas, gammas, final_rewards))
+        if batch is None:
+            batch = max(1, TENSOR_BYTES // (replicas * len(rewards) * len(rewards) * 8))
+        jobs = [(rewards, location_to_state, final_state, ending, settings[first:first + batch], iterations, replicas, seed)
+                for ending, final_state in enumerate(final_states) for first in range(0, len(settings), batch)]
+        for job, results in zip(jobs, run(_train_grid, jobs)):
+            for count, statistics in results.items():
+                for (alpha, gamma, final_reward), statistic in zip(job[4], statistics):
+                    tables.setdefault((alpha, gamma, None, count, final_reward), {})[job[3]] = statistic
+    elif trainer == "rollout":
+        combinations = list(itertools.product(alphas, gammas, epsilons, iterations, final_rewards))
+        jobs = [(rewards, location_to_state, final_state, ending) + combination + (replicas, seed)
+                for combination in combinations for ending, final_state in enumerate(final_states)]
+        for job, statistic in zip(jobs, run(_train_rollout, jobs)):
+            tables.setdefault(job[4:9], {})[job[3]] = statistic
+    else:
+        raise ValueError("unknown trainer " + repr(trainer))
+    
+    rows = []
+    for combination in itertools.product(alphas, gammas, epsilons, iterations, final_rewards):
+        statistics = [tables[combination][ending] for ending in range(len(final_states))]
+        row = dict(zip(PARAMETERS, combination), trainer=trainer)
+        row['score'] = round(meaningfulness([ending.mean for ending in statistics], p_value), 3)
+        row['max_stderr'] = round(max(float(np.max(ending.standard_error, initial=0)) for ending in statistics), 3)
+        rows.append(row)
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score topology files over grids of training settings.")
+    parser.add_argument("patterns", nargs="+", help="topology files or glob patterns")
+    parser.add_argument("--output", default="-", help="csv to write, - for stdout")
+    parser.add_argument("--trainer", choices=["batch", "rollout"], default="batch",
+                        help="batch observes random states like MPD_V1, rollout walks epsilon-greedy episodes")
+    parser.add_argument("--alpha", default="0.9", help="values or start:stop:step ranges, comma separated")
+    parser.add_argument("--gamma", default="0.75")
+    parser.add_argument("--epsilon", help="rollout trainer only, 0.1 by default")
+    parser.add_argument("--iterations", default="1000")
+    parser.add_argument("--final-reward", help="reward of the ending self loop, 999 for batch and 100 for rollout by default")
+    parser.add_argument("--replicas", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--p", type=float, default=1, dest="p_value", help="Minkowski p of the score")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes shared by every file")
+    parser.add_argument("--batch", type=int, help="most settings to train in one tensor")
+    args = parser.parse_args(argv)
+    
+    if args.epsilon is not None and args.trainer == "batch":
+        parser.error("--epsilon only applies to --trainer rollout")
+    try:
+        grids = dict(alphas=parse_values(args.alpha), gammas=parse_values(args.gamma),
+                     epsilons=parse_values(args.epsilon or "0.1"), iterations=parse_values(args.iterations, int))
+        if args.final_reward is not None:
+            grids['final_rewards'] = parse_values(args.final_reward)
+    except ValueError as error:
+        parser.error(str(error))
+    
+    executor = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+    output = sys.stdout if args.output == "-" else open(args.output, "w", newline="")
+    try:
+        writer = csv.DictWriter(output, fieldnames=FIELDS)
+        writer.writeheader()
+        for filename in topology_files(args.patterns):
+            rewards, location_to_state = load_topology(filename)
+            for row in sweep(rewards, location_to_state, ending_names(location_to_state), trainer=args.trainer,
+                             replicas=args.replicas, seed=args.seed, p_value=args.p_value, executor=executor,
+                             batch=args.batch, **grids):
+                writer.writerow(dict(row, file=filename))
+            output.flush()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if output is not sys.stdout:
+            output.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import numpy as np
+
+
+# ### Topology Index
+# 
+# Compressed sparse row (CSR) view of a reward matrix. Built once per matrix so that looking up or
+# sampling the playable actions of a state is an array lookup instead of a scan of its whole row.
+
+class TopologyIndex():
+    
+    def __init__(self, rewards=None):
+        """ Build successor offsets and targets for every state with a positive reward
+        """
+        if rewards is not None:
+            adjacency = np.asarray(rewards) > 0
+            self._build(len(adjacency), *np.nonzero(adjacency))
+    
+    @classmethod
+    def from_edges(cls, size, sources, targets):
+        """Build the index straight from lists of edge endpoints, without a dense matrix
+
+        Repeated edges are kept once.
+        """
+        keys = np.unique(np.asarray(sources, dtype=np.int64) * size + np.asarray(targets, dtype=np.int64))
+        index = cls()
+        index._build(size, keys // size, keys % size)
+        return index
+    
+    def _build(self, size, sources, targets):
+        """Set up the CSR arrays from edges sorted by source and then target
+        """
+        self.size = size
+        
+        #successors of state s are targets[offsets[s]:offsets[s + 1]], in column order
+        self.degrees = np.bincount(sources, minlength=size)
+        self.offsets = np.zeros(self.size + 1, dtype=np.int64)
+        np.cumsum(self.degrees, out=self.offsets[1:])
+        self.sources = np.asarray(sources, dtype=np.int64)
+        self.targets = np.asarray(targets, dtype=np.int64)
+        
+        #states that have at least one playable action
+        self.active = np.flatnonzero(self.degrees)
+        
+    def successors(self, state):
+        """Return the playable actions of a state
+        """
+        return self.targets[self.offsets[state]:self.offsets[state + 1]]
+    
+    def out_edges(self, states):
+        """Positions of every edge leaving any of the given states, state by state
+        """
+        states = np.asarray(states, dtype=np.int64)
+        counts = self.degrees[states]
+        starts = np.repeat(self.offsets[states] - np.cumsum(counts) + counts, counts)
+        return starts + np.arange(counts.sum())
+    
+    def sample_edge(self, state, random_state=np.random):
+        """Pick one of the edges leaving a state uniformly at random and return its position
+        """
+        return self.offsets[state] + random_state.randint(0, self.degrees[state])
+    
+    def sample_action(self, state, random_state=np.random):
+        """Pick a playable action of a state uniformly at random
+
+        Uses the same draw as np.random.choice over the list of playable actions.
+        """
+        return self.targets[self.sample_edge(state, random_state)]
+    
+    def edge_ids(self, sources, targets):
+        """Positions of the given (source, target) edges, which must all exist in the index
+        """
+        keys = self.sources * self.size + self.targets
+        return np.searchsorted(keys, np.asarray(sources, dtype=np.int64) * self.size + np.asarray(targets, dtype=np.int64))
+    
+    def to_dense(self, values=1, dtype=np.int64):
+        """Dense N x N matrix holding values on every edge and zero elsewhere
+        """
+        dense = np.zeros([self.size, self.size], dtype=dtype)
+        dense[self.sources, self.targets] = values
+        return dense
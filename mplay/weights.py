@@ -0,0 +1,93 @@
+from collections import OrderedDict
+import hashlib
+import numpy as np
+
+from mplay.topology import TopologyIndex
+
+
+# ### Layer Weighting
+# 
+# Gives the Q-values of early states more say in the score. Every state gets the weight of its layer,
+# its breadth-first depth from Start, and every row of the averaged tables is scaled by the weight of
+# its state in one broadcast multiply. The notebooks found the layers with a recursive depth-first
+# walk over a visited list; breadth-first depth is the shortest number of choices from Start, which
+# is the same on layered diagrams but can put a state reached by two paths of different length in an
+# earlier layer than the walk did.
+# 
+#     depths = layer_depths(TopologyIndex(rewards), location_to_state['Start'])
+#     weighted = weight_tables(averaged_tables, state_weights(depths, weight_calculator(5)[::-1]))
+
+#depths of recently weighted topologies, by the hash of their edges and start state
+_depths = OrderedDict()
+DEPTH_CACHE_SIZE = 64
+
+def layer_depths(index, start):
+    """Breadth-first depth of every state from start, -1 for states it cannot reach
+    
+    Results are cached per topology, since every table of a topology shares them.
+    """
+    digest = hashlib.sha256(b"%d %d " % (index.size, start))
+    digest.update(np.ascontiguousarray(index.sources, dtype=np.int64).tobytes())
+    digest.update(np.ascontiguousarray(index.targets, dtype=np.int64).tobytes())
+    digest = digest.hexdigest()
+    if digest in _depths:
+        _depths.move_to_end(digest)
+        return _depths[digest].copy()
+    
+    depths = np.full(index.size, -1, dtype=np.int64)
+    depths[start] = 0
+    frontier = np.array([start], dtype=np.int64)
+    depth = 0
+    while len(frontier) > 0:
+        depth += 1
+        children = index.targets[index.out_edges(frontier)]
+        frontier = np.unique(children[depths[children] < 0])
+        depths[frontier] = depth
+    
+    _depths[digest] = depths
+    if len(_depths) > DEPTH_CACHE_SIZE:
+        _depths.popitem(last=False)
+    return depths.copy()
+
+def weight_calculator(layers):
+    """Weights 1..layers of a straight line, shifted so they sum to 1, smallest first
+    
+    The V5 notebook reverses them so that the first layer weighs the most.
+    """
+    slope = 1 / (layers * layers)
+    ramp = np.arange(1, layers + 1) * slope
+    return ramp + (1 - ramp.sum()) / layers
+
+def state_weights(depths, weights, fill=1.0):
+    """Weight of every state from the weight of its layer
+    
+    weights is a sequence indexed by depth, or a function that takes the number of layers and returns
+    one. States deeper than the weights reach, and states Start cannot reach, keep fill, which is 1 as
+    in the notebooks.
+    """
+    depths = np.asarray(depths)
+    if callable(weights):
+        weights = weights(int(depths.max(initial=-1)) + 1)
+    weights = np.asarray(weights, dtype=float)
+    
+    result = np.full(len(depths), fill, dtype=float)
+    layered = (depths >= 0) & (depths < len(weights))
+    result[layered] = weights[depths[layered]]
+    return result
+
+def weight_tables(tables, weights, zero_loops=True):
+    """Scale every row of a (..., N, N) stack of tables by the weight of its state
+    
+    zero_loops first clears the self loop cells, which only hold the ending reward, as the notebooks did.
+    """
+    tables = np.array(tables, dtype=float)
+    if zero_loops:
+        diagonal = np.arange(tables.shape[-1])
+        tables[..., diagonal, diagonal] = 0
+    return tables * np.asarray(weights)[:, np.newaxis]
+
+def weight_layers(tables, rewards, start, weights, fill=1.0, zero_loops=True):
+    """Weight a stack of dense tables by the layers of the reward matrix below start
+    """
+    depths = layer_depths(TopologyIndex(rewards), start)
+    return weight_tables(tables, state_weights(depths, weights, fill), zero_loops)
@@ -1,5 +1,6 @@
 import numpy as np
 import xlsxwriter
+from mplay.topology import TopologyIndex
 
 # Define the states
 location_to_state = {
@@ -81,15 +82,13 @@ class QAgent():
         ending_state = self.location_to_state[end_location]
         rewards_new[ending_state, ending_state] = 999
         
+        #index the possible actions of every state once
+        playable = TopologyIndex(rewards_new)
+        
         for i in range(iterations):
             current_state = np.random.randint(0,20) 
-            playable_actions = []
-
-            for j in range(20):
-                if rewards_new[current_state,j] > 0:
-                    playable_actions.append(j)
     
-            next_state = np.random.choice(playable_actions)
+            next_state = playable.sample_action(current_state)
 
             #Calculate temporal difference
             TD = rewards_new[current_state,next_state] + \
@@ -0,0 +1,20 @@
+import os
+import numpy as np
+
+from mplay.cache import QCache
+
+
+# ### Q-Table Cache
+# 
+# Entries that cannot be read back count as misses and are dropped.
+
+def test_truncated_entry_is_a_miss(tmp_path):
+    cache = QCache(str(tmp_path))
+    cache.put("key", np.ones([2, 3, 3]))
+    with open(cache.path("key"), 'rb') as entryFile:
+        data = entryFile.read()
+    with open(cache.path("key"), 'wb') as entryFile:
+        entryFile.write(data[:len(data) // 2])
+    
+    assert cache.get("key") is None
+    assert not os.path.exists(cache.path("key"))
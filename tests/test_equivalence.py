@@ -0,0 +1,113 @@
+import os
+import numpy as np
+
+from mplay import scoring, sparse
+from mplay.aggregate import RunningTable
+from mplay.checkpoint import Checkpoint, train_checkpointed
+from mplay.loaders import ending_names, load_topology
+from mplay.parallel import replica_seed
+from mplay.qbatch import BatchQAgent
+from mplay.sweep import train_grid
+from mplay.topology import TopologyIndex
+from mplay.weights import layer_depths, state_weights, weight_calculator, weight_tables
+
+
+# ### Equivalence
+# 
+# The faster training paths promise the same tables as the ones they replace, bit for bit, given the
+# same seeds. These run each pair on the bundled NoIntegrated topology and compare them exactly.
+
+TOPOLOGY = os.path.join(os.path.dirname(__file__), os.pardir, "NoIntegrated.txt")
+REPLICAS = 4
+ITERATIONS = 300
+
+def topology():
+    rewards, location_to_state = load_topology(TOPOLOGY)
+    return rewards, location_to_state, ending_names(location_to_state)
+
+def per_agent_tables(rewards, location_to_state, end_location, replicas, iterations, alpha=0.9, gamma=0.75):
+    """Tables of one QAgent per replica drawing from the global stream, with the row scan and
+    np.random.choice of the original MPD_V1 QAgent.training
+    """
+    rewards_new = np.copy(rewards)
+    ending_state = location_to_state[end_location]
+    rewards_new[ending_state, ending_state] = 999
+    
+    qtables = []
+    for r in range(replicas):
+        Q = np.zeros([len(rewards), len(rewards)])
+        for i in range(iterations):
+            current_state = np.random.randint(0, len(rewards))
+            playable_actions = []
+            for j in range(len(rewards)):
+                if rewards_new[current_state, j] > 0:
+                    playable_actions.append(j)
+            if len(playable_actions) > 0:
+                next_state = np.random.choice(playable_actions)
+                TD = rewards_new[current_state, next_state] + gamma * Q[next_state, np.argmax(Q[next_state,])] - Q[current_state, next_state]
+                Q[current_state, next_state] += alpha * TD
+        qtables.append(Q)
+    return np.array(qtables)
+
+def test_batched_matches_per_agent():
+    rewards, location_to_state, final_states = topology()
+    state_to_location = dict((state, location) for location, state in location_to_state.items())
+    
+    np.random.seed(7)
+    expected = per_agent_tables(rewards, location_to_state, final_states[0], REPLICAS, ITERATIONS)
+    np.random.seed(7)
+    qagent = BatchQAgent(0.9, 0.75, location_to_state, rewards, state_to_location, REPLICAS)
+    qagent.training('Start', final_states[0], ITERATIONS, routes=False)
+    assert np.array_equal(qagent.Q, expected)
+
+def test_sparse_matches_dense():
+    rewards, location_to_state, final_states = topology()
+    dense = scoring.train_endings(rewards, location_to_state, final_states, replicas=REPLICAS, iterations=ITERATIONS, seed=3)
+    layout = sparse.EdgeTopology.from_dense(rewards, location_to_state)
+    edges = sparse.train_endings(layout, final_states, replicas=REPLICAS, iterations=ITERATIONS, seed=3)
+    for dense_tables, edge_tables in zip(dense, edges):
+        assert np.array_equal(layout.to_dense(edge_tables), dense_tables)
+
+def test_resumed_checkpoint_matches_uninterrupted(tmp_path):
+    rewards, location_to_state, final_states = topology()
+    settings = {'replicas': REPLICAS, 'iterations': ITERATIONS, 'alpha': 0.9, 'gamma': 0.75, 'seed': 5}
+    expected = scoring.train_endings(rewards, location_to_state, final_states, **settings)
+    
+    #stop a run part of the way through: two replicas of the first ending a third of the way in
+    checkpoint = Checkpoint(rewards, location_to_state, final_states, **settings)
+    state_to_location = dict((state, location) for location, state in location_to_state.items())
+    replicas = np.array([0, 2])
+    random_states = checkpoint.generators(0, replicas)
+    qagent = BatchQAgent(0.9, 0.75, location_to_state, rewards, state_to_location, len(replicas), checkpoint.tables(0, replicas))
+    qagent.training('Start', final_states[0], ITERATIONS // 3, random_states, routes=False)
+    checkpoint.record(0, replicas, qagent.Q, random_states, ITERATIONS // 3)
+    filename = str(tmp_path / "run.ckpt.npz")
+    checkpoint.save(filename)
+    
+    resumed = train_checkpointed(filename, rewards, location_to_state, final_states, block=70, interval=0, **settings)
+    for expected_tables, resumed_tables in zip(expected, resumed):
+        assert np.array_equal(resumed_tables, expected_tables)
+
+def test_sweep_matches_separate_runs():
+    rewards, location_to_state, final_states = topology()
+    state_to_location = dict((state, location) for location, state in location_to_state.items())
+    settings = [(0.9, 0.75, 999), (0.5, 0.6, 999)]
+    counts = [ITERATIONS // 2, ITERATIONS]
+    results = train_grid(rewards, location_to_state, final_states[1], 1, settings, counts, REPLICAS, seed=2)
+    
+    for count in counts:
+        for (alpha, gamma, final_reward), statistics in zip(settings, results[count]):
+            qagent = BatchQAgent(alpha, gamma, location_to_state, rewards, state_to_location, REPLICAS)
+            qagent.training('Start', final_states[1], count, [replica_seed(2, 1, r) for r in range(REPLICAS)], routes=False)
+            assert np.array_equal(statistics.mean, RunningTable().add_all(qagent.Q).mean)
+
+def test_weighted_sparse_score_matches_dense():
+    rewards, location_to_state, final_states = topology()
+    layout = sparse.EdgeTopology.from_dense(rewards, location_to_state)
+    dense = scoring.train_endings(rewards, location_to_state, final_states, replicas=REPLICAS, iterations=ITERATIONS, seed=3)
+    averaged = np.array([RunningTable().add_all(tables).mean for tables in dense])
+    weights = state_weights(layer_depths(TopologyIndex(rewards), location_to_state['Start']), lambda layers: weight_calculator(layers)[::-1])
+    
+    dense_score = scoring.meaningfulness(weight_tables(averaged, weights))
+    sparse_score = scoring.meaningfulness(sparse.weight_states(layout.edge_values(averaged), layout, weights))
+    assert np.isclose(sparse_score, dense_score)
@@ -0,0 +1,34 @@
+import os
+import numpy as np
+
+from mplay.cache import QCache
+from mplay.incremental import ancestors, changed_states, match_edges, rescore, score_snapshot
+from mplay.loaders import load_topology
+from mplay.sparse import EdgeTopology
+
+
+# ### Incremental Rescoring
+
+TOPOLOGY = os.path.join(os.path.dirname(__file__), os.pardir, "NoIntegrated.txt")
+TRAINING = {'replicas': 4, 'iterations': 300, 'seed': 1}
+
+def test_sampled_retrain_leaves_unaffected_states_alone(tmp_path):
+    rewards, location_to_state = load_topology(TOPOLOGY)
+    old = EdgeTopology.from_dense(rewards, location_to_state)
+    cache = QCache(str(tmp_path / "cache"))
+    snapshot = score_snapshot(old, cache=cache, **TRAINING)
+    
+    #drop one edge from a state in the last layer, so only the states that can reach it are redone
+    edited = np.array(rewards)
+    source = location_to_state['16']
+    edited[source, np.flatnonzero(edited[source])[0]] = 0
+    new = EdgeTopology.from_dense(edited, location_to_state)
+    updated, summary = rescore(new, snapshot, cache, **TRAINING)
+    
+    matches = match_edges(old, new)
+    affected = ancestors(new.index, changed_states(old, new, matches))
+    assert 0 < affected.sum() < new.size and summary['retrained'] == new.goals
+    kept = ~affected[new.index.sources]
+    for goal in range(len(new.goals)):
+        assert np.array_equal(updated.means[goal][kept], snapshot.means[goal][matches[kept]])
+        assert not np.array_equal(updated.means[goal][~kept], snapshot.means[goal][matches[~kept]])
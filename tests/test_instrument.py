@@ -0,0 +1,38 @@
+import numpy as np
+
+from mplay import instrument
+
+
+# ### Instrumentation
+
+MEGABYTES = 1 << 20
+
+def test_nested_stage_keeps_the_enclosing_peak():
+    with instrument.recording(instrument.Recorder(trace_memory=True)) as recorder:
+        with instrument.stage("outer"):
+            #a large allocation that is gone again before the inner stage starts
+            scratch = np.ones(10 * MEGABYTES // 8)
+            del scratch
+            with instrument.stage("inner"):
+                small = np.ones(1000)
+            with instrument.stage("second"):
+                medium = np.ones(2 * MEGABYTES // 8)
+                del medium
+    
+    stages = recorder.to_dict()['stages']
+    assert stages['outer']['peak_bytes'] >= 10 * MEGABYTES
+    assert stages['outer/inner']['peak_bytes'] < MEGABYTES
+    assert 2 * MEGABYTES <= stages['outer/second']['peak_bytes'] < 10 * MEGABYTES
+
+def test_stages_and_counters_are_recorded():
+    with instrument.recording(instrument.Recorder()) as recorder:
+        with instrument.stage("E1"):
+            with instrument.stage("training"):
+                instrument.count("td_updates", 5)
+            instrument.count("td_updates", 2)
+    
+    record = recorder.to_dict()
+    assert record['stages']['E1/training']['calls'] == 1
+    assert record['stages']['E1/training']['counters'] == {'td_updates': 5}
+    assert record['stages']['E1']['counters'] == {'td_updates': 2}
+    assert record['counters'] == {'td_updates': 7}
@@ -0,0 +1,27 @@
+import asyncio
+
+from mplay.server import ScoringServer, request_score
+
+
+# ### Scoring Server
+# 
+# Every event the server streams has to be valid JSON, including the score of a topology with
+# nothing to compare.
+
+async def score_events(path, payload, **settings):
+    server = ScoringServer(workers=1)
+    await server.start()
+    listener = await asyncio.start_unix_server(server.handle, path)
+    try:
+        async with listener:
+            return [event async for event in request_score(payload, "single.txt", path=path, **settings)]
+    finally:
+        await server.close()
+
+def test_single_ending_scores_null(tmp_path):
+    payload = b"0,1,0\n0,0,1\n0,0,0\n"
+    events = asyncio.run(score_events(str(tmp_path / "server.sock"), payload, replicas=2, iterations=10))
+    
+    assert events[0] == {'event': "parsed", 'states': 3, 'endings': 1}
+    assert events[-1]['event'] == "score"
+    assert events[-1]['score'] is None
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from mplay.store import StackWriter, find_table, load_qtables, save_qtables
+
+
+# ### Stored Tables
+# 
+# Picking one table out of a stored stack, as the distance scripts do.
+
+LOCATIONS = {'Start': 0, 'E1': 1, 'E2': 2}
+
+def stack(count):
+    return np.arange(count * 9, dtype=float).reshape(count, 3, 3)
+
+def test_single_table_needs_no_selection(tmp_path):
+    basename = str(tmp_path / "single")
+    save_qtables(basename, stack(1), LOCATIONS)
+    assert np.array_equal(find_table(basename), stack(1)[0])
+
+def test_tables_picked_by_name_index_or_mean(tmp_path):
+    basename = str(tmp_path / "averaged")
+    save_qtables(basename, stack(2), LOCATIONS, names=['E1', 'E2'])
+    assert np.array_equal(find_table(basename + "[E2]"), stack(2)[1])
+    assert np.array_equal(find_table(basename + ".npy[0]"), stack(2)[0])
+    assert np.array_equal(find_table(basename + "[mean]"), stack(2).mean(axis=0))
+    
+    #the picked table is still a view of the memory-mapped stack
+    assert isinstance(find_table(basename + "[E1]").base, np.memmap)
+
+def test_several_tables_without_selection_is_an_error(tmp_path):
+    basename = str(tmp_path / "replicas")
+    save_qtables(basename, stack(3), LOCATIONS, compressed=True)
+    with pytest.raises(ValueError):
+        find_table(basename)
+    with pytest.raises(ValueError):
+        find_table(basename + "[E3]")
+    assert load_qtables(basename + ".npz")[1].get('tables') is None
+
+def test_missing_stack_is_none(tmp_path):
+    assert find_table(str(tmp_path / "missing[E1]")) is None
+
+def test_stack_writer_streams_batches(tmp_path):
+    writer = StackWriter(str(tmp_path / "streamed"), LOCATIONS, 5)
+    for batch in np.split(stack(4), [1, 3]):
+        writer.add_all(batch)
+    stored = writer.close(paths_taken=[[4, "reached", 'Start', 'E1']])
+    
+    #the unused room for a fifth table is dropped from the file
+    assert np.array_equal(stored, stack(4))
+    qtables, header = load_qtables(str(tmp_path / "streamed.npy"), mmap=False)
+    assert np.array_equal(qtables, stack(4))
+    assert header['shape'] == [4, 3, 3] and header['paths_taken'] == [[4, "reached", 'Start', 'E1']]